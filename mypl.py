@@ -9,8 +9,11 @@ CLASS: CPSC 326
 import argparse
 import sys
 import io
+import json
+import os
+import time
 
-from mypl_iowrapper import FileWrapper, StdInWrapper
+from mypl_iowrapper import StdInWrapper, BufferedWrapper, MappedWrapper
 from mypl_error import MyPLError
 from mypl_lexer import Lexer
 from mypl_token import TokenType, Token
@@ -20,6 +23,15 @@ from mypl_printer import PrintVisitor
 from mypl_semantic_checker import SemanticChecker
 from mypl_code_gen import CodeGenerator
 from mypl_vm import VM
+from mypl_cache import cache_key, load_templates, save_templates
+from mypl_incremental import IncrementalCompiler
+from mypl_daemon import default_socket, serve
+from mypl_batch import TIMEOUT, run_batch
+from mypl_parallel import compile_parallel
+
+
+# source files at least this many bytes are memory-mapped
+MAPPED_SIZE = 1 << 20
 
 
 def run_lex_mode(in_stream):
@@ -31,12 +43,8 @@ def run_lex_mode(in_stream):
 
     """
     try: 
-        lexer = Lexer(in_stream)
-        t = lexer.next_token()
-        while t.token_type != TokenType.EOS:
+        for t in Lexer(in_stream).tokens(comments=True):
             print(t)
-            t = lexer.next_token()
-        print(t)
     except MyPLError as ex:
         print(ex)
         exit(1)
@@ -104,55 +112,158 @@ def run_check_mode(in_stream):
 
 
     
-def run_ir_mode(in_stream):
+def run_ir_mode(in_stream, opt_level=0, profile=None, jobs=None):
     """Generates the intermediate representation (VM instructions) for the
     given mypl program and prints to standard output the resulting
     instructions.
 
     Args: 
         in_stream -- A wrapped input stream containing a mypl program.
+        opt_level -- The code generator optimization level.
+        profile -- Profile data to guide code generation (optional).
+        jobs -- If more than 1, the number of processes to check and
+                generate functions with.
 
     """
     try: 
         lexer = Lexer(in_stream)
         parser = ASTParser(lexer)
         ast = parser.parse()
-        visitor = SemanticChecker()
-        ast.accept(visitor)
         vm = VM()
-        codegen = CodeGenerator(vm)
-        ast.accept(codegen)
+        if jobs and jobs > 1:
+            compile_parallel(ast, vm, opt_level, profile, jobs)
+        else:
+            visitor = SemanticChecker()
+            ast.accept(visitor)
+            codegen = CodeGenerator(vm, opt_level, profile)
+            ast.accept(codegen)
         print(vm)
     except MyPLError as ex:
         print(ex)
         exit(1)
 
     
-def run_normal_mode(in_stream):
+def run_normal_mode(in_stream, opt_level=0, profile=None, profile_out=None,
+                    lazy=False, jobs=None):
     """Executes the given mypl program. Any output produced by the program
     is printed to standard output. 
 
     Args: 
         in_stream -- A wrapped input stream containing a mypl program.
+        opt_level -- The code generator optimization level.
+        profile -- Profile data to guide code generation (optional).
+        profile_out -- File name to save the run's profile to (optional).
+        lazy -- If True, generate code for each function on its first call.
+        jobs -- If more than 1 (and not lazy), the number of processes to
+                check and generate functions with.
 
     """
     try: 
         lexer = Lexer(in_stream)
         parser = ASTParser(lexer)
         ast = parser.parse()
-        visitor = SemanticChecker()
-        ast.accept(visitor)
         vm = VM()
-        codegen = CodeGenerator(vm)
-        ast.accept(codegen)
+        if jobs and jobs > 1 and not lazy:
+            compile_parallel(ast, vm, opt_level, profile, jobs)
+        else:
+            visitor = SemanticChecker()
+            ast.accept(visitor)
+            codegen = CodeGenerator(vm, opt_level, profile, lazy)
+            ast.accept(codegen)
+        vm.run(profile=profile_out is not None)
+        if profile_out:
+            with open(profile_out, 'w', encoding='utf-8') as f:
+                json.dump(vm.profile(), f, indent=1)
+    except MyPLError as ex:
+        print(ex)
+        exit(1)
+
+
+
+def run_cached_mode(source, opt_level, cache_dir):
+    """Executes the given mypl program using the compiled code saved in
+    the cache directory (compiling and saving it if it isn't there).
+
+    Args: 
+        source -- The mypl program source code.
+        opt_level -- The code generator optimization level.
+        cache_dir -- The directory holding compiled programs.
+
+    """
+    try: 
+        key = cache_key(source, opt_level)
+        vm = VM()
+        templates = load_templates(cache_dir, key)
+        if templates is None:
+            lexer = Lexer(BufferedWrapper(io.StringIO(source)))
+            parser = ASTParser(lexer)
+            ast = parser.parse()
+            visitor = SemanticChecker()
+            ast.accept(visitor)
+            codegen = CodeGenerator(vm, opt_level)
+            ast.accept(codegen)
+            save_templates(cache_dir, key, vm.frame_templates)
+        else:
+            vm.frame_templates = templates
         vm.run()
     except MyPLError as ex:
         print(ex)
         exit(1)
 
 
+def run_watch_mode(filename, opt_level=0, interval=0.5):
+    """Executes the given mypl program file, then runs it again each time
+    the file changes (until interrupted). Each run recompiles only the
+    definitions that changed.
+
+    Args: 
+        filename -- The mypl program file.
+        opt_level -- The code generator optimization level.
+        interval -- Seconds between checks for changes.
+
+    """
+    compiler = IncrementalCompiler(opt_level)
+    last_change = None
+    try:
+        while True:
+            try:
+                change = os.stat(filename).st_mtime_ns
+            except OSError:
+                change = None
+            if change is not None and change != last_change:
+                last_change = change
+                try:
+                    with open(filename, 'r', encoding='utf-8') as f:
+                        source = f.read()
+                    compiler.compile(source).run()
+                except MyPLError as ex:
+                    print(ex)
+                except OSError:
+                    print(f"ERROR: Could not open file '{filename}'")
+                sys.stdout.flush()
+                print(f'\n[watching {filename} for changes]', file=sys.stderr, flush=True)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+
+def positive(convert):
+    """Returns an argument type that converts an argument and checks
+    that it is greater than 0."""
+    def convert_positive(text):
+        value = convert(text)
+        if value <= 0:
+            raise argparse.ArgumentTypeError(f'must be greater than 0: {text}')
+        return value
+    # argparse names the type in its error messages
+    convert_positive.__name__ = convert.__name__
+    return convert_positive
+
+
     
-if __name__ == '__main__':
+def main(argv=None):
+    """Runs mypl with the given command line arguments (by default, those
+    of this process)."""
     # initial help/usage info
     about = ('Run the mypl interpreter.\n'
              'If filename missing, reads from standard input.')
@@ -170,17 +281,72 @@ if __name__ == '__main__':
     group.add_argument('--check', action='store_true', help=help_msg)
     help_msg = 'displays intermediate code'
     group.add_argument('--ir', action='store_true', help=help_msg)
+    help_msg = 'optimization level (0 = none)'
+    argparser.add_argument('-O', '--opt-level', type=int, default=0,
+                           metavar='LEVEL', help=help_msg)
+    help_msg = 'save an execution profile to FILE'
+    argparser.add_argument('--profile-out', metavar='FILE', help=help_msg)
+    help_msg = 'use the execution profile in FILE to guide optimizations'
+    argparser.add_argument('--profile-in', metavar='FILE', help=help_msg)
+    help_msg = 'generate code for each function when it is first called'
+    argparser.add_argument('--lazy', action='store_true', help=help_msg)
+    help_msg = ('reuse compiled programs saved in DIR (default $MYPL_CACHE_DIR, '
+                'which is not used with --lazy or -j)')
+    argparser.add_argument('--cache-dir', metavar='DIR', help=help_msg)
+    help_msg = 'run the program again (recompiling what changed) when the file changes'
+    argparser.add_argument('--watch', action='store_true', help=help_msg)
+    help_msg = 'keep the compiler loaded and run programs sent by mypl_client.py'
+    argparser.add_argument('--serve', action='store_true', help=help_msg)
+    help_msg = ('socket for --serve (default $MYPL_SOCKET, or mypl.sock in '
+                '$XDG_RUNTIME_DIR or a private /tmp/mypl-UID directory)')
+    argparser.add_argument('--socket', metavar='PATH', help=help_msg,
+                           default=default_socket())
+    help_msg = 'run every .mypl program in DIR (comparing output to .expected files)'
+    argparser.add_argument('--batch', metavar='DIR', help=help_msg)
+    help_msg = ('number of processes for --batch (default: one per CPU), or to '
+                'check and generate functions with')
+    argparser.add_argument('-j', '--jobs', type=positive(int), metavar='N', help=help_msg)
+    help_msg = f'seconds each --batch program may run (default {TIMEOUT:g})'
+    argparser.add_argument('--timeout', type=positive(float), default=TIMEOUT,
+                           metavar='SECONDS', help=help_msg)
     help_msg = 'mypl program file (optional)'
     argparser.add_argument('filename', nargs='?', help=help_msg)
-    args = argparser.parse_args()
+    args = argparser.parse_args(argv)
+    if args.serve:
+        serve(args.socket, main)
+        return
+    if args.batch:
+        if not os.path.isdir(args.batch):
+            print(f"ERROR: Could not open directory '{args.batch}'")
+            exit(1)
+        exit(1 if run_batch(args.batch, args.opt_level, args.jobs, args.timeout) else 0)
+    if args.watch and not args.filename:
+        argparser.error('--watch requires a filename')
+    # cached programs are run as saved (all functions generated in one process)
+    if args.lazy or (args.jobs and args.jobs > 1):
+        if args.cache_dir:
+            argparser.error('--cache-dir cannot be used with --lazy or -j')
+    elif args.cache_dir is None:
+        args.cache_dir = os.environ.get('MYPL_CACHE_DIR')
     # get the input (file or standard in)
     in_stream = StdInWrapper(sys.stdin)
     if args.filename:
         try: 
-            in_stream = FileWrapper(open(args.filename, 'r', encoding='utf-8'))
+            if os.path.getsize(args.filename) >= MAPPED_SIZE:
+                in_stream = MappedWrapper(open(args.filename, 'rb'))
+            else:
+                in_stream = BufferedWrapper(open(args.filename, 'r', encoding='utf-8'))
         except: 
             print(f"ERROR: Could not open file '{args.filename}'")
             exit(1)
+    profile = None
+    if args.profile_in:
+        try:
+            with open(args.profile_in, 'r', encoding='utf-8') as f:
+                profile = json.load(f)
+        except:
+            print(f"ERROR: Could not read profile '{args.profile_in}'")
+            exit(1)
     # check args and route to appropriate function
     if args.lex:
         run_lex_mode(in_stream)
@@ -191,9 +357,20 @@ if __name__ == '__main__':
     elif args.check:
         run_check_mode(in_stream)
     elif args.ir:
-        run_ir_mode(in_stream)
+        run_ir_mode(in_stream, args.opt_level, profile, args.jobs)
+    elif args.watch:
+        run_watch_mode(args.filename, args.opt_level)
+    elif args.cache_dir and args.filename and not (args.profile_in or args.profile_out):
+        source = in_stream.text
+        run_cached_mode(source, args.opt_level, args.cache_dir)
     else:
-        run_normal_mode(in_stream)
+        run_normal_mode(in_stream, args.opt_level, profile, args.profile_out,
+                        args.lazy, args.jobs)
     # close the (wrapped) input stream
     in_stream.close()
 
+
+
+if __name__ == '__main__':
+    main()
+
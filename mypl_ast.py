@@ -6,7 +6,8 @@ CLASS: CPSC 326
 
 """
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from types import GeneratorType
 from mypl_token import Token
 from typing import List
 
@@ -85,7 +86,7 @@ class Visitor:
 
 # declare dictionary
 # dict(type, type) id;
-@dataclass
+@dataclass(slots=True)
 class DataType:
     is_array: bool
     is_dict: bool
@@ -93,156 +94,294 @@ class DataType:
     element_type_name: Token
     type_name: Token
     def accept(self, visitor):
-        visitor.visit_data_type(self)
+        traverse(self, visitor)
 
 
-@dataclass
+@dataclass(slots=True)
 class VarDef:
     data_type: DataType
     var_name: Token
     def accept(self, visitor):
-        visitor.visit_var_def(self)
+        traverse(self, visitor)
 
-@dataclass
+@dataclass(slots=True)
 class Stmt:
     pass
 
-@dataclass
+@dataclass(slots=True)
 class StructDef:
     struct_name: Token
     fields: List[VarDef]
     def accept(self, visitor):
-        visitor.visit_struct_def(self)
+        traverse(self, visitor)
 
-@dataclass
+@dataclass(slots=True)
 class FunDef:
     return_type: DataType
     fun_name: Token
     params: List[VarDef]
     stmts: List[Stmt]
     def accept(self, visitor):
-        visitor.visit_fun_def(self)
+        traverse(self, visitor)
 
-@dataclass
+@dataclass(slots=True)
 class Program: 
     struct_defs: List[StructDef]
     fun_defs: List[FunDef]
     def accept(self, visitor):
-        visitor.visit_program(self)
+        traverse(self, visitor)
 
 
 # Expression Related Classes
 
-@dataclass
+@dataclass(slots=True)
 class RValue:
     pass                        
 
-@dataclass
+@dataclass(slots=True)
 class ExprTerm:
     pass                        
 
-@dataclass
+@dataclass(slots=True)
 class Expr:
     not_op: bool
     first: ExprTerm
     op: Token
     rest: 'Expr'
     def accept(self, visitor):
-        visitor.visit_expr(self)
+        traverse(self, visitor)
 
-@dataclass
+@dataclass(slots=True)
 class CallExpr(Stmt, RValue):
     fun_name: Token
     args: List[Expr]
     def accept(self, visitor):
-        visitor.visit_call_expr(self)
+        traverse(self, visitor)
         
-@dataclass
+@dataclass(slots=True)
 class SimpleTerm(ExprTerm):
     rvalue: RValue
     def accept(self, visitor):
-        visitor.visit_simple_term(self)
+        traverse(self, visitor)
         
-@dataclass
+@dataclass(slots=True)
 class ComplexTerm(ExprTerm):
     expr: Expr
     def accept(self, visitor):
-        visitor.visit_complex_term(self)
+        traverse(self, visitor)
 
-@dataclass
+@dataclass(slots=True)
 class SimpleRValue(RValue):
     value: Token
     def accept(self, visitor):
-        visitor.visit_simple_rvalue(self)
+        traverse(self, visitor)
 
-@dataclass
+@dataclass(slots=True)
 class NewRValue(RValue):
     type_name: Token
     array_expr: Expr
     struct_params: List[Expr]
     def accept(self, visitor):
-        visitor.visit_new_rvalue(self)
+        traverse(self, visitor)
     
-@dataclass
+@dataclass(slots=True)
 class VarRef:
     var_name: Token
     array_expr: Expr
+    # the declaration the semantic checker resolved the name to (only
+    # for the first reference of a path)
+    var_def: VarDef = field(default=None, compare=False, repr=False)
         
-@dataclass
+@dataclass(slots=True)
 class VarRValue(RValue):
     path: List[VarRef]
     def accept(self, visitor):
-        visitor.visit_var_rvalue(self)
+        traverse(self, visitor)
 
         
 # Statement Related Classes
 
-@dataclass
+@dataclass(slots=True)
 class ReturnStmt(Stmt):
     expr: Expr
     def accept(self, visitor):
-        visitor.visit_return_stmt(self)
+        traverse(self, visitor)
 
-@dataclass
+@dataclass(slots=True)
 class VarDecl(Stmt):
     var_def: VarDef
     expr: Expr
     def accept(self, visitor):
-        visitor.visit_var_decl(self)
+        traverse(self, visitor)
 
-@dataclass
+@dataclass(slots=True)
 class AssignStmt(Stmt):
     lvalue: List[VarRef]
     expr: Expr
     def accept(self, visitor):
-        visitor.visit_assign_stmt(self)
+        traverse(self, visitor)
 
-@dataclass
+@dataclass(slots=True)
 class WhileStmt(Stmt):
     condition: Expr
     stmts: List[Stmt]
     def accept(self, visitor):
-        visitor.visit_while_stmt(self)
+        traverse(self, visitor)
         
-@dataclass
+@dataclass(slots=True)
 class ForStmt(Stmt):
     var_decl: VarDecl
     condition: Expr
     assign_stmt: AssignStmt
     stmts: List[Stmt]
     def accept(self, visitor):
-        visitor.visit_for_stmt(self)
+        traverse(self, visitor)
 
-@dataclass
+@dataclass(slots=True)
 class BasicIf:
     condition: Expr
     stmts: List[Stmt]
 
-@dataclass
+@dataclass(slots=True)
 class IfStmt(Stmt):
     if_part: BasicIf
     else_ifs: List[BasicIf]
     else_stmts: List[Stmt]
     def accept(self, visitor):
-        visitor.visit_if_stmt(self)
+        traverse(self, visitor)
 
+
+#----------------------------------------------------------------------
+# Traversal engine
+#----------------------------------------------------------------------
+
+# node type -> name of the Visitor function that handles it
+HANDLER_NAMES = {
+    Program: 'visit_program',
+    StructDef: 'visit_struct_def',
+    FunDef: 'visit_fun_def',
+    ReturnStmt: 'visit_return_stmt',
+    VarDecl: 'visit_var_decl',
+    AssignStmt: 'visit_assign_stmt',
+    WhileStmt: 'visit_while_stmt',
+    ForStmt: 'visit_for_stmt',
+    IfStmt: 'visit_if_stmt',
+    CallExpr: 'visit_call_expr',
+    Expr: 'visit_expr',
+    DataType: 'visit_data_type',
+    VarDef: 'visit_var_def',
+    SimpleTerm: 'visit_simple_term',
+    ComplexTerm: 'visit_complex_term',
+    SimpleRValue: 'visit_simple_rvalue',
+    NewRValue: 'visit_new_rvalue',
+    VarRValue: 'visit_var_rvalue',
+}
+
+# visitor class -> {node type: visit function} (filled in as needed)
+handler_tables = {}
+
+
+def handler_table(visitor_class):
+    """Returns the node type to visit function table of a visitor class."""
+    table = handler_tables.get(visitor_class)
+    if table is None:
+        table = {node_type: getattr(visitor_class, name)
+                 for node_type, name in HANDLER_NAMES.items()}
+        handler_tables[visitor_class] = table
+    return table
+
+
+# returned by next() when a generator is done
+DONE = object()
+
+
+def traverse(node, visitor):
+    """Visits an AST node.
+
+    A visit function written as a generator yields each child node to
+    visit (instead of calling its accept), and is resumed once the child
+    has been visited. The generators are kept on an explicit work stack,
+    so the depth of the AST is not limited by the Python call stack. A
+    visit function may also yield a generator (e.g., from a helper that
+    visits a list of statements), which is run the same way. Visit
+    functions that aren't generators are just called.
+
+    Args:
+        node -- The AST node to visit.
+        visitor -- The visitor to visit it with.
+
+    """
+    table = handler_table(type(visitor))
+    stack = []
+    error = None
+    work = node
+    while True:
+        # start the work: visit the node or push the generator
+        try:
+            if work is not None and type(work) is not GeneratorType:
+                work = table[type(work)](visitor, work)
+            if type(work) is GeneratorType:
+                stack.append(work)
+        except BaseException as ex:
+            if not stack:
+                raise
+            error = ex
+        # resume the innermost generator until it yields more work
+        while stack:
+            try:
+                if error is None:
+                    work = next(stack[-1], DONE)
+                else:
+                    ex, error = error, None
+                    work = stack[-1].throw(ex)
+            except StopIteration:
+                # the generator caught the error and finished
+                work = DONE
+            except BaseException as ex:
+                stack.pop()
+                if not stack:
+                    raise
+                error = ex
+                continue
+            if work is not DONE:
+                break
+            stack.pop()
+        else:
+            return
+
+
+def evaluate(work):
+    """Runs a generator that computes a value from the values of others,
+    returning its value.
+
+    The generator yields each generator whose value it needs and is sent
+    back that value (the generator's return value), with the generators
+    kept on an explicit work stack as in traverse. This lets recursive
+    computations over deeply nested ASTs (e.g., folding an expression)
+    be written as generators without overflowing the call stack.
+
+    Args:
+        work -- The generator to run.
+
+    """
+    stack = [work]
+    value = error = None
+    while True:
+        try:
+            if error is None:
+                work = stack[-1].send(value)
+            else:
+                ex, error = error, None
+                work = stack[-1].throw(ex)
+            stack.append(work)
+            value = None
+        except StopIteration as done:
+            stack.pop()
+            if not stack:
+                return done.value
+            value = done.value
+        except BaseException as ex:
+            stack.pop()
+            if not stack:
+                raise
+            error = ex
@@ -11,6 +11,29 @@ from mypl_lexer import *
 from mypl_ast import *
 
 
+# how tightly each binary operator binds (all are left associative)
+BINARY_PRECEDENCE = {
+    TokenType.OR: 1,
+    TokenType.AND: 2,
+    TokenType.EQUAL: 4, TokenType.NOT_EQUAL: 4,
+    TokenType.LESS: 4, TokenType.LESS_EQ: 4,
+    TokenType.GREATER: 4, TokenType.GREATER_EQ: 4,
+    TokenType.PLUS: 5, TokenType.MINUS: 5,
+    TokenType.TIMES: 6, TokenType.DIVIDE: 6,
+}
+
+# not applies to a comparison (or arithmetic) expression
+NOT_PRECEDENCE = 3
+
+# operators whose chains are built as balanced trees (the operands are
+# still evaluated left to right). The grouping doesn't change the value
+# of and, or, string +, or int + and * (ints don't overflow). It can
+# change how doubles round, so the semantic checker regroups double +
+# and * chains from the left. A null operand can be reported by a later
+# operation (after more of the operands are evaluated).
+ASSOCIATIVE = {TokenType.AND, TokenType.OR, TokenType.PLUS, TokenType.TIMES}
+
+
 class ASTParser:
 
     def __init__(self, lexer):
@@ -21,6 +44,7 @@ class ASTParser:
 
         """
         self.lexer = lexer
+        self.tokens = TokenStream(lexer.tokens())
         self.curr_token = None
 
         
@@ -56,11 +80,9 @@ class ASTParser:
 
 
     def advance(self):
-        """Moves to the next token of the lexer."""
-        self.curr_token = self.lexer.next_token()
-        # skip comments
-        while self.match(TokenType.COMMENT):
-            self.curr_token = self.lexer.next_token()
+        """Moves to the next token of the lexer (comments are skipped by
+        the lexer)."""
+        self.curr_token = self.tokens.next()
 
             
     def match(self, token_type):
@@ -246,7 +268,7 @@ class ASTParser:
         # check for dictionary
         if var_node.data_type.is_dict:
             self.eat(TokenType.LPAREN, "Expecting ( in dict param)")
-            var_node.data_type.key_type = self.curr_token
+            var_node.data_type.key_type_name = self.curr_token
             self.advance()
             self.eat(TokenType.COMMA, "Expecting , in dict param")
             var_node.data_type.element_type_name = self.curr_token
@@ -448,29 +470,74 @@ class ASTParser:
 
 
     def expr(self, expr_node):
-        """Check for well formed expression"""
-        # not 
+        """Check for well formed expression, filling in the given node.
+
+        Each Expr with an operator is one binary operation: its first
+        term is the left operand (a ComplexTerm if it has operators) and
+        its rest is the right operand.
+
+        """
+        result = self.binary_expr(0)
+        expr_node.not_op = result.not_op
+        expr_node.first = result.first
+        expr_node.op = result.op
+        expr_node.rest = result.rest
+        return expr_node
+
+
+    def binary_expr(self, min_precedence):
+        """Returns the expression up to the next binary operator that binds
+        no tighter than the given precedence (precedence climbing)."""
+        left = self.unary_expr()
+        while self.is_bin_op() and BINARY_PRECEDENCE[self.curr_token.token_type] > min_precedence:
+            ops = [self.curr_token]
+            precedence = BINARY_PRECEDENCE[ops[0].token_type]
+            self.advance()
+            operands = [left, self.binary_expr(precedence)]
+            if ops[0].token_type in ASSOCIATIVE:
+                while self.match(ops[0].token_type):
+                    ops.append(self.curr_token)
+                    self.advance()
+                    operands.append(self.binary_expr(precedence))
+            left = self.balanced(operands, ops, True)
+        return left
+
+
+    def unary_expr(self):
+        """Returns a not expression, parenthesized expression, or rvalue."""
         if self.match(TokenType.NOT):
-            expr_node.not_op = True
             self.advance()
-            self.expr(expr_node)
+            expr_node = self.binary_expr(NOT_PRECEDENCE)
+            if expr_node.not_op:
+                return Expr(True, ComplexTerm(expr_node), None, None)
+            expr_node.not_op = True
+            return expr_node
         elif self.match(TokenType.LPAREN):
             self.advance()
-            tmp_node = Expr(False, None, None, None)
-            complex_node = ComplexTerm(self.expr(tmp_node))
-            expr_node.first = complex_node
+            complex_node = ComplexTerm(self.binary_expr(0))
             self.eat(TokenType.RPAREN, "Expecting ) in expr")
-        # rvalue
-        else:
-            simple_node = SimpleTerm(self.r_value())
-            expr_node.first = simple_node
-        if self.is_bin_op():
-            expr_node.op = self.curr_token
-            self.advance()
-            rest_node = Expr(False, None, None, None)
-            expr_node.rest = self.expr(rest_node)
-        return expr_node 
-        
+            return Expr(False, complex_node, None, None)
+        return Expr(False, SimpleTerm(self.r_value()), None, None)
+
+
+    def balanced(self, operands, ops, leftmost):
+        """Returns a balanced tree of binary expressions for a chain of
+        operands and the operators between them (leftmost if the tree
+        starts the chain)."""
+        if len(operands) == 1:
+            return operands[0]
+        mid = len(operands) // 2
+        left = self.balanced(operands[:mid], ops[:mid-1], leftmost)
+        right = self.balanced(operands[mid:], ops[mid:], False)
+        # a left operand with operators is grouped as a term (as is a
+        # parenthesized one within the chain, to tell it from a part of
+        # the chain)
+        op = ops[mid-1]
+        if left.op or left.not_op or (not leftmost and type(left.first) == ComplexTerm):
+            return Expr(False, ComplexTerm(left), op, right)
+        return Expr(False, left.first, op, right)
+
+
     def r_value(self):
         """Check for well formed r value"""
         # null or base r vals
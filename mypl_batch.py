@@ -0,0 +1,166 @@
+"""Runs a directory of MyPL programs across a pool of processes.
+
+NAME: George Calvert
+DATE: Spring 2024
+CLASS: CPSC 326
+
+For each prog.mypl in the directory, prog.input (if there is one) is
+used as its standard input and prog.expected (if there is one) is
+compared against its standard output.
+
+"""
+
+import contextlib
+import difflib
+import io
+import os
+import signal
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+
+from mypl_daemon import exit_status
+
+
+# seconds a program may run before it is stopped
+TIMEOUT = 60.0
+
+
+class ProgramTimeout(Exception):
+    """Raised in a program that has run for too long."""
+
+
+def stop_program(signum, frame):
+    """Stops the running program (on its timer's signal)."""
+    raise ProgramTimeout()
+
+
+@dataclass
+class BatchResult:
+    """The outcome of running one program."""
+    name: str
+    stdout: str
+    stderr: str
+    status: int
+    seconds: float
+    expected: Optional[str] = None
+    timed_out: bool = False
+
+    def passed(self):
+        """Returns True if the output matched the expected output, or if
+        there was no expected output and the program exited normally."""
+        if self.timed_out:
+            return False
+        if self.expected is None:
+            return self.status == 0
+        return self.stdout == self.expected
+
+
+def read_text(path):
+    """Returns the contents of a file, or None if it doesn't exist."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def run_program(path, opt_level=0, timeout=TIMEOUT):
+    """Runs a program (in this process) with its output captured.
+
+    Args:
+        path -- The mypl program file.
+        opt_level -- The code generator optimization level.
+        timeout -- Seconds the program may run before it is stopped.
+
+    """
+    # imported here since mypl imports this module
+    from mypl import main
+    base = os.path.splitext(path)[0]
+    stdin_data = read_text(base + '.input') or ''
+    stdout, stderr = io.StringIO(), io.StringIO()
+    status = 0
+    timed_out = False
+    saved_stdin = sys.stdin
+    # mypl reads standard input through its binary buffer
+    sys.stdin = io.TextIOWrapper(io.BufferedReader(io.BytesIO(stdin_data.encode('utf-8'))),
+                                 encoding='utf-8')
+    start = time.perf_counter()
+    saved_handler = signal.signal(signal.SIGALRM, stop_program)
+    # the timer repeats in case the VM's own error handling swallows it
+    signal.setitimer(signal.ITIMER_REAL, timeout, 0.1)
+    try:
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            try:
+                main(['-O', str(opt_level), path])
+            except ProgramTimeout:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                print(f'timed out after {timeout:g}s', file=sys.stderr)
+                status = 1
+                timed_out = True
+            except SystemExit as ex:
+                status = exit_status(ex.code)
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, saved_handler)
+        sys.stdin = saved_stdin
+    seconds = time.perf_counter() - start
+    return BatchResult(os.path.basename(path), stdout.getvalue(), stderr.getvalue(),
+                       status, seconds, read_text(base + '.expected'), timed_out)
+
+
+def report(result):
+    """Prints a line for a result, followed by the differences from the
+    expected output (or the error output) if it didn't pass."""
+    if result.passed():
+        outcome = 'PASS' if result.expected is not None else 'OK'
+    elif result.timed_out:
+        outcome = 'TIMEOUT'
+    else:
+        outcome = 'FAIL' if result.expected is not None else 'ERROR'
+    print(f'{outcome:<7} {result.status:>3} {result.seconds:8.3f}s  {result.name}')
+    if result.passed():
+        return
+    if result.timed_out:
+        lines = result.stderr.splitlines(True)[-1:]
+    elif result.expected is not None:
+        diff = difflib.unified_diff(result.expected.splitlines(True), result.stdout.splitlines(True),
+                                    'expected', 'actual')
+        lines = list(diff)
+    else:
+        lines = (result.stdout + result.stderr).splitlines(True)
+    for line in lines:
+        print('    ' + line, end='' if line.endswith('\n') else '\n')
+
+
+def run_batch(folder, opt_level=0, jobs=None, timeout=TIMEOUT):
+    """Runs every program in a directory, printing a line per program
+    (in name order) and a summary. Returns the number of programs that
+    didn't pass.
+
+    Args:
+        folder -- The directory of mypl programs.
+        opt_level -- The code generator optimization level.
+        jobs -- The number of worker processes (default: one per CPU).
+        timeout -- Seconds each program may run before it is stopped.
+
+    """
+    names = sorted(n for n in os.listdir(folder) if n.endswith('.mypl'))
+    paths = [os.path.join(folder, name) for name in names]
+    start = time.perf_counter()
+    failures = 0
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for result in pool.map(run_program, paths, [opt_level] * len(paths),
+                               [timeout] * len(paths)):
+            report(result)
+            failures += not result.passed()
+    seconds = time.perf_counter() - start
+    print(f'{len(paths)} programs, {len(paths) - failures} passed, {failures} failed '
+          f'({seconds:.3f}s)')
+    return failures
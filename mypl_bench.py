@@ -0,0 +1,263 @@
+"""Benchmarks for the MyPL front end and visitors on large generated
+programs.
+
+NAME: George Calvert
+DATE: Spring 2024
+CLASS: CPSC 326
+
+Run with: python3 mypl_bench.py [--functions N] [--repeat R] [--depth D] [--terms T]
+
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import time
+import tracemalloc
+from dataclasses import fields, is_dataclass
+
+from mypl_token import Token
+from mypl_iowrapper import FileWrapper, BufferedWrapper, MappedWrapper
+from mypl_lexer import Lexer
+from mypl_ast_parser import ASTParser
+from mypl_semantic_checker import SemanticChecker
+from mypl_code_gen import CodeGenerator
+from mypl_printer import PrintVisitor
+from mypl_vm import VM
+
+
+# one generated function (formatted with its number)
+FUNCTION_TEMPLATE = '''
+// function number {n}
+struct Node{n} {{
+  int value;
+  string label;
+  Node{n} next;
+}}
+
+int walk{n}(Node{n} head, array double weights) {{
+  dict(string, int) seen = new dict();
+  int total = 0;
+  Node{n} curr = head;
+  while ((curr != null) and (total < ({n} + 1000))) {{
+    if (curr.label == "skip {n}") {{
+      curr = curr.next;
+    }}
+    elseif (not (curr.value >= 0)) {{
+      total = total - curr.value;
+    }}
+    else {{
+      total = total + ((curr.value * 2) / 3);
+      seen["n{n}"] = total;
+    }}
+    for (int i = 0; i < length(weights); i = i + 1) {{
+      weights[i] = (weights[i] * 1.5) + 0.25;
+    }}
+    curr = curr.next;
+  }}
+  return total;
+}}
+'''
+
+
+def generate_program(functions):
+    """Returns the source of a large valid MyPL program.
+
+    Args:
+        functions -- The number of generated struct/function pairs.
+
+    """
+    parts = [FUNCTION_TEMPLATE.format(n=n) for n in range(functions)]
+    parts.append('\nvoid main() {\n  print("done");\n}\n')
+    return ''.join(parts)
+
+
+def generate_deep_program(depth, terms):
+    """Returns the source of a valid MyPL program with deeply nested
+    statements and long expressions (deeper than the Python call stack
+    allows a recursive visitor to go).
+
+    Args:
+        depth -- The number of nested if and for statements.
+        terms -- The number of terms in the innermost expression.
+
+    """
+    chain = 'x' + ''.join(f' + {k % 7}' if k % 2 else f' - (x * {k % 5})' for k in range(terms))
+    lines = ['void main() {', '  int x = 1;']
+    for k in range(depth):
+        if k % 2:
+            lines.append(f'for (int i{k} = 0; i{k} < 1; i{k} = i{k} + 1) {{')
+        else:
+            lines.append(f'if (x + {k} > 0) {{')
+        lines.append(f'int v{k} = (x * {k}) + 1;')
+    lines.append(f'int y = {chain};')
+    lines.append('x = x + (y - y);')
+    lines.append('}' * depth)
+    lines.append('  print(itos(x));')
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
+
+
+def time_lexer(path, wrapper, repeat=3):
+    """Returns the number of tokens in a source file and the best time
+    (in seconds) to lex it reading through the given input wrapper
+    class."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        in_stream = open_source(path, wrapper)
+        lexer = Lexer(in_stream)
+        count = 0
+        for _ in lexer.tokens(comments=True):
+            count += 1
+        in_stream.close()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return count, best
+
+
+def open_source(path, wrapper):
+    """Returns a source file opened through an input wrapper class."""
+    if wrapper is MappedWrapper:
+        return MappedWrapper(open(path, 'rb'))
+    return wrapper(open(path, 'r', encoding='utf-8'))
+
+
+def peak_memory(path, wrapper):
+    """Returns the peak memory (in bytes) allocated while lexing a
+    source file, not counting the tokens."""
+    tracemalloc.start()
+    in_stream = open_source(path, wrapper)
+    for _ in Lexer(in_stream).tokens(comments=True):
+        pass
+    in_stream.close()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def token_memory(path):
+    """Returns the number of tokens in a source file and the memory (in
+    bytes) they take up."""
+    in_stream = MappedWrapper(open(path, 'rb'))
+    tracemalloc.start()
+    tokens = list(Lexer(in_stream).tokens(comments=True))
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    in_stream.close()
+    return len(tokens), size
+
+
+def parse(path):
+    """Returns the Program AST of a source file."""
+    in_stream = MappedWrapper(open(path, 'rb'))
+    program = ASTParser(Lexer(in_stream)).parse()
+    in_stream.close()
+    return program
+
+
+def node_count(node):
+    """Returns the number of AST nodes (not counting tokens) in an AST."""
+    count = 0
+    stack = [node]
+    while stack:
+        curr = stack.pop()
+        if isinstance(curr, list):
+            stack.extend(curr)
+        elif is_dataclass(curr) and not isinstance(curr, Token):
+            count += 1
+            stack.extend(getattr(curr, f.name) for f in fields(curr))
+    return count
+
+
+def time_parser(path, repeat=3):
+    """Returns the number of AST nodes in a source file and the best time
+    (in seconds) to parse it."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        program = parse(path)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return node_count(program), best
+
+
+def ast_memory(path):
+    """Returns the memory (in bytes) taken up by a source file's AST
+    (including the tokens it holds)."""
+    tracemalloc.start()
+    program = parse(path)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size
+
+
+def time_visitor(program, new_visitor, repeat=3):
+    """Returns the best time (in seconds) to visit an AST with a new
+    visitor from new_visitor() each run (printed output is discarded)."""
+    best = None
+    for _ in range(repeat):
+        visitor = new_visitor()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            program.accept(visitor)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def report(name, size, count, seconds):
+    """Prints one line of benchmark results."""
+    print(f'{name:<28} {seconds:8.3f}s {size / seconds / 1e6:8.2f} MB/s '
+          f'{count / seconds / 1e3:9.1f} Ktokens/s')
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='MyPL front end benchmarks')
+    argparser.add_argument('--functions', type=int, default=200,
+                           help='number of generated functions')
+    argparser.add_argument('--repeat', type=int, default=3,
+                           help='runs per measurement (the best is reported)')
+    argparser.add_argument('--depth', type=int, default=200,
+                           help='nested statements in the deep program')
+    argparser.add_argument('--terms', type=int, default=5000,
+                           help='terms in the deep program\'s longest expression')
+    args = argparser.parse_args()
+    source = generate_program(args.functions)
+    size = len(source.encode('utf-8'))
+    print(f'{args.functions} functions, {size} bytes, {source.count(chr(10))} lines')
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'bench.mypl')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(source)
+        wrappers = [('FileWrapper', FileWrapper), ('BufferedWrapper', BufferedWrapper),
+                    ('MappedWrapper', MappedWrapper)]
+        for name, wrapper in wrappers:
+            count, seconds = time_lexer(path, wrapper, args.repeat)
+            report(f'lex ({name})', size, count, seconds)
+        for name, wrapper in wrappers[1:]:
+            print(f'{"peak memory (" + name + ")":<28} {peak_memory(path, wrapper) / 1e6:8.2f} MB')
+        count, size = token_memory(path)
+        print(f'{"token memory":<28} {size / 1e6:8.2f} MB {size / count:8.1f} bytes/token')
+        nodes, seconds = time_parser(path, args.repeat)
+        print(f'{"parse":<28} {seconds:8.3f}s {nodes / seconds / 1e3:8.1f} Knodes/s')
+        size = ast_memory(path)
+        print(f'{"AST memory (with tokens)":<28} {size / 1e6:8.2f} MB {size / nodes:8.1f} bytes/node')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(generate_deep_program(args.depth, args.terms))
+        program = parse(path)
+        nodes = node_count(program)
+        print(f'deep program: depth {args.depth}, {args.terms} terms, {nodes} nodes')
+        visitors = [('check', SemanticChecker)]
+        for level in range(3):
+            visitors.append((f'codegen (-O {level})', lambda level=level: CodeGenerator(VM(), level)))
+        visitors.append(('print', PrintVisitor))
+        for name, new_visitor in visitors:
+            seconds = time_visitor(program, new_visitor, args.repeat)
+            print(f'{name:<28} {seconds:8.3f}s {nodes / seconds / 1e3:8.1f} Knodes/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""The MyPL built-in functions: one registry shared by the semantic
+checker, the code generator, the optimizer, and the VM.
+
+NAME: George Calvert
+DATE: Spring 2024
+CLASS: CPSC 326
+
+Types in signatures are written as text: a base type name ('int',
+'double', 'bool', 'string', or 'void' for null), 'array ' followed by a
+base type name, 'dict' for any dictionary, or 'any'. The return type
+'array key' is an array of the first argument's dictionary key type.
+
+"""
+
+from dataclasses import dataclass
+from typing import Callable
+from mypl_opcode import OpCode
+
+
+# the types of the values native functions can take and return
+NATIVE_TYPES = ('int', 'double', 'bool', 'string')
+
+
+@dataclass
+class BuiltIn:
+    """A built-in function, implemented either by a VM instruction or by
+    a native Python function."""
+    name: str
+    params: tuple           # the accepted types of each argument
+    return_type: str
+    opcode: OpCode = None   # the instruction that implements it
+    native: Callable = None # or the Python function that implements it
+    pure: bool = True       # no side effects (no input or output)
+
+
+# function name -> BuiltIn
+BUILT_INS = {}
+
+
+def add_built_in(built_in):
+    """Adds a built-in function to the registry."""
+    BUILT_INS[built_in.name] = built_in
+
+
+for built_in in [
+        BuiltIn('print', (('string', 'bool', 'double', 'int', 'void'),), 'void',
+                OpCode.WRITE, pure=False),
+        BuiltIn('input', (), 'string', OpCode.READ, pure=False),
+        BuiltIn('itos', (('int',),), 'string', OpCode.TOSTR),
+        BuiltIn('itod', (('int',),), 'double', OpCode.TODBL),
+        BuiltIn('dtos', (('double',),), 'string', OpCode.TOSTR),
+        BuiltIn('dtoi', (('double',),), 'int', OpCode.TOINT),
+        BuiltIn('stoi', (('string',),), 'int', OpCode.TOINT),
+        BuiltIn('stod', (('string',),), 'double', OpCode.TODBL),
+        BuiltIn('length', (('string', 'array string', 'array int', 'array double',
+                            'array bool'),), 'int', OpCode.LEN),
+        BuiltIn('get', (('int',), ('string',)), 'string', OpCode.GETC),
+        BuiltIn('keys', (('dict',),), 'array key', OpCode.KEYS),
+        BuiltIn('in', (('dict',), ('any',)), 'bool', OpCode.IN)]:
+    add_built_in(built_in)
+
+
+def native_type(type_text, allow_void=False):
+    """True if a type can be passed to or returned from a native function:
+    a base type or an array of one (or void, if allowed)."""
+    if type_text.startswith('array '):
+        type_text = type_text[len('array '):]
+    elif allow_void and type_text == 'void':
+        return True
+    return type_text in NATIVE_TYPES
+
+
+def register_native(name, params, return_type, fn, pure=False):
+    """Makes a Python function callable from MyPL programs (checked,
+    compiled, and run like the other built-in functions).
+
+    Arrays are passed to the function as the VM's Python lists (which it
+    may change), and a returned list becomes a new array.
+
+    Args:
+        name -- The MyPL function name.
+        params -- The type of each parameter (e.g., ['int', 'array double']).
+        return_type -- The type returned, or 'void' if nothing is.
+        fn -- The Python function, called with one value per parameter.
+        pure -- True if the function has no side effects and always
+                returns the same value for the same arguments (so calls
+                can be evaluated at compile time).
+
+    """
+    if not name.isidentifier():
+        raise ValueError(f'invalid function name {name!r}')
+    if name in BUILT_INS and BUILT_INS[name].native is None:
+        raise ValueError(f'cannot replace built-in function {name}')
+    for type_text in params:
+        if not native_type(type_text):
+            raise ValueError(f'unsupported parameter type {type_text!r} for {name}')
+    if not native_type(return_type, allow_void=True):
+        raise ValueError(f'unsupported return type {return_type!r} for {name}')
+    add_built_in(BuiltIn(name, tuple((p,) for p in params), return_type,
+                         native=fn, pure=pure))
+
+
+def unregister_native(name):
+    """Removes a function added by register_native."""
+    if name not in BUILT_INS or BUILT_INS[name].native is None:
+        raise ValueError(f'{name} is not a native function')
+    del BUILT_INS[name]
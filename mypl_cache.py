@@ -0,0 +1,236 @@
+"""Persistent cache of compiled MyPL programs (VM frame templates).
+
+NAME: George Calvert
+DATE: Spring 2024
+CLASS: CPSC 326
+
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+
+from mypl_opcode import *
+from mypl_frame import *
+from mypl_builtins import BUILT_INS
+
+
+# bump when the binary layout changes
+FORMAT_VERSION = 1
+
+# start of every cache file
+MAGIC = b'MYPLBC'
+
+# modules whose code affects the generated instructions
+COMPILER_MODULES = ['mypl_token.py', 'mypl_lexer.py', 'mypl_ast.py',
+                    'mypl_ast_parser.py', 'mypl_symbol_table.py',
+                    'mypl_semantic_checker.py', 'mypl_var_table.py',
+                    'mypl_optimizer.py', 'mypl_code_gen.py', 'mypl_opcode.py',
+                    'mypl_frame.py', 'mypl_builtins.py', 'mypl_cache.py']
+
+# operand type tags
+TAG_NONE, TAG_FALSE, TAG_TRUE, TAG_INT, TAG_BIG_INT, TAG_FLOAT, TAG_STR = range(7)
+
+
+def compiler_version():
+    """Returns a hash of the compiler's source code."""
+    digest = hashlib.sha256()
+    folder = os.path.dirname(os.path.abspath(__file__))
+    for module in COMPILER_MODULES:
+        with open(os.path.join(folder, module), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def cache_key(source, opt_level=0):
+    """Returns the cache key for a program compiled at an optimization
+    level by this version of the compiler (with the native functions
+    registered now, which decide what compiles and what is evaluated at
+    compile time).
+
+    Args:
+        source -- The program's source code.
+        opt_level -- The code generator optimization level.
+
+    """
+    digest = hashlib.sha256()
+    digest.update(f'{FORMAT_VERSION}:{compiler_version()}:{opt_level}:'.encode('utf-8'))
+    for b in BUILT_INS.values():
+        if b.native is not None:
+            digest.update(f'{b.name}{b.params}{b.return_type}{b.pure}:'.encode('utf-8'))
+    digest.update(source.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def cache_path(cache_dir, key):
+    """Returns the file name of a cache entry."""
+    return os.path.join(cache_dir, key + '.myplc')
+
+
+#----------------------------------------------------------------------
+# Encoding
+#----------------------------------------------------------------------
+
+def encode_str(s):
+    data = s.encode('utf-8')
+    return struct.pack('<I', len(data)) + data
+
+
+def encode_operand(val):
+    """Returns the tagged binary form of an instruction operand."""
+    if val is None:
+        return struct.pack('<B', TAG_NONE)
+    elif type(val) == bool:
+        return struct.pack('<B', TAG_TRUE if val else TAG_FALSE)
+    elif type(val) == int:
+        if -2**63 <= val < 2**63:
+            return struct.pack('<Bq', TAG_INT, val)
+        return struct.pack('<B', TAG_BIG_INT) + encode_str(str(val))
+    elif type(val) == float:
+        return struct.pack('<Bd', TAG_FLOAT, val)
+    return struct.pack('<B', TAG_STR) + encode_str(str(val))
+
+
+def encode_template(template):
+    """Returns the binary form of a frame template."""
+    parts = [struct.pack('<II', template.arg_count, len(template.instructions))]
+    for instr in template.instructions:
+        parts.append(struct.pack('<B', instr.opcode.value))
+        parts.append(encode_operand(instr.operand))
+        parts.append(encode_str(instr.comment))
+    return b''.join(parts)
+
+
+def encode_templates(templates):
+    """Returns the binary form of a dictionary of frame templates.
+
+    The file is a header (magic, format version, template count), then
+    an index giving each template's name and the offset and size of its
+    body, then the bodies. The index lets a template be decoded only when
+    it is first needed.
+
+    """
+    bodies = [(name, encode_template(t)) for name, t in templates.items()]
+    index = b''
+    offset = 0
+    for name, body in bodies:
+        index += encode_str(name) + struct.pack('<QQ', offset, len(body))
+        offset += len(body)
+    header = MAGIC + struct.pack('<HI', FORMAT_VERSION, len(bodies))
+    return header + index + b''.join(body for _, body in bodies)
+
+
+#----------------------------------------------------------------------
+# Decoding
+#----------------------------------------------------------------------
+
+def decode_str(buffer, pos):
+    (size,) = struct.unpack_from('<I', buffer, pos)
+    pos += 4
+    return str(buffer[pos:pos+size], 'utf-8'), pos + size
+
+
+def decode_operand(buffer, pos):
+    """Returns the operand at pos and the position after it."""
+    tag = buffer[pos]
+    pos += 1
+    if tag == TAG_NONE:
+        return None, pos
+    elif tag == TAG_FALSE or tag == TAG_TRUE:
+        return tag == TAG_TRUE, pos
+    elif tag == TAG_INT:
+        return struct.unpack_from('<q', buffer, pos)[0], pos + 8
+    elif tag == TAG_BIG_INT:
+        val, pos = decode_str(buffer, pos)
+        return int(val), pos
+    elif tag == TAG_FLOAT:
+        return struct.unpack_from('<d', buffer, pos)[0], pos + 8
+    elif tag == TAG_STR:
+        return decode_str(buffer, pos)
+    raise ValueError(f'bad operand tag {tag}')
+
+
+def decode_template(name, buffer, pos):
+    """Returns the frame template whose body starts at pos."""
+    arg_count, count = struct.unpack_from('<II', buffer, pos)
+    pos += 8
+    template = VMFrameTemplate(name, arg_count, [])
+    for _ in range(count):
+        opcode = OpCode(buffer[pos])
+        operand, pos = decode_operand(buffer, pos + 1)
+        comment, pos = decode_str(buffer, pos)
+        template.instructions.append(VMInstr(opcode, operand, comment))
+    return template
+
+
+class CachedTemplates(OnDemandTemplates):
+    """Frame templates backed by an encoded buffer. Each template is
+    decoded the first time it is looked up."""
+
+    def __init__(self, buffer):
+        """Reads the header and index of an encoded buffer.
+
+        Args:
+            buffer -- Bytes (or an mmap) holding encoded frame templates.
+
+        """
+        super().__init__()
+        if buffer[:len(MAGIC)] != MAGIC:
+            raise ValueError('not a MyPL cache file')
+        pos = len(MAGIC)
+        version, count = struct.unpack_from('<HI', buffer, pos)
+        if version != FORMAT_VERSION:
+            raise ValueError(f'unsupported cache format {version}')
+        pos += 6
+        self.buffer = buffer
+        self.index = {}        # function name -> (body offset, body size)
+        for _ in range(count):
+            name, pos = decode_str(buffer, pos)
+            offset, size = struct.unpack_from('<QQ', buffer, pos)
+            pos += 16
+            self.index[name] = (offset, size)
+        self.names = self.index
+        self.body_start = pos
+        if any(self.body_start + offset + size > len(buffer) for offset, size in self.index.values()):
+            raise ValueError('truncated cache file')
+
+    def create(self, name):
+        return decode_template(name, self.buffer, self.body_start + self.index[name][0])
+
+
+def decode_templates(buffer):
+    """Returns a dictionary of all the frame templates in a buffer."""
+    return dict(CachedTemplates(buffer).items())
+
+
+#----------------------------------------------------------------------
+# Cache files
+#----------------------------------------------------------------------
+
+def load_templates(cache_dir, key):
+    """Returns the cached frame templates for a key (memory mapped and
+    decoded on demand), or None if there is no usable cache entry.
+
+    """
+    try:
+        with open(cache_path(cache_dir, key), 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return CachedTemplates(buffer)
+    except (OSError, ValueError, struct.error):
+        return None
+
+
+def save_templates(cache_dir, key, templates):
+    """Writes frame templates to the cache (ignoring write errors, since
+    the cache is only an optimization)."""
+    path = cache_path(cache_dir, key)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(encode_templates(templates))
+        # other processes only ever see a complete file
+        os.replace(temp_path, path)
+    except OSError:
+        pass
@@ -0,0 +1,22 @@
+"""Thin client for the mypl server (mypl.py --serve). Takes the same
+arguments as mypl.py and runs mypl.py directly if no server is running.
+
+NAME: George Calvert
+DATE: Spring 2024
+CLASS: CPSC 326
+
+"""
+
+import os
+import sys
+
+from mypl_daemon import run_remote
+
+
+if __name__ == '__main__':
+    status = run_remote(sys.argv[1:])
+    if status is None:
+        # no server, so run the program in this process
+        mypl = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mypl.py')
+        os.execv(sys.executable, [sys.executable, mypl] + sys.argv[1:])
+    sys.exit(status)
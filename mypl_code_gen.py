@@ -6,21 +6,53 @@ CLASS: CPSC 326
 
 """
 
+import sys
+
 from mypl_token import *
 from mypl_ast import *
 from mypl_var_table import *
 from mypl_frame import *
 from mypl_opcode import *
+from mypl_builtins import BUILT_INS
 from mypl_vm import *
+from mypl_optimizer import *
+
+
+class LazyTemplates(OnDemandTemplates):
+    """Frame templates that are generated the first time each function
+    is looked up (i.e., called)."""
+
+    def __init__(self, codegen, fun_defs):
+        """Creates the (initially empty) templates.
+
+        Args:
+            codegen -- The code generator to generate functions with.
+            fun_defs -- The program's function definitions.
+
+        """
+        super().__init__()
+        self.codegen = codegen
+        self.fun_defs = {fun_def.fun_name.lexeme: fun_def for fun_def in fun_defs}
+        self.names = self.fun_defs
+
+    def create(self, name):
+        # visiting the function adds its template (functions don't share
+        # variable names, so the order they are generated in doesn't matter)
+        self.fun_defs[name].accept(self.codegen)
+        return dict.__getitem__(self, name)
 
 
 class CodeGenerator (Visitor):
 
-    def __init__(self, vm):
+    def __init__(self, vm, opt_level=0, profile=None, lazy=False):
         """Creates a new Code Generator given a VM. 
         
         Args:
             vm -- The target vm.
+            opt_level -- The optimization level (0 disables optimizations).
+            profile -- Profile data (from VM.profile) to guide code layout
+                       and inlining.
+            lazy -- If True, functions are generated when first called.
         """
         # the vm to add frames to
         self.vm = vm
@@ -28,22 +60,189 @@ class CodeGenerator (Visitor):
         self.curr_template = None
         # for var -> index mappings wrt to environments
         self.var_table = VarTable()
+        # (id(VarDef), var name) -> (VarDef, index) for the variables
+        # declared so far in the current function
+        self.slots = {}
         # struct name -> StructDef for struct field info
         self.struct_defs = {}
         # dict_defs = list of dictionary definitions
         self.dict_defs = []
+        # optimization level
+        self.opt_level = opt_level
+        # var name -> StructDef for structs replaced by their fields
+        self.scalar_structs = {}
+        # max AST nodes in a fully unrolled loop body
+        self.unroll_budget = UNROLL_BUDGET
+        # id(node) -> key for common subexpressions of the current block
+        self.cse_shared = {}
+        # key -> hidden variable index holding an already computed value
+        self.cse_avail = {}
+        # id(Expr) -> (Expr, value) for the expressions already constant folded
+        self.const_memo = {}
+        # profile data and the call sites it shows are hot
+        self.profile = profile or {}
+        self.hot_calls = hot_call_sites(self.profile)
+        # function name -> FunDef for inlining
+        self.fun_defs = {}
+        # (start, end) instruction ranges to move to the end of the function
+        self.cold_segments = []
+        # jumps to patch to the end of the function being inlined
+        self.inline_exits = None
+        # functions that can be evaluated at compile time
+        self.pure_funs = set()
+        # (function name, args) -> result of a call evaluated at compile time
+        self.folded = {}
+        # frame templates used to evaluate calls at compile time
+        self.sandbox = None
+        self.program = None
+        # (array name, index variable name) pairs known to be in bounds
+        self.safe_indexes = set()
+        # generate each function on its first call
+        self.lazy = lazy
 
     
     def add_instr(self, instr):
         """Helper function to add an instruction to the current template."""
         self.curr_template.instructions.append(instr)
 
+
+    def gen_stmts(self, stmts):
+        """Generates code for a statement list, sharing common
+        subexpressions within each run of simple statements."""
+        if self.opt_level == 0:
+            # no common subexpressions to track
+            for stmt in stmts:
+                yield stmt
+            return
+        saved = (self.cse_shared, self.cse_avail)
+        self.cse_shared = {}
+        self.cse_avail = {}
+        # id(stmt) -> stmt_effects(stmt) found while planning
+        effects = {}
+        for i in range(len(stmts)):
+            stmt = stmts[i]
+            if not isinstance(stmt, SIMPLE_STMTS):
+                # control flow ends the basic block
+                self.cse_avail = {}
+                yield stmt
+                self.cse_avail = {}
+                continue
+            # plan the run of simple statements starting here
+            if i == 0 or not isinstance(stmts[i-1], SIMPLE_STMTS):
+                j = i
+                while j < len(stmts) and isinstance(stmts[j], SIMPLE_STMTS):
+                    j += 1
+                self.cse_shared = plan_cse(stmts[i:j], effects)
+            names, heap, calls = effects[id(stmt)]
+            if calls:
+                self.cse_kill(set(), True)
+            yield stmt
+            self.cse_kill(names, heap)
+        self.cse_shared, self.cse_avail = saved
+
+
+    def gen_condition(self, expr):
+        """Generates code for a loop or if condition, sharing common
+        subexpressions within the condition."""
+        saved = (self.cse_shared, self.cse_avail)
+        self.cse_shared = plan_cse([expr]) if self.opt_level >= 1 else {}
+        self.cse_avail = {}
+        # hidden variables only live while the condition is evaluated
+        self.var_table.push_environment()
+        yield expr
+        self.var_table.pop_environment()
+        self.cse_shared, self.cse_avail = saved
+
+
+    def scalar_path(self, path):
+        """Rewrites a path starting at a scalar-replaced struct variable so
+        it starts at the hidden variable holding the accessed field."""
+        if path[0].var_name.lexeme not in self.scalar_structs:
+            return path
+        name = path[0].var_name
+        field = path[1].var_name
+        token = Token(TokenType.ID, sys.intern(f'{name.lexeme}.{field.lexeme}'), field.line, field.column)
+        return [VarRef(token, path[1].array_expr, path[0].var_def)] + path[2:]
+
+
+    def add_slot(self, var_def, name, index):
+        """Records the index of a declared variable (name is the declared
+        name, or the hidden variable name of a scalar-replaced field)."""
+        self.slots[(id(var_def), name)] = (var_def, index)
+
+
+    def var_index(self, var_ref):
+        """Returns the index of the (root) variable of a reference: the
+        index given to the declaration the semantic checker resolved it
+        to, or (for unchecked ASTs) the innermost variable with its name."""
+        slot = self.slots.get((id(var_ref.var_def), var_ref.var_name.lexeme))
+        if slot is not None and slot[0] is var_ref.var_def:
+            return slot[1]
+        return self.var_table.get(var_ref.var_name.lexeme)
+
+
+    def in_bounds(self, var_ref):
+        """True if the (root) array element reference needs no index
+        checks."""
+        index_name = simple_var_name(var_ref.array_expr)
+        return (var_ref.var_name.lexeme, index_name) in self.safe_indexes
+
+
+    def cse_kill(self, names, heap):
+        """Forgets computed values invalidated by writes to the given
+        variables or (if heap is True) to any heap object."""
+        for key in killed_keys(list(self.cse_avail), names, heap):
+            del self.cse_avail[key]
+
+
+    def cse_load(self, node):
+        """Emits a load of the node's value if it was already computed by
+        a common subexpression. Returns True if the load was emitted."""
+        key = self.cse_shared.get(id(node))
+        if key is None or key not in self.cse_avail:
+            return False
+        self.add_instr(LOAD(self.cse_avail[key]))
+        return True
+
+
+    def cse_save(self, node):
+        """Keeps a copy of the value just computed for the node in a hidden
+        variable if the value is needed again later in the block."""
+        key = self.cse_shared.get(id(node))
+        if key is None or key in self.cse_avail:
+            return
+        index = self.var_table.total_vars
+        # '$' can't appear in a MyPL identifier so the name can't clash
+        self.var_table.add(f'$cse{index}')
+        self.add_instr(DUP())
+        self.add_instr(STORE(index))
+        self.cse_avail[key] = index
+
         
     def visit_program(self, program):
+        self.begin_program(program)
+        if self.lazy:
+            self.vm.frame_templates = LazyTemplates(self, program.fun_defs)
+            return
+        for fun_def in program.fun_defs:
+            yield fun_def
+
+
+    def begin_program(self, program):
+        """Records the program's functions and structs, after which each
+        function can be generated by visiting it.
+
+        Args:
+            program -- The Program AST node.
+
+        """
+        self.program = program
+        for fun_def in program.fun_defs:
+            self.fun_defs[fun_def.fun_name.lexeme] = fun_def
+        if self.opt_level >= 2:
+            self.pure_funs = pure_functions(program.fun_defs)
         for struct_def in program.struct_defs:
             struct_def.accept(self)
-        for fun_def in program.fun_defs:
-            fun_def.accept(self)
 
     
     def visit_struct_def(self, struct_def):
@@ -54,23 +253,41 @@ class CodeGenerator (Visitor):
             if val.data_type.is_dict:
                 self.dict_defs.append(val.var_name.lexeme)
 
+
+    def struct_dicts(self):
+        """Returns the names of the struct fields that are dictionaries."""
+        return [field.var_name.lexeme for struct_def in self.struct_defs.values()
+                for field in struct_def.fields if field.data_type.is_dict]
+
         
     def visit_fun_def(self, fun_def):
         # create a new frame
         func_template = VMFrameTemplate(fun_def.fun_name.lexeme, len(fun_def.params), [])
         # set new frame to cur template
         self.curr_template = func_template
+        # find struct objects that never leave the function
+        if self.opt_level >= 2:
+            self.scalar_structs = non_escaping_structs(fun_def, self.struct_defs)
+        self.cold_segments = []
+        self.const_memo = {}
+        # dictionary variables are local to the function
+        outer_dicts = self.dict_defs
+        self.dict_defs = list(outer_dicts)
+        outer_slots = self.slots
+        self.slots = {}
         # push new variable env
         self.var_table.push_environment()
         # add each param to variable env and add store instruction
         for param in range(func_template.arg_count):
+            if fun_def.params[param].data_type.is_dict:
+                self.dict_defs.append(fun_def.params[param].var_name.lexeme)
             self.var_table.add(fun_def.params[param].var_name.lexeme)
+            self.add_slot(fun_def.params[param], fun_def.params[param].var_name.lexeme, param)
             # add store func
             self.curr_template.instructions.append(STORE(param))
 
         # visit each statement
-        for stmt in fun_def.stmts:
-            stmt.accept(self)
+        yield from self.gen_stmts(fun_def.stmts)
 
         # add return if last instruction is not a return
         if len(self.curr_template.instructions) == 0 or type(fun_def.stmts[len(fun_def.stmts) - 1]) != ReturnStmt: 
@@ -79,18 +296,65 @@ class CodeGenerator (Visitor):
             
         # pop environment
         self.var_table.pop_environment()
+        self.dict_defs = outer_dicts
+        self.slots = outer_slots
+        if self.cold_segments:
+            self.move_cold_segments()
         # add frame to vm
         self.vm.add_frame_template(func_template)
 
+
+    def move_cold_segments(self):
+        """Moves the cold code segments of the current function after
+        its other instructions, updating jump targets and sites."""
+        instrs = self.curr_template.instructions
+        # the innermost segment each instruction belongs to (if any)
+        owner = [None] * len(instrs)
+        for seg in sorted(self.cold_segments):
+            for i in range(seg[0], seg[1]):
+                owner[i] = seg
+        order = [i for i in range(len(instrs)) if owner[i] is None]
+        for seg in sorted(self.cold_segments):
+            order += [i for i in range(seg[0], seg[1]) if owner[i] == seg]
+        new_pos = {old: new for new, old in enumerate(order)}
+        new_pos[len(instrs)] = len(instrs)
+        for instr in instrs:
+            if instr.opcode in (OpCode.JMP, OpCode.JMPF, OpCode.JMPT):
+                instr.operand = new_pos[instr.operand]
+        self.curr_template.instructions = [instrs[i] for i in order]
+        self.curr_template.sites = {new_pos[pc]: pos for pc, pos in self.curr_template.sites.items()}
+        self.curr_template.loops = {new_pos[pc]: pos for pc, pos in self.curr_template.loops.items()}
+        self.cold_segments = []
+
     
     def visit_return_stmt(self, return_stmt):
-        return_stmt.expr.accept(self)
+        yield return_stmt.expr
+        # an inlined return leaves its value for the caller
+        if self.inline_exits is not None:
+            self.inline_exits.append(len(self.curr_template.instructions))
+            self.curr_template.instructions.append(JMP(-1))
+            return
         self.curr_template.instructions.append(RET())
 
         
     def visit_var_decl(self, var_decl):
+        # keep each field of a non-escaping struct in its own variable
+        name = var_decl.var_def.var_name.lexeme
+        if name in self.scalar_structs:
+            struct_def = self.scalar_structs[name]
+            params = var_decl.expr.first.rvalue.struct_params
+            for p in range(len(params)):
+                field = struct_def.fields[p]
+                yield params[p]
+                self.curr_template.instructions.append(STORE(self.var_table.total_vars))
+                field_var = f'{name}.{field.var_name.lexeme}'
+                if field.data_type.is_dict:
+                    self.dict_defs.append(field_var)
+                self.add_slot(var_decl.var_def, field_var, self.var_table.total_vars)
+                self.var_table.add(field_var)
+            return
         if var_decl.expr:
-            var_decl.expr.accept(self)
+            yield var_decl.expr
             self.curr_template.instructions.append(STORE(self.var_table.total_vars))
         else:
             self.curr_template.instructions.append(PUSH(None))
@@ -98,28 +362,38 @@ class CodeGenerator (Visitor):
         # cehck for dictionary
         if var_decl.var_def.data_type.is_dict:
             self.dict_defs.append(var_decl.var_def.var_name.lexeme)
-        self.var_table.add(var_decl.var_def.var_name.lexeme)
+        self.var_table.add(name)
+        # (a name declared again in the same scope keeps its first index)
+        self.add_slot(var_decl.var_def, name, self.var_table.get(name))
                 
                 
     
     def visit_assign_stmt(self, assign_stmt):
-        var = assign_stmt.lvalue[0]
-        index = self.var_table.get(var.var_name.lexeme)
-        self.curr_template.instructions.append(LOAD(index))
+        lvalue = self.scalar_path(assign_stmt.lvalue)
+        var = lvalue[0]
+        index = self.var_index(var)
+        # the object is only needed when storing into it
+        if len(lvalue) > 1 or var.array_expr:
+            self.curr_template.instructions.append(LOAD(index))
 
         # chck if path has more than lvalue statement
-        if len(assign_stmt.lvalue) > 1:
+        if len(lvalue) > 1:
             if var.array_expr:
-                var.array_expr.accept(self)
-                self.curr_template.instructions.append(GETI())
+                yield var.array_expr
+                if var.var_name.lexeme in self.dict_defs:
+                    self.curr_template.instructions.append(GETD())
+                elif self.in_bounds(var):
+                    self.curr_template.instructions.append(GETIU())
+                else:
+                    self.curr_template.instructions.append(GETI())
             # go through lvals
-            for x in range(1, len(assign_stmt.lvalue)):
-                field = assign_stmt.lvalue[x]
+            for x in range(1, len(lvalue)):
+                field = lvalue[x]
                 # not last 
-                if x != len(assign_stmt.lvalue) - 1:
+                if x != len(lvalue) - 1:
                     if field.array_expr:
                         self.curr_template.instructions.append(GETF(field.var_name.lexeme))
-                        field.array_expr.accept(self)
+                        yield field.array_expr
                         # check for dict
                         if field.var_name.lexeme in self.dict_defs:
                             self.curr_template.instructions.append(GETD())
@@ -131,52 +405,56 @@ class CodeGenerator (Visitor):
                 else:
                     if field.array_expr:
                         self.curr_template.instructions.append(GETF(field.var_name.lexeme))
-                        field.array_expr.accept(self)
-                        assign_stmt.expr.accept(self)
+                        yield field.array_expr
+                        yield assign_stmt.expr
                         # check for dictionary
                         if field.var_name.lexeme in self.dict_defs:
                             self.curr_template.instructions.append(SETD())
                         else:
                             self.curr_template.instructions.append(SETI())
                     else:
-                        assign_stmt.expr.accept(self)
+                        yield assign_stmt.expr
                         self.curr_template.instructions.append(SETF(field.var_name.lexeme))
                 
         else:
-            var_name = assign_stmt.lvalue[0].var_name.lexeme
+            var_name = lvalue[0].var_name.lexeme
             is_array = False
             is_dict = False
-            if assign_stmt.lvalue[0].array_expr:
+            if lvalue[0].array_expr:
                 if var_name in self.dict_defs:
                     is_dict = True
                 else:
                     is_array = True
-                assign_stmt.lvalue[0].array_expr.accept(self)
+                yield lvalue[0].array_expr
             # accept r value
-            assign_stmt.expr.accept(self)
-            if is_array:
+            yield assign_stmt.expr
+            if is_array and self.in_bounds(lvalue[0]):
+                self.curr_template.instructions.append(SETIU())
+            elif is_array:
                 self.curr_template.instructions.append(SETI())
             elif is_dict:
                 self.curr_template.instructions.append(SETD())
             else:
-                index_var = self.var_table.get(var_name)
-                self.curr_template.instructions.append(STORE(index_var))
+                self.curr_template.instructions.append(STORE(index))
     
     def visit_while_stmt(self, while_stmt):
+        if self.opt_level >= 1:
+            yield from self.gen_rotated_loop(while_stmt.condition, while_stmt.stmts)
+            return
         # grab starting index
         # call accpet on condition
         start = len(self.curr_template.instructions)
-        while_stmt.condition.accept(self)
+        yield from self.gen_condition(while_stmt.condition)
         jmp_loc = len(self.curr_template.instructions)
 
         # create and add jump false with -1
+        self.curr_template.loops[jmp_loc] = source_pos(while_stmt.condition)
         self.curr_template.instructions.append(JMPF(-1))
         # push var table env
         self.var_table.push_environment()
 
         # accept statements
-        for stmt in while_stmt.stmts:
-            stmt.accept(self)
+        yield from self.gen_stmts(while_stmt.stmts)
 
         # pop var_env
         self.var_table.pop_environment()
@@ -189,27 +467,46 @@ class CodeGenerator (Visitor):
 
         
     def visit_for_stmt(self, for_stmt):
+        # fully unroll small loops with constant bounds
+        if self.opt_level >= 2:
+            copies = unroll_for(for_stmt, self.unroll_budget)
+            if copies is not None:
+                for body in copies:
+                    self.var_table.push_environment()
+                    yield from self.gen_stmts(body)
+                    self.var_table.pop_environment()
+                return
         # push environment for var decl
         self.var_table.push_environment()
         # vardecl generate
-        for_stmt.var_decl.accept(self)
+        yield for_stmt.var_decl
+        if self.opt_level >= 1:
+            # indexes known to be in bounds in the body
+            safe = bounded_index(for_stmt)
+            saved = self.safe_indexes
+            if safe:
+                self.safe_indexes = saved | {safe}
+            yield from self.gen_rotated_loop(for_stmt.condition, for_stmt.stmts, for_stmt.assign_stmt)
+            self.safe_indexes = saved
+            self.var_table.pop_environment()
+            return
         # condition
         start = len(self.curr_template.instructions)
-        for_stmt.condition.accept(self)
+        yield from self.gen_condition(for_stmt.condition)
         jmp_loc = len(self.curr_template.instructions)
 
         # create and add jump false with -1
+        self.curr_template.loops[jmp_loc] = source_pos(for_stmt.condition)
         self.curr_template.instructions.append(JMPF(-1))
         # push var table env
         self.var_table.push_environment()
 
         # accept statements
-        for stmt in for_stmt.stmts:
-            stmt.accept(self)
+        yield from self.gen_stmts(for_stmt.stmts)
         
         # update i
         self.var_table.pop_environment()
-        for_stmt.assign_stmt.accept(self)
+        yield for_stmt.assign_stmt
         self.curr_template.instructions.append(JMP(start))
         self.var_table.pop_environment()
         # add jmp nop and update JMPF
@@ -217,19 +514,53 @@ class CodeGenerator (Visitor):
         self.curr_template.instructions[jmp_loc].operand = len(self.curr_template.instructions) - 1
 
     
+    def gen_rotated_loop(self, condition, stmts, step=None):
+        """Generates a loop with the condition tested once before entry and
+        again at the bottom, so each iteration ends in a single JMPT
+        instead of a JMP back to the condition followed by a JMPF.
+
+        Args:
+            condition -- The loop condition.
+            stmts -- The loop body.
+            step -- Optional statement run after the body (for loops).
+
+        """
+        # guard
+        yield from self.gen_condition(condition)
+        jmpf_loc = len(self.curr_template.instructions)
+        self.curr_template.loops[jmpf_loc] = source_pos(condition)
+        self.add_instr(JMPF(-1))
+        # body
+        start = len(self.curr_template.instructions)
+        self.var_table.push_environment()
+        yield from self.gen_stmts(stmts)
+        self.var_table.pop_environment()
+        if step:
+            yield step
+        # back edge
+        yield from self.gen_condition(condition)
+        self.curr_template.loops[len(self.curr_template.instructions)] = source_pos(condition)
+        self.add_instr(JMPT(start))
+        self.curr_template.instructions[jmpf_loc].operand = len(self.curr_template.instructions)
+
+
     def visit_if_stmt(self, if_stmt):
+        # lay out using the profile if it covers this statement
+        if self.branch_counts(if_stmt.if_part):
+            yield from self.gen_profiled_if(if_stmt)
+            return
         # basic_if
         basic_if = if_stmt.if_part
-        basic_if.condition.accept(self)
+        yield from self.gen_condition(basic_if.condition)
 
         # add jumpf
         first_jmpf_loc = len(self.curr_template.instructions)
+        self.curr_template.sites[first_jmpf_loc] = source_pos(basic_if.condition)
         self.curr_template.instructions.append(JMPF(-1))
 
         # push env and accept statments
         self.var_table.push_environment()
-        for stmt in basic_if.stmts:
-            stmt.accept(self)
+        yield from self.gen_stmts(basic_if.stmts)
         self.var_table.pop_environment()
 
         # save jmp location to end of else or elseifs
@@ -245,14 +576,14 @@ class CodeGenerator (Visitor):
                 # add NOP
                 self.curr_template.instructions.append(NOP())
                 # accept condition
-                else_if.condition.accept(self)
+                yield from self.gen_condition(else_if.condition)
                 # jmpf
                 jmpf_loc = len(self.curr_template.instructions)
+                self.curr_template.sites[jmpf_loc] = source_pos(else_if.condition)
                 self.curr_template.instructions.append(JMPF(-1))
                 # statements
                 self.var_table.push_environment()
-                for stmt in else_if.stmts:
-                    stmt.accept(self)
+                yield from self.gen_stmts(else_if.stmts)
                 self.var_table.pop_environment()
                 # jump to end
                 end_jump_locs.append(len(self.curr_template.instructions))
@@ -262,8 +593,7 @@ class CodeGenerator (Visitor):
 
             # go through else stmts if there
             self.var_table.push_environment()
-            for stmt in if_stmt.else_stmts:
-                stmt.accept(self)
+            yield from self.gen_stmts(if_stmt.else_stmts)
             self.var_table.pop_environment()
             # update end_jump_locs
             for loc in end_jump_locs:
@@ -282,55 +612,206 @@ class CodeGenerator (Visitor):
 
             # accept else statements
             self.var_table.push_environment()
-            for stmt in if_stmt.else_stmts:
-                stmt.accept(self)
+            yield from self.gen_stmts(if_stmt.else_stmts)
             self.var_table.pop_environment()
 
             self.curr_template.instructions.append(NOP())
             # update location for end of if to jmp to 
             self.curr_template.instructions[first_jmp_loc].operand = len(self.curr_template.instructions) - 1 
 
+
+    def branch_counts(self, basic_if):
+        """Returns the profiled (true, false) counts of an if/elseif test,
+        or None if the profile has no data for it."""
+        counts = self.profile.get('branches', {}).get(source_pos(basic_if.condition))
+        if counts is None:
+            return None
+        return counts['true'], counts['false']
+
+
+    def gen_profiled_if(self, if_stmt):
+        """Generates an if statement laid out using profile data: tests
+        that can be reordered are tried most frequent first, and rarely
+        taken arms are moved out of the fall-through path."""
+        arms = [if_stmt.if_part] + if_stmt.else_ifs
+        counts = {id(arm): self.branch_counts(arm) or (0, 0) for arm in arms}
+        if len(arms) > 1 and exclusive_tests([arm.condition for arm in arms]):
+            arms.sort(key=lambda arm: -counts[id(arm)][0])
+        end_jump_locs = []
+        for i in range(len(arms)):
+            arm = arms[i]
+            yield from self.gen_condition(arm.condition)
+            test_loc = len(self.curr_template.instructions)
+            self.curr_template.sites[test_loc] = source_pos(arm.condition)
+            if is_cold(counts[id(arm)]):
+                # jump out to the arm's statements, which jump back after
+                self.curr_template.instructions.append(JMPT(test_loc + 1))
+                start = len(self.curr_template.instructions)
+                self.var_table.push_environment()
+                yield from self.gen_stmts(arm.stmts)
+                self.var_table.pop_environment()
+                end_jump_locs.append(len(self.curr_template.instructions))
+                self.curr_template.instructions.append(JMP(-1))
+                self.cold_segments.append((start, len(self.curr_template.instructions)))
+            else:
+                self.curr_template.instructions.append(JMPF(-1))
+                self.var_table.push_environment()
+                yield from self.gen_stmts(arm.stmts)
+                self.var_table.pop_environment()
+                # the last arm can fall through to the end
+                if i < len(arms) - 1 or if_stmt.else_stmts:
+                    end_jump_locs.append(len(self.curr_template.instructions))
+                    self.curr_template.instructions.append(JMP(-1))
+                self.curr_template.instructions[test_loc].operand = len(self.curr_template.instructions)
+        self.var_table.push_environment()
+        yield from self.gen_stmts(if_stmt.else_stmts)
+        self.var_table.pop_environment()
+        for loc in end_jump_locs:
+            self.curr_template.instructions[loc].operand = len(self.curr_template.instructions)
+
             
     
     def visit_call_expr(self, call_expr):
+        # evaluate pure calls with constant arguments at compile time
+        if call_expr.fun_name.lexeme in self.pure_funs:
+            val = self.call_value(call_expr)
+            if val is not NOT_CONSTANT:
+                self.add_instr(PUSH(val))
+                self.curr_template.instructions[-1].comment = f'folded {self.call_text(call_expr)}'
+                return
         # go through arguments and accept them
         for arg in call_expr.args:
-            arg.accept(self)
+            yield arg
         
         # check what function
         name = call_expr.fun_name.lexeme
-        if name == 'print':
-            self.curr_template.instructions.append(WRITE())
-        elif name == 'input':
-            self.curr_template.instructions.append(READ())
-        elif name == 'length':
-            self.curr_template.instructions.append(LEN())
-        elif name == 'dtoi' or name == 'stoi':
-            self.curr_template.instructions.append(TOINT())
-        elif name == 'itod' or name == 'stod':
-            self.curr_template.instructions.append(TODBL())
-        elif name == 'itos' or name == 'dtos':
-            self.curr_template.instructions.append(TOSTR())
-        elif name == 'get':
-            self.curr_template.instructions.append(GETC())
-        elif name == 'keys':
-            self.curr_template.instructions.append(KEYS())
-        elif name == 'in':
-            self.curr_template.instructions.append(IN())
+        if name in BUILT_INS:
+            built_in = BUILT_INS[name]
+            if built_in.opcode is None:
+                self.curr_template.instructions.append(NATIVE(name))
+            else:
+                self.curr_template.instructions.append(VMInstr(built_in.opcode))
+        elif name in self.fun_defs and source_pos(call_expr) in self.hot_calls \
+             and self.inline_exits is None and can_inline(self.fun_defs[name]):
+            yield from self.gen_inline_call(self.fun_defs[name])
         else:
+            self.curr_template.sites[len(self.curr_template.instructions)] = source_pos(call_expr)
             self.curr_template.instructions.append(CALL(name))
 
+
+    def call_value(self, call_expr):
+        """Returns the result of a pure function call whose arguments are
+        constants (or such calls), or NOT_CONSTANT."""
+        name = call_expr.fun_name.lexeme
+        if name not in self.pure_funs:
+            return NOT_CONSTANT
+        args = []
+        for arg in call_expr.args:
+            val = const_value(arg)
+            if val is NOT_CONSTANT and call_of(arg):
+                val = self.call_value(call_of(arg))
+            if val is NOT_CONSTANT:
+                return NOT_CONSTANT
+            args.append(val)
+        # the types keep e.g. 1 and true apart
+        key = (name, tuple((type(a), a) for a in args))
+        if key not in self.folded:
+            self.folded[key] = self.evaluate_call(name, args)
+        return self.folded[key]
+
+
+    def evaluate_call(self, name, args):
+        """Runs a function in a separate VM with an instruction budget,
+        returning its result or NOT_CONSTANT if it didn't finish."""
+        if self.sandbox is None:
+            vm = VM()
+            try:
+                self.program.accept(CodeGenerator(vm, 1))
+            except MyPLError:
+                pass
+            self.sandbox = vm.frame_templates
+        if name not in self.sandbox:
+            return NOT_CONSTANT
+        vm = VM()
+        vm.frame_templates = dict(self.sandbox)
+        main = VMFrameTemplate('main', 0, [PUSH(a) for a in args] + [CALL(name), RET()])
+        vm.frame_templates['main'] = main
+        vm.max_steps = PARTIAL_EVAL_BUDGET
+        try:
+            return vm.run()
+        except MyPLError:
+            # VM errors (including running out of budget) are left for
+            # run time
+            return NOT_CONSTANT
+
+
+    def call_text(self, call_expr):
+        """Returns a folded call written with its argument values."""
+        args = []
+        for arg in call_expr.args:
+            val = const_value(arg)
+            args.append(self.call_text(call_of(arg)) if val is NOT_CONSTANT else value_text(val))
+        return f'{call_expr.fun_name.lexeme}({", ".join(args)})'
+
+
+    def gen_inline_call(self, fun_def):
+        """Generates the body of a called function in place of the call
+        (the arguments are already on the operand stack)."""
+        self.var_table.push_environment()
+        # the caller's dictionary variables aren't visible in the body
+        outer_dicts = self.dict_defs
+        self.dict_defs = self.struct_dicts()
+        params = [param.var_name.lexeme for param in fun_def.params]
+        base = self.var_table.total_vars
+        # the last argument is on top, so create the slots below it first
+        for i in range(len(params)):
+            if i < len(params) - 1:
+                self.add_instr(PUSH(None))
+                self.add_instr(STORE(base + i))
+            if fun_def.params[i].data_type.is_dict:
+                self.dict_defs.append(params[i])
+            self.var_table.add(params[i])
+            self.add_slot(fun_def.params[i], params[i], base + i)
+        for i in reversed(range(len(params))):
+            self.add_instr(STORE(base + i))
+        saved = (self.scalar_structs, self.safe_indexes)
+        self.scalar_structs = {}
+        self.safe_indexes = set()
+        self.inline_exits = []
+        yield from self.gen_stmts(fun_def.stmts)
+        if not fun_def.stmts or type(fun_def.stmts[-1]) != ReturnStmt:
+            self.add_instr(PUSH(None))
+        elif self.inline_exits[-1] == len(self.curr_template.instructions) - 1:
+            # a final return can just fall through
+            self.curr_template.instructions.pop()
+            self.inline_exits.pop()
+        for loc in self.inline_exits:
+            self.curr_template.instructions[loc].operand = len(self.curr_template.instructions)
+        self.inline_exits = None
+        self.scalar_structs, self.safe_indexes = saved
+        self.dict_defs = outer_dicts
+        self.var_table.pop_environment()
+
         
     def visit_expr(self, expr):
+        # fold constant expressions
+        if self.opt_level >= 1 and (expr.op or expr.not_op):
+            val = const_value(expr, self.const_memo)
+            if val is not NOT_CONSTANT:
+                self.add_instr(PUSH(val))
+                return
+        # reuse an already computed common subexpression
+        if self.cse_load(expr):
+            return
         # check for operation
         if expr.op:
             # check for greater than comparison
             if expr.op.token_type == TokenType.GREATER or expr.op.token_type == TokenType.GREATER_EQ:
-                expr.rest.accept(self)
-                expr.first.accept(self)
+                yield expr.rest
+                yield expr.first
             else:
-                expr.first.accept(self)
-                expr.rest.accept(self)
+                yield expr.first
+                yield expr.rest
             # determine operation
             if expr.op.token_type == TokenType.PLUS:
                 self.curr_template.instructions.append(ADD())
@@ -361,10 +842,11 @@ class CodeGenerator (Visitor):
                 self.curr_template.instructions.append(CMPNE())           
         # no operation
         else:
-            expr.first.accept(self)
+            yield expr.first
         # check for not
         if expr.not_op:
             self.curr_template.instructions.append(NOT())
+        self.cse_save(expr)
             
 
             
@@ -379,29 +861,15 @@ class CodeGenerator (Visitor):
 
     
     def visit_simple_term(self, simple_term):
-        simple_term.rvalue.accept(self)
+        yield simple_term.rvalue
 
         
     def visit_complex_term(self, complex_term):
-        complex_term.expr.accept(self)
+        yield complex_term.expr
 
         
     def visit_simple_rvalue(self, simple_rvalue):
-        val = simple_rvalue.value.lexeme
-        if simple_rvalue.value.token_type == TokenType.INT_VAL:
-            self.add_instr(PUSH(int(val)))
-        elif simple_rvalue.value.token_type == TokenType.DOUBLE_VAL:
-            self.add_instr(PUSH(float(val)))
-        elif simple_rvalue.value.token_type == TokenType.STRING_VAL:
-            val = val.replace('\\n', '\n')
-            val = val.replace('\\t', '\t')
-            self.add_instr(PUSH(val))
-        elif val == 'true':
-            self.add_instr(PUSH(True))
-        elif val == 'false':
-            self.add_instr(PUSH(False))
-        elif val == 'null':
-            self.add_instr(PUSH(None))
+        self.add_instr(PUSH(literal_value(simple_rvalue.value)))
 
     
     def visit_new_rvalue(self, new_rvalue):
@@ -414,7 +882,7 @@ class CodeGenerator (Visitor):
             struct_params = new_rvalue.struct_params
             for p in range(len(struct_params)):
                 self.curr_template.instructions.append(DUP())
-                struct_params[p].accept(self)
+                yield struct_params[p]
                 self.curr_template.instructions.append(SETF(struct_fields[p].var_name.lexeme))
         # array or dict
         else:
@@ -429,17 +897,25 @@ class CodeGenerator (Visitor):
             
     
     def visit_var_rvalue(self, var_rvalue):
+        # reuse an already computed common subexpression
+        if self.cse_load(var_rvalue):
+            return
+        path = self.scalar_path(var_rvalue.path)
         # check for path expr
-        if len(var_rvalue.path) > 1:
-            path = var_rvalue.path
+        if len(path) > 1:
             # get mem location
-            struct_mem_loc = self.var_table.get(path[0].var_name.lexeme)
+            struct_mem_loc = self.var_index(path[0])
             
             self.curr_template.instructions.append(LOAD(struct_mem_loc))
             # check array_expr for first
             if path[0].array_expr:
-                path[0].array_expr.accept(self)
-                self.curr_template.instructions.append(GETI())
+                yield path[0].array_expr
+                if path[0].var_name.lexeme in self.dict_defs:
+                    self.curr_template.instructions.append(GETD())
+                elif self.in_bounds(path[0]):
+                    self.curr_template.instructions.append(GETIU())
+                else:
+                    self.curr_template.instructions.append(GETI())
             
             # # go through rest of path
             for x in range(1, len(path)):
@@ -448,7 +924,7 @@ class CodeGenerator (Visitor):
                 if x != len(path) - 1:
                     if field.array_expr:
                         self.curr_template.instructions.append(GETF(field.var_name.lexeme))
-                        field.array_expr.accept(self)
+                        yield field.array_expr
                         if field.var_name.lexeme in self.dict_defs:
                             self.curr_template.instructions.append(GETD())
                         else:
@@ -459,8 +935,8 @@ class CodeGenerator (Visitor):
                 else:
                     if field.array_expr:
                         self.curr_template.instructions.append(GETF(field.var_name.lexeme))
-                        field.array_expr.accept(self)
-                        field.expr.accept(self)
+                        yield field.array_expr
+                        yield field.expr
                         if field.var_name.lexeme in self.dict_defs:
                             self.curr_template.instructions.append(GETD())
                         else:
@@ -468,16 +944,18 @@ class CodeGenerator (Visitor):
                     else:
                         self.curr_template.instructions.append(GETF(field.var_name.lexeme))
         else:
-            name = var_rvalue.path[0].var_name.lexeme
-            index = self.var_table.get(name)
+            name = path[0].var_name.lexeme
+            index = self.var_index(path[0])
             self.curr_template.instructions.append(LOAD(index))
             # check for array expr so getI
-            if var_rvalue.path[0].array_expr:
+            if path[0].array_expr:
                 # push index onto stack
-                var_rvalue.path[0].array_expr.accept(self)
+                yield path[0].array_expr
                 if name in self.dict_defs:
                     self.curr_template.instructions.append(GETD())  
+                elif self.in_bounds(path[0]):
+                    self.curr_template.instructions.append(GETIU())
                 else:
                     self.curr_template.instructions.append(GETI())
+        self.cse_save(var_rvalue)
 
-                
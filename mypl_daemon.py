@@ -0,0 +1,288 @@
+"""Warm MyPL server: runs programs sent over a Unix socket by
+mypl_client.py without paying Python startup and import time per run.
+
+NAME: George Calvert
+DATE: Spring 2024
+CLASS: CPSC 326
+
+A client sends its command line arguments, working directory, and the
+environment variables mypl reads along with its standard input, output,
+and error file descriptors. The server forks a child (with the compiler
+already loaded) that runs the request on the client's own streams, so
+output is streamed to the client as the program runs, and then sends
+back the exit status. Only the standard library is imported here so that the
+client starts quickly.
+
+The socket is only usable by the user running the server: it is created
+with mode 0600 (by default in a directory only the user can access),
+and on systems that report the peer of a Unix socket connection, the
+client and server each check that the other runs as the same user.
+
+"""
+
+import json
+import os
+import signal
+import socket
+import stat
+import struct
+import sys
+import tempfile
+import traceback
+
+
+# upper limit on the size of a request (arguments and environment)
+MAX_REQUEST = 1 << 20
+
+# the environment variables sent with a request (the ones mypl reads)
+FORWARDED_ENV = ['MYPL_CACHE_DIR']
+
+
+def socket_dir():
+    """Returns the per-user directory for the default socket:
+    $XDG_RUNTIME_DIR, or a mypl-UID directory in the temp directory."""
+    return os.environ.get('XDG_RUNTIME_DIR') or \
+        os.path.join(tempfile.gettempdir(), f'mypl-{os.getuid()}')
+
+
+def default_socket():
+    """Returns the socket path from $MYPL_SOCKET, or a per-user default."""
+    return os.environ.get('MYPL_SOCKET') or os.path.join(socket_dir(), 'mypl.sock')
+
+
+def make_private_dir(path):
+    """Creates a directory only the current user can access (if it
+    doesn't exist), raising OSError if the directory is not private.
+
+    Args:
+        path -- The directory path.
+
+    """
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() \
+       or stat.S_IMODE(info.st_mode) & 0o077:
+        raise OSError(f"'{path}' is not a directory private to this user")
+
+
+def owned_socket(path):
+    """True if the path is a socket owned by the current user."""
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(info.st_mode) and info.st_uid == os.getuid()
+
+
+def peer_uid(conn):
+    """Returns the user id of the process at the other end of a Unix
+    socket connection, or None if the system doesn't report it."""
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    return struct.unpack('3i', creds)[1]
+
+
+def trusted_peer(conn):
+    """True if the other end of a connection runs as the current user
+    (or the system can't tell, leaving it to the socket's permissions)."""
+    uid = peer_uid(conn)
+    return uid is None or uid == os.getuid()
+
+
+def recv_exactly(conn, size):
+    """Returns the next size bytes from a socket (fewer at end of file)."""
+    data = b''
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+#----------------------------------------------------------------------
+# Client
+#----------------------------------------------------------------------
+
+def send_request(conn, argv, fds):
+    """Sends a run request over a connected socket.
+
+    Args:
+        conn -- The socket connected to the server.
+        argv -- The mypl command line arguments.
+        fds -- The standard input, output, and error file descriptors to
+               run the program with.
+
+    """
+    env = {name: os.environ[name] for name in FORWARDED_ENV if name in os.environ}
+    body = json.dumps({'argv': argv, 'cwd': os.getcwd(), 'env': env})
+    body = body.encode('utf-8')
+    # the descriptors travel with the length header
+    socket.send_fds(conn, [struct.pack('<I', len(body))], fds)
+    conn.sendall(body)
+
+
+def run_remote(argv, path=None, fds=(0, 1, 2)):
+    """Runs mypl on the server, returning the exit status, or None if no
+    server is listening on the socket (or the socket or the server isn't
+    the current user's).
+
+    Args:
+        argv -- The mypl command line arguments.
+        path -- The server's socket (default_socket() if None).
+        fds -- The standard input, output, and error file descriptors to
+               run the program with.
+
+    """
+    path = path or default_socket()
+    if not os.path.exists(path):
+        return None
+    if not owned_socket(path):
+        print(f"WARNING: ignoring '{path}', which is not a socket owned by this user", file=sys.stderr)
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+    except OSError:
+        conn.close()
+        return None
+    if not trusted_peer(conn):
+        conn.close()
+        print(f"WARNING: ignoring '{path}', whose server is run by another user", file=sys.stderr)
+        return None
+    with conn:
+        send_request(conn, argv, list(fds))
+        status = recv_exactly(conn, 4)
+    if len(status) < 4:
+        print('ERROR: mypl server stopped before the program finished', file=sys.stderr)
+        return 1
+    return struct.unpack('<i', status)[0]
+
+
+#----------------------------------------------------------------------
+# Server
+#----------------------------------------------------------------------
+
+def exit_status(code):
+    """Returns the process exit status for a SystemExit code."""
+    if code is None:
+        return 0
+    elif type(code) == int:
+        return code
+    print(code, file=sys.stderr)
+    return 1
+
+
+def handle(conn, main):
+    """Runs one request in a forked child process, returning the exit
+    status to send back.
+
+    Args:
+        conn -- The socket connected to the client.
+        main -- The function that runs mypl given its arguments.
+
+    """
+    size_data, fds, _, _ = socket.recv_fds(conn, 4, 3)
+    if len(size_data) < 4 or len(fds) != 3:
+        return 1
+    (size,) = struct.unpack('<I', size_data)
+    if size > MAX_REQUEST:
+        return 1
+    request = json.loads(recv_exactly(conn, size).decode('utf-8'))
+    # take over the client's standard streams
+    for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+        os.close(fd)
+    sys.stdin = open(0, 'r', encoding='utf-8', closefd=False)
+    sys.stdout = open(1, 'w', encoding='utf-8', closefd=False)
+    sys.stderr = open(2, 'w', encoding='utf-8', closefd=False)
+    for name in FORWARDED_ENV:
+        os.environ.pop(name, None)
+    os.environ.update({name: request['env'][name] for name in FORWARDED_ENV
+                       if name in request['env']})
+    status = 0
+    try:
+        os.chdir(request['cwd'])
+        main(request['argv'])
+    except SystemExit as ex:
+        status = exit_status(ex.code)
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return status
+
+
+def is_listening(path):
+    """Returns True if a server is accepting connections on the socket."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        try:
+            conn.connect(path)
+            return True
+        except OSError:
+            return False
+
+
+def serve(path, main):
+    """Listens on a Unix socket, running each request from the same user
+    in a fresh child process, until interrupted.
+
+    Args:
+        path -- The socket path.
+        main -- The function that runs mypl given its arguments.
+
+    """
+    if os.path.dirname(os.path.abspath(path)) == os.path.abspath(socket_dir()):
+        try:
+            make_private_dir(socket_dir())
+        except OSError as ex:
+            print(f'ERROR: {ex}', file=sys.stderr)
+            sys.exit(1)
+    if os.path.lexists(path):
+        if is_listening(path):
+            print(f"ERROR: a mypl server is already listening on '{path}'", file=sys.stderr)
+            sys.exit(1)
+        if not owned_socket(path):
+            print(f"ERROR: '{path}' exists and is not a socket owned by this user", file=sys.stderr)
+            sys.exit(1)
+        # left over from a server that didn't shut down
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # only the user can connect (created that way so there's no window
+    # before the chmod)
+    old_umask = os.umask(0o177)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(old_umask)
+    os.chmod(path, 0o600)
+    server.listen()
+    # finished children are reaped automatically
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    print(f'mypl server listening on {path}', file=sys.stderr, flush=True)
+    try:
+        while True:
+            conn, _ = server.accept()
+            if not trusted_peer(conn):
+                conn.close()
+                continue
+            if os.fork() == 0:
+                server.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                status = 1
+                try:
+                    status = handle(conn, main)
+                    conn.sendall(struct.pack('<i', status))
+                finally:
+                    os._exit(status)
+            conn.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.unlink(path)
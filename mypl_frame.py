@@ -18,6 +18,55 @@ class VMFrameTemplate:
     function_name: str
     arg_count: int
     instructions: list['VMInstr'] = field(default_factory=list) 
+    sites: dict[int, str] = field(default_factory=dict)   # pc -> source position
+    loops: dict[int, str] = field(default_factory=dict)   # pc -> loop condition position
+
+
+class OnDemandTemplates(dict):
+    """A function name -> frame template dictionary that creates each
+    template the first time it is looked up. Subclasses set names to the
+    names of all the functions and implement create(name). Iterating
+    creates any templates not yet created."""
+
+    names = ()
+
+    def create(self, name):
+        """Returns the new template for the named function."""
+        raise NotImplementedError()
+
+    def __contains__(self, name):
+        return name in self.names or dict.__contains__(self, name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __missing__(self, name):
+        if name not in self.names:
+            raise KeyError(name)
+        template = self.create(name)
+        self[name] = template
+        return template
+
+    def load_all(self):
+        """Creates every template not yet created."""
+        for name in self.names:
+            self[name]
+
+    def __iter__(self):
+        self.load_all()
+        return dict.__iter__(self)
+
+    def keys(self):
+        self.load_all()
+        return dict.keys(self)
+
+    def values(self):
+        self.load_all()
+        return dict.values(self)
+
+    def items(self):
+        self.load_all()
+        return dict.items(self)
 
     
 @dataclass
@@ -96,6 +145,9 @@ def JMP(offset):
 def JMPF(offset):
     return VMInstr(OpCode.JMPF, offset)
 
+def JMPT(offset):
+    return VMInstr(OpCode.JMPT, offset)
+
 def CALL(fun_name):
     return VMInstr(OpCode.CALL, fun_name)
 
@@ -128,6 +180,9 @@ def TODBL():
 def TOSTR():
     return VMInstr(OpCode.TOSTR)
 
+def NATIVE(fun_name):
+    return VMInstr(OpCode.NATIVE, fun_name)
+
 def ALLOCS():
     return VMInstr(OpCode.ALLOCS)
 
@@ -155,6 +210,12 @@ def SETI():
 def GETI():
     return VMInstr(OpCode.GETI)
 
+def SETIU():
+    return VMInstr(OpCode.SETIU)
+
+def GETIU():
+    return VMInstr(OpCode.GETIU)
+
 def DUP():
     return VMInstr(OpCode.DUP)
 
@@ -0,0 +1,297 @@
+"""Incremental compilation of MyPL programs, one top-level definition
+at a time.
+
+NAME: George Calvert
+DATE: Spring 2024
+CLASS: CPSC 326
+
+"""
+
+import io
+from dataclasses import fields, is_dataclass
+
+from mypl_error import *
+from mypl_token import *
+from mypl_iowrapper import BufferedWrapper
+from mypl_lexer import Lexer
+from mypl_ast import *
+from mypl_ast_parser import ASTParser
+from mypl_semantic_checker import SemanticChecker
+from mypl_code_gen import CodeGenerator
+from mypl_optimizer import walk_nodes
+from mypl_frame import VMFrameTemplate
+from mypl_vm import VM
+
+
+def split_definitions(source):
+    """Splits a program into its top-level definitions.
+
+    Each piece runs from the end of the previous definition to the
+    closing brace of the next one (so leading comments and whitespace
+    belong to the definition after them), with whatever follows the last
+    definition as a final piece. Braces inside strings and comments are
+    skipped.
+
+    Args:
+        source -- The program's source code.
+
+    Returns: A list of (text, line, column) tuples, where line and
+    column are the lexer's position just before the piece's first
+    character.
+
+    """
+    pieces = []
+    start, start_line, start_column = 0, 1, 0
+    line, column = 1, 0
+    depth = 0
+    in_string = in_comment = False
+    for i, ch in enumerate(source):
+        if in_comment:
+            in_comment = ch != '\n'
+        elif in_string:
+            in_string = ch != '"' and ch != '\n'
+        elif ch == '/' and source[i+1:i+2] == '/':
+            in_comment = True
+        elif ch == '"':
+            in_string = True
+        elif ch == '{':
+            depth += 1
+        elif ch == '}':
+            depth -= 1
+            if depth == 0:
+                pieces.append((source[start:i+1], start_line, start_column))
+                start, start_line, start_column = i + 1, line, column + 1
+        if ch == '\n':
+            line, column = line + 1, 0
+        else:
+            column += 1
+    if start < len(source):
+        pieces.append((source[start:], start_line, start_column))
+    return pieces
+
+
+def has_code(text):
+    """Returns True if a line of source code might have tokens (i.e., it
+    isn't just whitespace and a comment)."""
+    return text.split('//', 1)[0].strip() != ''
+
+
+def tokens(node):
+    """Yields each token in an AST (once, even if it is shared)."""
+    seen = set()
+    stack = [node]
+    while stack:
+        curr = stack.pop()
+        if isinstance(curr, Token):
+            if id(curr) not in seen:
+                seen.add(id(curr))
+                yield curr
+        elif isinstance(curr, list):
+            stack.extend(curr)
+        elif is_dataclass(curr):
+            stack.extend(getattr(curr, f.name) for f in fields(curr))
+
+
+def shift_lines(node, delta):
+    """Moves every token of an AST down by delta lines, in place."""
+    for token in tokens(node):
+        token.line += delta
+
+
+def shift_sites(template, delta):
+    """Returns a copy of a frame template with its source positions moved
+    down by delta lines (sharing the instructions)."""
+    def shift(positions):
+        moved = {}
+        for pc, pos in positions.items():
+            line, column = pos.split(':')
+            moved[pc] = f'{int(line) + delta}:{column}'
+        return moved
+    return VMFrameTemplate(template.function_name, template.arg_count,
+                           template.instructions, shift(template.sites),
+                           shift(template.loops))
+
+
+def type_text(data_type):
+    """Returns the kind and type names of a data type, for comparing
+    types."""
+    kind = 'dict' if data_type.is_dict else 'array' if data_type.is_array else 'base'
+    return ' '.join([kind] + [token.lexeme for token in tokens(data_type)])
+
+
+def signature(fun_def):
+    """Returns the text of a function's return and parameter types."""
+    params = ', '.join(type_text(p.data_type) for p in fun_def.params)
+    return f'{type_text(fun_def.return_type)} ({params})'
+
+
+class IncrementalCompiler:
+    """Compiles successive versions of a program, redoing only the work
+    for top-level definitions that changed.
+
+    A definition is re-parsed when its text changes, and re-checked and
+    re-generated when its text or the definitions it depends on change.
+    A function depends on the signatures of the functions it calls and
+    on the layouts of the structs it names (and the structs those name),
+    and its code on the names of all dictionary struct fields. At -O 2, code generation also depends on the functions that can be
+    evaluated at compile time.
+
+    """
+
+    def __init__(self, opt_level=0):
+        """Creates a compiler with empty caches.
+
+        Args:
+            opt_level -- The code generator optimization level.
+
+        """
+        self.opt_level = opt_level
+        # (text, column) -> (Program, line) for each parsed piece, where
+        # the column is None if the piece's first line has no tokens
+        self.pieces = {}
+        # keys of the definitions that passed the semantic checker
+        self.checked_keys = set()
+        # codegen key -> (template, line) for each function
+        self.templates = {}
+        # id(definition) -> source text of the current program
+        self.texts = {}
+        # names of the definitions redone by the last compile
+        self.parsed = []
+        self.checked = []
+        self.generated = []
+
+
+    def compile(self, source):
+        """Compiles a program, returning a VM ready to run it.
+
+        Args:
+            source -- The program's source code.
+
+        """
+        self.parsed, self.checked, self.generated = [], [], []
+        program = self.parse(source)
+        self.check(program)
+        return self.generate(program)
+
+
+    def parse(self, source):
+        """Returns the Program AST, reusing the ASTs of unchanged pieces."""
+        program = Program([], [])
+        pieces = {}
+        self.texts = {}
+        for text, line, column in split_definitions(source):
+            key = (text, column if has_code(text.split('\n', 1)[0]) else None)
+            if key in self.pieces:
+                piece, old_line = self.pieces.pop(key)
+                if line != old_line:
+                    shift_lines(piece, line - old_line)
+            else:
+                lexer = Lexer(BufferedWrapper(io.StringIO(text)))
+                lexer.line, lexer.column = line, column
+                try:
+                    piece = ASTParser(lexer).parse()
+                except MyPLError:
+                    # report the same error a whole-file parse would
+                    return self.parse_all(source)
+                self.parsed.extend(name_of(d) for d in piece.struct_defs + piece.fun_defs)
+            pieces[key] = (piece, line)
+            program.struct_defs.extend(piece.struct_defs)
+            program.fun_defs.extend(piece.fun_defs)
+            for definition in piece.struct_defs + piece.fun_defs:
+                self.texts[id(definition)] = text
+        self.pieces = pieces
+        return program
+
+
+    def parse_all(self, source):
+        """Returns the Program AST of a whole-file parse (which every
+        definition then depends on)."""
+        program = ASTParser(Lexer(BufferedWrapper(io.StringIO(source)))).parse()
+        self.pieces = {}
+        self.texts = {id(d): source for d in program.struct_defs + program.fun_defs}
+        self.parsed = [name_of(d) for d in program.struct_defs + program.fun_defs]
+        return program
+
+
+    def struct_layouts(self, definition, structs):
+        """Returns the source text of the structs a definition names,
+        directly or through the fields of other structs."""
+        used = {}
+        stack = [definition]
+        while stack:
+            for token in tokens(stack.pop()):
+                name = token.lexeme
+                if name in structs and name not in used:
+                    used[name] = self.texts.get(id(structs[name]))
+                    stack.append(structs[name])
+        return tuple(sorted(used.items()))
+
+
+    def check_key(self, definition, checker):
+        """Returns the text and dependencies that determine whether a
+        definition passes the semantic checker."""
+        text = self.texts.get(id(definition))
+        layouts = self.struct_layouts(definition, checker.structs)
+        if isinstance(definition, StructDef):
+            return ('struct', text, layouts, tuple(sorted(checker.structs)))
+        calls = {}
+        for node in walk_nodes(definition):
+            if isinstance(node, CallExpr):
+                name = node.fun_name.lexeme
+                fun_def = checker.functions.get(name)
+                calls[name] = signature(fun_def) if fun_def else None
+        return ('fun', text, layouts, tuple(sorted(calls.items())))
+
+
+    def check(self, program):
+        """Runs the semantic checker on the changed definitions."""
+        checker = SemanticChecker()
+        checker.declare_program(program)
+        keys = set()
+        for definition in list(checker.structs.values()) + list(checker.functions.values()):
+            key = self.check_key(definition, checker)
+            if key not in self.checked_keys:
+                self.checked.append(name_of(definition))
+                definition.accept(checker)
+                self.checked_keys.add(key)
+            keys.add(key)
+        # forget definitions that are no longer in the program
+        self.checked_keys = keys
+
+
+    def generate(self, program):
+        """Generates code for the changed functions, returning the VM."""
+        vm = VM()
+        codegen = CodeGenerator(vm, self.opt_level)
+        codegen.begin_program(program)
+        structs = {s.struct_name.lexeme: s for s in program.struct_defs}
+        # dictionary struct fields are treated as dictionaries everywhere
+        dicts = tuple(sorted(set(codegen.struct_dicts())))
+        pure = ()
+        if self.opt_level >= 2:
+            pure = tuple(sorted((f.fun_name.lexeme, self.texts.get(id(f))) for f in program.fun_defs
+                                if f.fun_name.lexeme in codegen.pure_funs))
+        templates = {}
+        for fun_def in program.fun_defs:
+            name = fun_def.fun_name.lexeme
+            line = fun_def.fun_name.line
+            key = (self.texts.get(id(fun_def)), fun_def.fun_name.column,
+                   self.struct_layouts(fun_def, structs), dicts, pure)
+            if key in self.templates:
+                template, old_line = self.templates[key]
+                template = shift_sites(template, line - old_line)
+                vm.add_frame_template(template)
+            else:
+                fun_def.accept(codegen)
+                template = vm.frame_templates[name]
+                self.generated.append(name)
+            templates[key] = (template, line)
+        self.templates = templates
+        return vm
+
+
+def name_of(definition):
+    """Returns the name of a struct or function definition."""
+    if isinstance(definition, StructDef):
+        return definition.struct_name.lexeme
+    return definition.fun_name.lexeme
@@ -6,6 +6,10 @@ CLASS: CPSC 326
 
 """
 
+import mmap
+import os
+import re
+
 
 class StdInWrapper:
     """Standard input wrapper for reading and peeking."""
@@ -49,5 +53,94 @@ class FileWrapper:
     def close(self):
         """Closes the stream."""
         self.stream.close()
-        
 
+
+
+class BufferedWrapper:
+    """Input wrapper that reads the whole stream into memory once and
+    then reads and peeks from the buffer."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.text = stream.read()
+        self.pos = 0
+
+    def read_char(self):
+        """Returns and removes a single character in stream."""
+        ch = self.text[self.pos:self.pos+1]
+        if ch:
+            self.pos += 1
+        return ch
+
+    def peek_char(self):
+        """Returns next character in stream to be read."""
+        return self.text[self.pos:self.pos+1]
+
+    def close(self):
+        """Closes the stream."""
+        self.stream.close()
+
+
+
+class MappedWrapper:
+    """Input wrapper that memory-maps a file, so that the lexer can scan
+    its UTF-8 bytes in place instead of reading them into memory.
+
+    As in text mode, a lone \\r ends a line. The lexer only treats \\n
+    (or \\r\\n) as a line break, so a file with lone \\r characters is
+    read into memory with them replaced by \\n instead of being mapped.
+
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        size = os.fstat(stream.fileno()).st_size
+        # an empty file can't be mapped
+        self.data = b''
+        if size:
+            self.data = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+            if LONE_CR_RE.search(self.data):
+                data = self.data[:].replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+                self.data.close()
+                self.data = data
+        self.pos = 0
+
+    @property
+    def text(self):
+        """The decoded contents of the file (a copy, with line endings
+        read as in text mode)."""
+        text = self.data[:].decode('utf-8')
+        return text.replace('\r\n', '\n').replace('\r', '\n')
+
+    def read_char(self):
+        """Returns and removes a single character in stream."""
+        ch = self.peek_char()
+        self.pos += char_size(self.data, self.pos) if ch else 0
+        return ch
+
+    def peek_char(self):
+        """Returns next character in stream to be read."""
+        return self.data[self.pos:self.pos + char_size(self.data, self.pos)].decode('utf-8')
+
+    def close(self):
+        """Closes the stream."""
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.stream.close()
+
+
+
+# a carriage return that isn't part of a \r\n line ending
+LONE_CR_RE = re.compile(rb'\r(?!\n)')
+
+
+def char_size(data, pos):
+    """Returns the number of bytes in the UTF-8 character starting at a
+    position of a bytes-like object (1 at the end)."""
+    if pos >= len(data) or data[pos] < 0xc0:
+        return 1
+    elif data[pos] < 0xe0:
+        return 2
+    elif data[pos] < 0xf0:
+        return 3
+    return 4
@@ -6,8 +6,89 @@ CLASS: CPSC 326
 
 """
 
+import re
+import sys
+
 from mypl_token import *
 from mypl_error import *
+from mypl_iowrapper import char_size
+
+
+# the next token (after any whitespace) of the remaining input
+TOKEN_RE = re.compile(r'''
+    (?P<space>\s*)
+    (?:
+        (?P<comment>//)
+      | (?P<symbol>==|<=|>=|!=|[.;,+\-*/()\[\]{}=<>])
+      | (?P<string>")
+      | (?P<number>\d+(?:\.\d*)?)
+      | (?P<word>[^\W\d_][^\s()=,\[\].+\-*/<>;]*)
+      | (?P<other>.)
+    )?''', re.VERBOSE | re.DOTALL)
+
+# the same for UTF-8 bytes, where words, numbers, and whitespace are
+# ASCII (anything else is scanned as text)
+BYTES_TOKEN_RE = re.compile(rb'''
+    (?P<space>[\x20\t\n\r\f\v\x1c-\x1f]*)
+    (?:
+        (?P<comment>//)
+      | (?P<symbol>==|<=|>=|!=|[.;,+\-*/()\[\]{}=<>])
+      | (?P<string>")
+      | (?P<number>[0-9]+(?:\.[0-9]*)?)
+      | (?P<word>[A-Za-z][^\x20\t\n\r\f\v\x1c-\x1f()=,\[\].+\-*/<>;\x80-\xff]*)
+      | (?P<other>.)
+    )?''', re.VERBOSE | re.DOTALL)
+
+SPACE_RE = re.compile(r'\s*')
+
+# punctuation and operators
+SYMBOLS = {
+    '.': TokenType.DOT,
+    ';': TokenType.SEMICOLON,
+    ',': TokenType.COMMA,
+    '+': TokenType.PLUS,
+    '-': TokenType.MINUS,
+    '*': TokenType.TIMES,
+    '/': TokenType.DIVIDE,
+    '(': TokenType.LPAREN,
+    ')': TokenType.RPAREN,
+    '[': TokenType.LBRACKET,
+    ']': TokenType.RBRACKET,
+    '{': TokenType.LBRACE,
+    '}': TokenType.RBRACE,
+    '=': TokenType.ASSIGN,
+    '==': TokenType.EQUAL,
+    '<': TokenType.LESS,
+    '<=': TokenType.LESS_EQ,
+    '>': TokenType.GREATER,
+    '>=': TokenType.GREATER_EQ,
+    '!=': TokenType.NOT_EQUAL,
+}
+
+# reserved words and literal values
+KEYWORDS = {
+    'null': TokenType.NULL_VAL,
+    'true': TokenType.BOOL_VAL,
+    'false': TokenType.BOOL_VAL,
+    'string': TokenType.STRING_TYPE,
+    'int': TokenType.INT_TYPE,
+    'bool': TokenType.BOOL_TYPE,
+    'double': TokenType.DOUBLE_TYPE,
+    'void': TokenType.VOID_TYPE,
+    'and': TokenType.AND,
+    'or': TokenType.OR,
+    'not': TokenType.NOT,
+    'if': TokenType.IF,
+    'elseif': TokenType.ELSEIF,
+    'else': TokenType.ELSE,
+    'while': TokenType.WHILE,
+    'for': TokenType.FOR,
+    'return': TokenType.RETURN,
+    'struct': TokenType.STRUCT,
+    'array': TokenType.ARRAY,
+    'dict': TokenType.DICT,
+    'new': TokenType.NEW,
+}
 
 
 class Lexer:
@@ -23,17 +104,40 @@ class Lexer:
         self.in_stream = in_stream
         self.line = 1
         self.column = 0
+        # the input (read on the first call to next_token) and the
+        # position of the next character to scan
+        self.text = None
+        self.pos = 0
+
+
+    def buffer(self):
+        """Returns the whole input, reading it from the stream if needed.
+        For a memory-mapped stream this is the mapped bytes."""
+        if self.text is None:
+            self.text = getattr(self.in_stream, 'data', None)
+            if self.text is None:
+                self.text = getattr(self.in_stream, 'text', None)
+            if self.text is None:
+                self.text = ''.join(iter(self.in_stream.read_char, ''))
+            else:
+                self.pos = self.in_stream.pos
+        return self.text
 
 
     def read(self):
         """Returns and removes one character from the input stream."""
+        ch = self.peek()
         self.column += 1
-        return self.in_stream.read_char()
+        self.pos += len(ch) if isinstance(self.text, str) else len(ch.encode('utf-8'))
+        return ch
 
     
     def peek(self):
         """Returns but doesn't remove one character from the input stream."""
-        return self.in_stream.peek_char()
+        text = self.buffer()
+        if isinstance(text, str):
+            return text[self.pos:self.pos+1]
+        return text[self.pos:self.pos + char_size(text, self.pos)].decode('utf-8')
 
     
     def eof(self, ch):
@@ -45,259 +149,287 @@ class Lexer:
         raise LexerError(f'{message} at line {line}, column {column}')
 
     
+    def tokens(self, comments=False):
+        """Yields each token in the lexer's input stream, up to and
+        including the end-of-stream token.
+
+        Args:
+            comments -- If True, comment tokens are included.
+
+        """
+        while True:
+            token = self.next_token()
+            if token.token_type == TokenType.COMMENT and not comments:
+                continue
+            yield token
+            if token.token_type == TokenType.EOS:
+                return
+
+
     def next_token(self):
         """Return the next token in the lexer's input stream."""
-        # initialize
-        ch = self.read()
-        # new line or space
-        if ch.isspace():
-            if ch == "\n":
-                self.line += 1
-                self.column = 0
-            return self.next_token()
-        # dot
-        elif ch == ".":
-            return Token(TokenType.DOT, ".", self.line, self.column)
-        # end of file
-        elif self.eof(ch):
-            return Token(TokenType.EOS, '', self.line, self.column)
-        # semicolon
-        elif ch == ";":
-            return Token(TokenType.SEMICOLON, ";", self.line, self.column)
-        # comments
-        elif ch == "/" and self.peek() == "/":
-            temp_col = self.column
-            ch = " "
-            self.read()
-            self.read()
-            n = self.peek()
-            while not(self.eof(n)):
-                if n == "\n":
-                    break
-                ch = ch + self.read()
-                n = self.peek()
-            return Token(TokenType.COMMENT, ch, self.line, temp_col)
-        # comma
-        elif ch == ",":
-            return Token(TokenType.COMMA, ",", self.line, self.column)
-        # plus
-        elif ch == "+":
-            return Token(TokenType.PLUS, "+", self.line, self.column)
-        # minus
-        elif ch == "-":
-            return Token(TokenType.MINUS, "-", self.line, self.column)
-        # times
-        elif ch == "*":
-            return Token(TokenType.TIMES, "*", self.line, self.column)
-        # divide
-        elif ch == "/":
-            return Token(TokenType.DIVIDE, "/", self.line, self.column)
-        # left paren
-        elif ch == "(":
-            return Token(TokenType.LPAREN, "(", self.line, self.column)
-        # r paren
-        elif ch == ")":
-            return Token(TokenType.RPAREN, ")", self.line, self.column)
-        # l bracket
-        elif ch == "[":
-            return Token(TokenType.LBRACKET, "[", self.line, self.column)
-        # r bracket
-        elif ch == "]":
-            return Token(TokenType.RBRACKET, "]", self.line, self.column)
-        # l cbrace
-        elif ch == "{":
-            return Token(TokenType.LBRACE, "{", self.line, self.column)
-        # r cbrace
-        elif ch == "}":
-            return Token(TokenType.RBRACE, "}", self.line, self.column)
-        # assign
-        elif ch == "=":
-            if self.peek() == "=":
-                t_col = self.column
-                self.read()
-                return Token(TokenType.EQUAL, "==", self.line, t_col)
-            else:
-                return Token(TokenType.ASSIGN, "=", self.line, self.column)
-        # less than
-        elif ch == "<":
-            if self.peek() == "=":
-                t_col = self.column
-                self.read()
-                return Token(TokenType.LESS_EQ, "<=", self.line, t_col)
-            else:
-                return Token(TokenType.LESS, "<", self.line, self.column)
-        # greater than
-        elif ch == ">":
-            if self.peek() == "=":
-                t_col = self.column
-                self.read()
-                return Token(TokenType.GREATER_EQ, ">=", self.line, t_col)
-            else:
-                return Token(TokenType.GREATER, ">", self.line, self.column)
-        # check for not equal
-        elif ch == "!":
-            t_col = self.column
-            if self.peek() == "=":
-                self.read()
-                return Token(TokenType.NOT_EQUAL, "!=", self.line, t_col)
-            else:
-                self.error("LexerError: Invalid Use of !", self.line, t_col)
-        # string vals
-        elif ch == "\"":
-            t = self.column
-            end_check = True
-            n = self.peek()
-            
-            if n == ch:
-                self.read()
-                return Token(TokenType.STRING_VAL, "", self.line, t)
-            else:
-                ch = self.read()
-                n = self.peek()
-
-                while n != "\"" or self.eof(n):
-                    if n == "\n":
-                        end_check = False
-                    ch += self.read()
-                    n = self.peek()
-                self.read()
-                if end_check:
-                    return Token(TokenType.STRING_VAL, ch, self.line, t)
-                else:
-                    self.error("MyPLError: No Endquotes", self.line, t)
-        # digits
-        elif ch.isdecimal():
-            type = TokenType.INT_VAL
-            n = self.peek()
-            t = self.column
-            if ch == "0" and n.isdigit():
-                self.error("LexerError: Leading Zero", self.line, t)
-            check = False
-            while n.isdecimal() or n == ".":
-                if n == "." and not(check):
-                    check = True
-                    type = TokenType.DOUBLE_VAL
-                    ch += self.read()
-                    n = self.peek()
-                    if n.isspace() or n == "":
-                        self.error("LexerError: trailing decimal", self.line, t)
-                        break
-                elif n == "." and check: 
-                    break
-                else:
-                    ch += self.read()
-                    n = self.peek()
-            if n.isalpha():
-                self.error("LexerError: Invalid Number", self.line, t)
-            return Token(type, ch, self.line, t)
-        # keywords
-        elif ch.isalpha():  
-            n = self.peek()
-            t = self.column
-            while not(self.eof(n)):
-                # end of read
-                if n.isspace() or n == "(" or n == ")" or n == "=" or n == "," or n == '[' or n == ']' or n == '.' or n == '+' or n == '-' or n == '*' or n == '/' or n == '\n':
-                    break
-                # check ;
-                elif ch == ";":
-                    self.error("Lexer Error")
-                # null
-                elif ch == "null" and n.isspace():
-                    return Token(TokenType.NULL_VAL, ch, self.line, t)
-                # bool vals
-                elif ch == "true" or ch == "false":
-                    return Token(TokenType.BOOL_VAL, ch, self.line, t)
-                # string type
-                elif ch == "string" and (n.isspace() or n == "["):
-                    return Token(TokenType.STRING_TYPE, ch, self.line, t)
-                # int type
-                elif ch == "int" and (n.isspace() or n == "["):
-                    return Token(TokenType.INT_TYPE, ch, self.line, t)
-                # bool type
-                elif ch == "bool" and (n.isspace() or n == "["):
-                    return Token(TokenType.BOOL_TYPE, ch, self.line, t)
-                # double type
-                elif ch == "double" and (n.isspace() or n == "["):
-                    return Token(TokenType.DOUBLE_TYPE, ch, self.line, t)
-                # void
-                elif ch == "void" and n.isspace():
-                    return Token(TokenType.VOID_TYPE, ch, self.line, t)
-                # and
-                elif ch == "and" and n.isspace():
-                    return Token(TokenType.AND, ch, self.line, t)
-                # not
-                elif ch == "not" and n.isspace():
-                    return Token(TokenType.NOT, ch, self.line, t)
-                # or
-                elif ch == "or" and n.isspace():
-                    return Token(TokenType.OR, ch, self.line, t)
-                # if
-                elif ch == "if" and (n.isspace() or n == "("):
-                    return Token(TokenType.IF, ch, self.line, t)
-                # else
-                elif ch == "else":
-                    #elseif
-                    if n == "i":
-                        ch += self.read()
-                        if self.peek() == "f":
-                            ch += self.read()
-                            return Token(TokenType.ELSEIF, ch, self.line, t)
-                    return Token(TokenType.ELSE, ch, self.line, t)
-                # while
-                elif ch == "while" and (n.isspace() or n == "("):
-                    return Token(TokenType.WHILE, ch, self.line, t)
-                # for
-                elif ch == "for" and (n.isspace() or n == "("):
-                    return Token(TokenType.FOR, ch, self.line, t)
-                # return
-                elif ch == "return" and n.isspace():
-                    return Token(TokenType.RETURN, ch, self.line, t)
-                # struct
-                elif ch == "struct" and n.isspace():
-                    return Token(TokenType.STRUCT, ch, self.line, t)
-                # array
-                elif ch == "array" and n.isspace():
-                    return Token(TokenType.ARRAY, ch, self.line, t)
-                elif ch == "dict" and n.isspace():
-                    return Token(TokenType.DICT, ch, self.line, t)
-                # new
-                elif ch == "new" and n.isspace():
-                    return Token(TokenType.NEW, ch, self.line, t)
-                # check ids
-                elif n == "<" or n == ">" or n == "=" or n == ";":
-                    if ch == "null":
-                        return Token(TokenType.NULL_VAL, ch, self.line, t)
-                    return Token(TokenType.ID, ch ,self.line, t)
-                ch += self.read()
-                n = self.peek()
-            dict = {
-                "null": TokenType.NULL_VAL,
-                "true": TokenType.BOOL_VAL,
-                "false": TokenType.BOOL_VAL,
-                "string": TokenType.STRING_TYPE,
-                "int": TokenType.INT_TYPE,
-                "bool": TokenType.BOOL_TYPE,
-                "double": TokenType.DOUBLE_TYPE,
-                "void": TokenType.VOID_TYPE,
-                "and": TokenType.AND,
-                "if": TokenType.IF,
-                "else": TokenType.ELSE,
-                "elseif": TokenType.ELSEIF,
-                "and": TokenType.AND,
-                "not": TokenType.NOT,
-                "or": TokenType.OR,
-                "while": TokenType.WHILE,
-                "for": TokenType.FOR,
-                "return": TokenType.RETURN,
-                "struct": TokenType.STRUCT,
-                "array": TokenType.ARRAY,
-                "new": TokenType.NEW,
-                "dict": TokenType.DICT
-            }
-            try:
-                return Token(dict[ch], ch, self.line, t)
-            # ID
-            except:
-                return Token(TokenType.ID, ch, self.line, t)
+        text = self.buffer()
+        if isinstance(text, str):
+            return self.scan_text(text)
+        return self.scan_bytes(text)
+
+
+    def skip_space(self, space):
+        """Moves the line and column past whitespace."""
+        newlines = space.count('\n')
+        if newlines:
+            self.line += newlines
+            self.column = len(space) - space.rindex('\n') - 1
+        else:
+            self.column += len(space)
+
+
+    def end_token(self, start):
+        """Returns the end-of-stream token (which still counts as a
+        column)."""
+        self.pos = start
+        self.column += 1
+        return Token(TokenType.EOS, '', self.line, self.column)
+
+
+    def scan_text(self, text):
+        """Returns the next token of input held in a string."""
+        m = TOKEN_RE.match(text, self.pos)
+        self.skip_space(m.group('space'))
+        kind = m.lastgroup
+        start = m.end('space')
+        column = self.column + 1
+        if kind == 'space':
+            return self.end_token(start)
+        lexeme = m.group(kind)
+        if kind == 'comment':
+            # the character after the // is skipped (even a newline)
+            body_start = min(start + 3, len(text))
+            end = text.find('\n', body_start)
+            if end < 0:
+                end = len(text)
+            self.pos = end
+            self.column += 3 + end - body_start
+            return Token(TokenType.COMMENT, ' ' + text[body_start:end], self.line, column)
+        if kind == 'string':
+            # the first character is part of the string even if it is a quote
+            end = text.find('"', start + 1)
+            lexeme = text[start:end+1] if end >= 0 else text[start:]
+        after = text[m.end():m.end()+1]
+        kind, lexeme, token = self.classify(kind, lexeme, after, column)
+        self.pos = start + len(lexeme)
+        self.column += len(lexeme)
+        return self.emit(kind, lexeme, after, column, token)
+
+
+    def scan_bytes(self, data):
+        """Returns the next token of UTF-8 input held in a bytes-like
+        object (such as a memory-mapped file), decoding just the token.
+
+        Words, numbers, and whitespace made of ASCII characters are
+        scanned in place. Ones with other characters are scanned from the
+        decoded rest of their line. Lines end with \\n or \\r\\n (which,
+        as in text mode, is one character in comments and strings).
+
+        """
+        while True:
+            m = BYTES_TOKEN_RE.match(data, self.pos)
+            kind = m.lastgroup
+            start = m.end('space')
+            if m.group('space'):
+                self.skip_space(m.group('space').decode('ascii'))
+            self.pos = start
+            stop = m.end()
+            if (kind == 'other' and data[start] >= 0x80 or
+                    kind in ('word', 'number') and stop < len(data) and data[stop] >= 0x80):
+                end = data.find(b'\n', start)
+                line = data[start:len(data) if end < 0 else end + 1].decode('utf-8')
+                space = SPACE_RE.match(line).group()
+                if space:
+                    self.skip_space(space)
+                    self.pos = start + len(space.encode('utf-8'))
+                    continue
+                # the rest of the line (with its newline) holds the token
+                # and the character after it
+                self.pos = 0
+                try:
+                    return self.scan_text(line)
+                finally:
+                    self.pos = start + len(line[:self.pos].encode('utf-8'))
+            break
+        column = self.column + 1
+        if kind == 'space':
+            return self.end_token(start)
+        if kind == 'comment':
+            body_start = start + 2
+            if data[body_start:body_start+2] == b'\r\n':
+                body_start += 2
+            elif body_start < len(data):
+                body_start += char_size(data, body_start)
+            end = data.find(b'\n', body_start)
+            if end < 0:
+                end = len(data)
+            body = data[body_start:end].decode('utf-8')
+            if body.endswith('\r') and end < len(data):
+                body = body[:-1]
+            self.pos = end
+            self.column += 3 + len(body)
+            return Token(TokenType.COMMENT, ' ' + body, self.line, column)
+        if kind == 'string':
+            end = data.find(b'"', start + 1)
+            raw = data[start:end+1] if end >= 0 else data[start:]
+            lexeme = raw.decode('utf-8').replace('\r\n', '\n')
         else:
-            self.error("LexerError: Invalid Symbol", self.line, self.column)
\ No newline at end of file
+            lexeme = m.group(kind).decode('ascii')
+        after = chr(data[stop]) if stop < len(data) else ''
+        kind, lexeme, token = self.classify(kind, lexeme, after, column)
+        self.pos = start + (len(raw) if kind == 'string' else len(lexeme))
+        self.column += len(lexeme)
+        return self.emit(kind, lexeme, after, column, token)
+
+
+    def classify(self, kind, lexeme, after, column):
+        """Returns the kind, lexeme, and (for a word) token of the
+        characters the next token or error consumes.
+
+        Args:
+            kind -- The group of the token expression that matched.
+            lexeme -- The matched characters.
+            after -- The character after the match ('' at end of file).
+            column -- The column of the first character.
+
+        """
+        token = None
+        if kind == 'word':
+            if not lexeme[0].isalpha():
+                return 'other', lexeme[0], None
+            token = self.word_token(lexeme, after, column)
+            lexeme = token.lexeme
+        # errors are reported after the bad characters are consumed
+        elif kind == 'number' and lexeme[0] == '0' and (lexeme[1:2] or after).isdigit():
+            return 'leading zero', '0', None
+        return kind, lexeme, token
+
+
+    def emit(self, kind, lexeme, after, column, token=None):
+        """Returns the token (or raises the error) for the consumed
+        characters of the next token, with arguments as for classify
+        (and the word token it returned)."""
+        if kind == 'symbol':
+            return Token(SYMBOLS[lexeme], lexeme, self.line, column)
+        elif kind == 'word':
+            return token
+        elif kind == 'string':
+            if len(lexeme) < 2 or lexeme[-1] != '"' or '\n' in lexeme[2:]:
+                self.error("MyPLError: No Endquotes", self.line, column)
+            return Token(TokenType.STRING_VAL, lexeme[1:-1], self.line, column)
+        elif kind == 'number':
+            return self.number_token(lexeme, after, column)
+        elif kind == 'leading zero':
+            self.error("LexerError: Leading Zero", self.line, column)
+        elif lexeme == '!':
+            self.error("LexerError: Invalid Use of !", self.line, column)
+        self.error("LexerError: Invalid Symbol", self.line, column)
+
+
+    def number_token(self, lexeme, after, column):
+        """Returns the int or double token for a number, checking that it
+        doesn't end in a decimal point or run into a letter.
+
+        Args:
+            lexeme -- The digits (and decimal point) of the number.
+            after -- The character after the number ('' at end of file).
+            column -- The column of the number's first digit.
+
+        """
+        if lexeme[-1] == "." and (after.isspace() or after == ""):
+            self.error("LexerError: trailing decimal", self.line, column)
+        if after.isalpha():
+            self.error("LexerError: Invalid Number", self.line, column)
+        token_type = TokenType.DOUBLE_VAL if "." in lexeme else TokenType.INT_VAL
+        return Token(token_type, lexeme, self.line, column)
+
+
+    def word_token(self, word, after, column):
+        """Returns the reserved word, value, or identifier token at the
+        start of a word.
+
+        Words starting with true, false, or else end after those letters
+        (with elsei and elseif both else tokens), and a word followed by
+        <, >, or ; is an identifier (or null) even if it is a reserved
+        word.
+
+        Args:
+            word -- The letters up to the next delimiter.
+            after -- The character after the word ('' at end of file).
+            column -- The column of the word's first letter.
+
+        """
+        for prefix in ("true", "false"):
+            if word.startswith(prefix):
+                return Token(TokenType.BOOL_VAL, prefix, self.line, column)
+        if word.startswith("else"):
+            if word[4:6] == "if":
+                return Token(TokenType.ELSEIF, "elseif", self.line, column)
+            return Token(TokenType.ELSE, word[:5] if word[4:5] == "i" else "else", self.line, column)
+        if after and after in "<>;":
+            if word == "null":
+                return Token(TokenType.NULL_VAL, "null", self.line, column)
+            return Token(TokenType.ID, sys.intern(word), self.line, column)
+        return Token(KEYWORDS.get(word, TokenType.ID), sys.intern(word), self.line, column)
+
+
+
+class TokenStream:
+    """A stream of tokens with a fixed number of tokens of lookahead,
+    held in a ring buffer."""
+
+    def __init__(self, tokens, lookahead=2):
+        """Create a stream over the tokens from a token generator (such
+        as Lexer.tokens()).
+
+        Args:
+            tokens -- The token iterator, ending with the end-of-stream token.
+            lookahead -- The number of tokens that can be peeked at.
+
+        """
+        self.tokens = tokens
+        self.buffer = [None] * lookahead
+        # index in the buffer of the next token and the number buffered
+        self.start = 0
+        self.count = 0
+        # returned again once the tokens run out
+        self.last = None
+
+
+    def fill(self, count):
+        """Reads tokens until count are buffered."""
+        size = len(self.buffer)
+        while self.count < count:
+            token = next(self.tokens, self.last)
+            self.last = token
+            self.buffer[(self.start + self.count) % size] = token
+            self.count += 1
+
+
+    def peek(self, offset=0):
+        """Returns but doesn't remove a token from the stream.
+
+        Args:
+            offset -- The number of tokens ahead of the next token.
+
+        """
+        if offset >= len(self.buffer):
+            raise IndexError(f'can only look {len(self.buffer)} tokens ahead')
+        self.fill(offset + 1)
+        return self.buffer[(self.start + offset) % len(self.buffer)]
+
+
+    def next(self):
+        """Returns and removes the next token from the stream."""
+        self.fill(1)
+        token = self.buffer[self.start]
+        self.buffer[self.start] = None
+        self.start = (self.start + 1) % len(self.buffer)
+        self.count -= 1
+        return token
@@ -34,6 +34,7 @@ OpCode = Enum('OpCode', [
     # jump and branch
     'JMP',     # jump to given instruction offset A
     'JMPF',    # pop x, if x is False jump to instruction offset A
+    'JMPT',    # pop x, if x is True jump to instruction offset A
 
     # functions
     'CALL',    # call function A (pop and push arguments)
@@ -47,6 +48,7 @@ OpCode = Enum('OpCode', [
     'TOINT',   # pop x, push int(x)
     'TODBL',   # pop x, push double(x)
     'TOSTR',   # pop x, push str(x)
+    'NATIVE',  # pop arguments, call native function A, push any result
 
     # heap
     'ALLOCS',  # allocate struct object, push oid x
@@ -55,6 +57,8 @@ OpCode = Enum('OpCode', [
     'ALLOCA',  # pop int x, allocate array object with x None values, push oid
     'SETI',    # pop value x, pop index y, pop oid z, set array obj(z)[y] = x
     'GETI',    # pop index x, pop oid y, push obj(y)[x] onto stack
+    'SETIU',   # SETI for an index known to be in bounds (no checks)
+    'GETIU',   # GETI for an index known to be in bounds (no checks)
     'ALLOCD',  # allocate dict object, push oid x
     'SETD',    # pop value x, pop key val, pop oid y, set obj(y)[A] = x
     'GETD',    # pop key, pop oid y, push obj(y)[x] onto stack
@@ -0,0 +1,964 @@
+"""Optimization analyses and passes used during MyPL code generation.
+
+NAME: George Calvert
+DATE: Spring 2024
+CLASS: CPSC 326
+
+"""
+
+import copy
+from types import GeneratorType
+from mypl_token import *
+from mypl_ast import *
+from mypl_builtins import BUILT_INS
+
+
+# loops with more iterations than this are never unrolled
+MAX_UNROLL_TRIPS = 32
+
+# default code size budget (in AST nodes) for a fully unrolled loop
+UNROLL_BUDGET = 512
+
+# largest function body (in AST nodes) inlined at a hot call site
+INLINE_BUDGET = 64
+
+# a call site is hot if it ran at least this many times and at least
+# this fraction of the times the hottest call site ran
+HOT_CALL_MIN = 2
+HOT_CALL_FRACTION = 0.1
+
+# if/elseif arms whose test was true at most this fraction of the time
+# are moved out of the fall-through path
+COLD_BRANCH_RATIO = 0.2
+
+# most instructions run to evaluate a call at compile time
+PARTIAL_EVAL_BUDGET = 100000
+
+
+#----------------------------------------------------------------------
+# AST helpers
+#----------------------------------------------------------------------
+
+def children(node):
+    """Returns the child nodes of an AST node (statements, expressions,
+    and variable references; types and tokens are not included).
+
+    """
+    kids = []
+    if isinstance(node, Program):
+        kids = node.struct_defs + node.fun_defs
+    elif isinstance(node, FunDef):
+        kids = list(node.stmts)
+    elif isinstance(node, VarDecl):
+        kids = [node.expr]
+    elif isinstance(node, AssignStmt):
+        kids = node.lvalue + [node.expr]
+    elif isinstance(node, ReturnStmt):
+        kids = [node.expr]
+    elif isinstance(node, WhileStmt):
+        kids = [node.condition] + node.stmts
+    elif isinstance(node, ForStmt):
+        kids = [node.var_decl, node.condition, node.assign_stmt] + node.stmts
+    elif isinstance(node, IfStmt):
+        kids = [node.if_part] + node.else_ifs + node.else_stmts
+    elif isinstance(node, BasicIf):
+        kids = [node.condition] + node.stmts
+    elif isinstance(node, CallExpr):
+        kids = list(node.args)
+    elif isinstance(node, Expr):
+        kids = [node.first, node.rest]
+    elif isinstance(node, SimpleTerm):
+        kids = [node.rvalue]
+    elif isinstance(node, ComplexTerm):
+        kids = [node.expr]
+    elif isinstance(node, NewRValue):
+        kids = [node.array_expr] + node.struct_params
+    elif isinstance(node, VarRValue):
+        kids = list(node.path)
+    elif isinstance(node, VarRef):
+        kids = [node.array_expr]
+    return [kid for kid in kids if kid is not None]
+
+
+def walk_nodes(node):
+    """Yields the node and all of its descendants (preorder)."""
+    stack = [node]
+    while stack:
+        curr = stack.pop()
+        yield curr
+        stack.extend(reversed(children(curr)))
+
+
+def node_count(nodes):
+    """Returns the number of AST nodes in the given list of nodes."""
+    return sum(1 for node in nodes for _ in walk_nodes(node))
+
+
+def simple_var_name(node):
+    """Returns the variable name if the expression is just a (non-indexed,
+    non-path) variable, otherwise None.
+
+    """
+    while isinstance(node, (Expr, ComplexTerm, SimpleTerm)):
+        if isinstance(node, Expr):
+            if node.op or node.not_op:
+                return None
+            node = node.first
+        elif isinstance(node, ComplexTerm):
+            node = node.expr
+        else:
+            node = node.rvalue
+    if isinstance(node, VarRValue) and len(node.path) == 1 and not node.path[0].array_expr:
+        return node.path[0].var_name.lexeme
+    return None
+
+
+def call_of(expr):
+    """Returns the CallExpr if the expression is just a function call,
+    otherwise None.
+
+    """
+    if isinstance(expr, Expr) and not expr.op and not expr.not_op:
+        if isinstance(expr.first, SimpleTerm) and isinstance(expr.first.rvalue, CallExpr):
+            return expr.first.rvalue
+    return None
+
+
+#----------------------------------------------------------------------
+# Constant folding
+#----------------------------------------------------------------------
+
+# returned by const_value for expressions that aren't compile-time constants
+NOT_CONSTANT = object()
+
+
+def literal_value(token):
+    """Returns the VM value of a literal value token."""
+    val = token.lexeme
+    if token.token_type == TokenType.INT_VAL:
+        return int(val)
+    elif token.token_type == TokenType.DOUBLE_VAL:
+        return float(val)
+    elif token.token_type == TokenType.STRING_VAL:
+        val = val.replace('\\n', '\n')
+        val = val.replace('\\t', '\t')
+        return val
+    elif val == 'true':
+        return True
+    elif val == 'false':
+        return False
+    return None
+
+
+def fold_op(op_type, y, x):
+    """Applies a binary operator to constant operands y and x the way the
+    VM would, returning NOT_CONSTANT if the VM would raise an error (the
+    error is then left to happen at run time).
+
+    """
+    ty, tx = type(y), type(x)
+    if op_type in (TokenType.EQUAL, TokenType.NOT_EQUAL):
+        return (y == x) if op_type == TokenType.EQUAL else (y != x)
+    if op_type in (TokenType.AND, TokenType.OR):
+        if tx != bool or ty != bool:
+            return NOT_CONSTANT
+        return (y and x) if op_type == TokenType.AND else (y or x)
+    if tx != ty or tx not in (int, float, str):
+        return NOT_CONSTANT
+    if op_type == TokenType.PLUS:
+        return y + x
+    elif op_type == TokenType.LESS:
+        return y < x
+    elif op_type == TokenType.LESS_EQ:
+        return y <= x
+    elif op_type == TokenType.GREATER:
+        return y > x
+    elif op_type == TokenType.GREATER_EQ:
+        return y >= x
+    if tx == str:
+        return NOT_CONSTANT
+    if op_type == TokenType.MINUS:
+        return y - x
+    elif op_type == TokenType.TIMES:
+        return y * x
+    elif op_type == TokenType.DIVIDE and x != 0:
+        return y // x if tx == int else y / x
+    return NOT_CONSTANT
+
+
+def const_value(node, memo=None):
+    """Returns the compile-time value of an expression made only of
+    literals and operators, or NOT_CONSTANT.
+
+    Args:
+        node -- An Expr, ExprTerm, or RValue node.
+        memo -- Optional dictionary from id(Expr) to (Expr, value) for
+                the expressions already evaluated, shared across calls
+                so that evaluating each part of an expression in turn
+                takes linear time.
+
+    """
+    val = const_part(node, memo)
+    return evaluate(val) if type(val) is GeneratorType else val
+
+
+def const_part(node, memo):
+    """Returns the value of a node for const_value, or a generator that
+    computes it (run by evaluate, so deeply nested expressions don't
+    overflow the call stack) if the node is an Expr not in the memo."""
+    while isinstance(node, (SimpleTerm, ComplexTerm)):
+        node = node.rvalue if isinstance(node, SimpleTerm) else node.expr
+    if isinstance(node, Expr):
+        if memo is not None and id(node) in memo:
+            return memo[id(node)][1]
+        return fold_const(node, memo)
+    elif isinstance(node, SimpleRValue):
+        return literal_value(node.value)
+    return NOT_CONSTANT
+
+
+def fold_const(expr, memo):
+    """Generator for the value of an Expr (see const_part)."""
+    val = const_part(expr.first, memo)
+    if type(val) is GeneratorType:
+        val = yield val
+    if val is not NOT_CONSTANT and expr.op:
+        rest = const_part(expr.rest, memo)
+        if type(rest) is GeneratorType:
+            rest = yield rest
+        val = NOT_CONSTANT if rest is NOT_CONSTANT else fold_op(expr.op.token_type, val, rest)
+    if expr.not_op and val is not NOT_CONSTANT:
+        val = (not val) if type(val) == bool else NOT_CONSTANT
+    if memo is not None:
+        memo[id(expr)] = (expr, val)
+    return val
+
+
+#----------------------------------------------------------------------
+# Loop unrolling
+#----------------------------------------------------------------------
+
+def assigned_or_declared(stmts, name):
+    """True if a variable with the given name is assigned to (as a whole)
+    or declared anywhere within the statements.
+
+    """
+    for node in (n for stmt in stmts for n in walk_nodes(stmt)):
+        if isinstance(node, AssignStmt) and node.lvalue[0].var_name.lexeme == name:
+            return True
+        if isinstance(node, VarDecl) and node.var_def.var_name.lexeme == name:
+            return True
+    return False
+
+
+def substitute_var(stmts, name, value):
+    """Replaces every plain use of the variable with an int literal (at
+    the same source position), in place.
+
+    """
+    for node in (n for stmt in stmts for n in walk_nodes(stmt)):
+        if isinstance(node, SimpleTerm) and simple_var_name(node) == name:
+            ref = node.rvalue.path[0].var_name
+            token = Token(TokenType.INT_VAL, str(value), ref.line, ref.column)
+            node.rvalue = SimpleRValue(token)
+
+
+def unroll_for(for_stmt, budget=UNROLL_BUDGET):
+    """Unrolls a for loop with a constant trip count.
+
+    The loop must declare an int variable initialized to a constant,
+    compare it against a constant, step it by a constant, and never
+    assign or redeclare it in the body. The body can't contain other
+    loops and the unrolled code must fit in the code size budget.
+
+    Args:
+        for_stmt -- The ForStmt to unroll.
+        budget -- The maximum number of AST nodes in the unrolled body.
+
+    Returns: A list containing a copy of the loop body for each iteration
+    (with the loop variable replaced by its constant value), or None if
+    the loop can't be unrolled.
+
+    """
+    var_def = for_stmt.var_decl.var_def
+    name = var_def.var_name.lexeme
+    if var_def.data_type.is_array or var_def.data_type.type_name.token_type != TokenType.INT_TYPE:
+        return None
+    if not for_stmt.var_decl.expr:
+        return None
+    start = const_value(for_stmt.var_decl.expr)
+    # condition: var <op> constant
+    cond = for_stmt.condition
+    if cond.not_op or not cond.op or simple_var_name(cond.first) != name:
+        return None
+    bound = const_value(cond.rest)
+    # step: var = var (+|-) constant
+    assign = for_stmt.assign_stmt
+    step_expr = assign.expr
+    if len(assign.lvalue) != 1 or assign.lvalue[0].array_expr or assign.lvalue[0].var_name.lexeme != name:
+        return None
+    if step_expr.not_op or not step_expr.op or simple_var_name(step_expr.first) != name:
+        return None
+    if step_expr.op.token_type not in (TokenType.PLUS, TokenType.MINUS):
+        return None
+    step = const_value(step_expr.rest)
+    if type(start) != int or type(bound) != int or type(step) != int:
+        return None
+    # find the induction values
+    values = []
+    val = start
+    while True:
+        test = fold_op(cond.op.token_type, val, bound)
+        if type(test) != bool:
+            return None
+        if not test:
+            break
+        values.append(val)
+        if len(values) > MAX_UNROLL_TRIPS:
+            return None
+        val = fold_op(step_expr.op.token_type, val, step)
+    # only innermost loops (so nested unrolling can't multiply code size),
+    # stopping at the budget so the bodies of nested loops aren't walked
+    # once per enclosing loop
+    size = 0
+    for node in (n for stmt in for_stmt.stmts for n in walk_nodes(stmt)):
+        if isinstance(node, (WhileStmt, ForStmt)):
+            return None
+        size += len(values)
+        if size > budget:
+            return None
+    if assigned_or_declared(for_stmt.stmts, name):
+        return None
+    # copy the body for each iteration
+    # the copies keep referring to the original declarations (which are
+    # given a new index each time a copy declares them)
+    var_defs = {id(node.var_def): node.var_def
+                for stmt in for_stmt.stmts for node in walk_nodes(stmt)
+                if isinstance(node, VarRef) and node.var_def is not None}
+    copies = []
+    for val in values:
+        body = copy.deepcopy(for_stmt.stmts, dict(var_defs))
+        substitute_var(body, name, val)
+        copies.append(body)
+    return copies
+
+
+#----------------------------------------------------------------------
+# Range analysis
+#----------------------------------------------------------------------
+
+def bounded_index(for_stmt):
+    """Finds an array that a for loop's variable always indexes in bounds.
+
+    The loop must declare an int variable initialized to a non-negative
+    constant, test 'var < length(arr)' for an array variable arr, step
+    the variable by adding a positive constant, and never assign or
+    redeclare either variable in the body (array elements can be set).
+    Inside the body (arrays never change size) arr[var] is then always
+    a valid index.
+
+    Args:
+        for_stmt -- The ForStmt to analyze.
+
+    Returns: The (array name, variable name) pair, or None.
+
+    """
+    var_def = for_stmt.var_decl.var_def
+    name = var_def.var_name.lexeme
+    if var_def.data_type.is_array or var_def.data_type.type_name.token_type != TokenType.INT_TYPE:
+        return None
+    start = const_value(for_stmt.var_decl.expr) if for_stmt.var_decl.expr else None
+    if type(start) != int or start < 0:
+        return None
+    # condition: var < length(arr)
+    cond = for_stmt.condition
+    if cond.not_op or not cond.op or cond.op.token_type != TokenType.LESS:
+        return None
+    call = call_of(cond.rest)
+    if simple_var_name(cond.first) != name or not call or call.fun_name.lexeme != 'length':
+        return None
+    arr = simple_var_name(call.args[0]) if len(call.args) == 1 else None
+    if arr is None or arr == name:
+        return None
+    # step: var = var + positive constant
+    assign = for_stmt.assign_stmt
+    step_expr = assign.expr
+    if len(assign.lvalue) != 1 or assign.lvalue[0].array_expr or assign.lvalue[0].var_name.lexeme != name:
+        return None
+    if step_expr.not_op or not step_expr.op or step_expr.op.token_type != TokenType.PLUS:
+        return None
+    step = const_value(step_expr.rest)
+    if simple_var_name(step_expr.first) != name or type(step) != int or step <= 0:
+        return None
+    if assigned_or_declared(for_stmt.stmts, name):
+        return None
+    for node in (n for stmt in for_stmt.stmts for n in walk_nodes(stmt)):
+        if isinstance(node, AssignStmt) and len(node.lvalue) == 1 and not node.lvalue[0].array_expr \
+           and node.lvalue[0].var_name.lexeme == arr:
+            return None
+        if isinstance(node, VarDecl) and node.var_def.var_name.lexeme == arr:
+            return None
+    return arr, name
+
+
+#----------------------------------------------------------------------
+# Common subexpression elimination (CSE)
+#----------------------------------------------------------------------
+
+# statements that never transfer control, so a run of them forms a
+# basic block
+SIMPLE_STMTS = (VarDecl, AssignStmt, CallExpr, ReturnStmt)
+
+
+def expr_key(node, memo=None):
+    """Returns a hashable key describing the value computed by a
+    side-effect-free expression, or None if the expression (or any part
+    of it) may have side effects or allocate.
+
+    Args:
+        node -- An Expr, ExprTerm, or RValue node.
+        memo -- Optional dictionary from id(node) to (node, key) for the
+                expressions and paths already seen (see const_value),
+                which also maps each key made to itself so equal keys
+                are the same object.
+
+    """
+    key = key_part(node, memo)
+    return evaluate(key) if type(key) is GeneratorType else key
+
+
+class ExprKey(tuple):
+    """A key from expr_key. The keys of large expressions are deeply
+    nested, so a key's hash is computed once (from the already computed
+    hashes of its parts) when it is made."""
+
+    def __new__(cls, parts):
+        key = super().__new__(cls, parts)
+        key.hash = tuple.__hash__(key)
+        return key
+
+    def __hash__(self):
+        return self.hash
+
+
+def new_key(parts, memo):
+    """Returns the key made of the given parts, reusing an equal key from
+    the memo (if any) so that comparing keys with equal parts stops at
+    the parts' identity."""
+    key = ExprKey(parts)
+    if memo is None:
+        return key
+    return memo.setdefault(key, key)
+
+
+def key_part(node, memo):
+    """Returns the key of a node for expr_key, or a generator that makes
+    it (see const_part) if the node is an Expr not in the memo or a
+    path with indexes."""
+    while isinstance(node, (SimpleTerm, ComplexTerm)):
+        node = node.rvalue if isinstance(node, SimpleTerm) else node.expr
+    if memo is not None and id(node) in memo:
+        return memo[id(node)][1]
+    if isinstance(node, Expr):
+        return build_key(node, memo)
+    elif isinstance(node, SimpleRValue):
+        return new_key(('val', node.value.token_type, node.value.lexeme), memo)
+    elif isinstance(node, VarRValue):
+        if any(var_ref.array_expr for var_ref in node.path):
+            return build_path_key(node, memo)
+        key = new_key(('var', tuple((v.var_name.lexeme, ()) for v in node.path)), memo)
+        if memo is not None:
+            memo[id(node)] = (node, key)
+        return key
+    # calls and new expressions
+    return None
+
+
+def build_key(expr, memo):
+    """Generator for the key of an Expr (see key_part)."""
+    key = key_part(expr.first, memo)
+    if type(key) is GeneratorType:
+        key = yield key
+    if key is not None and expr.op:
+        rest = key_part(expr.rest, memo)
+        if type(rest) is GeneratorType:
+            rest = yield rest
+        key = None if rest is None else new_key(('op', key, expr.op.token_type, rest), memo)
+    if key is not None and expr.not_op:
+        key = new_key(('not', key), memo)
+    if memo is not None:
+        memo[id(expr)] = (expr, key)
+    return key
+
+
+def build_path_key(var_rvalue, memo):
+    """Generator for the key of a path with indexes (see key_part)."""
+    path = []
+    for var_ref in var_rvalue.path:
+        index = ()
+        if var_ref.array_expr:
+            index = key_part(var_ref.array_expr, memo)
+            if type(index) is GeneratorType:
+                index = yield index
+            if index is None:
+                return None
+        path.append((var_ref.var_name.lexeme, index))
+    key = new_key(('var', tuple(path)), memo)
+    if memo is not None:
+        memo[id(var_rvalue)] = (var_rvalue, key)
+    return key
+
+
+def key_vars(key, memo=None):
+    """Returns the set of variable names a key's value depends on.
+
+    Args:
+        key -- A key from expr_key.
+        memo -- Optional dictionary from id(key) to (key, names) for the
+                keys already seen (see const_value).
+
+    """
+    names = vars_part(key, memo)
+    return evaluate(names) if type(names) is GeneratorType else names
+
+
+def vars_part(key, memo):
+    """Returns the variable names of a key for key_vars, or a generator
+    that collects them (see const_part) if the key has parts of its own
+    and isn't in the memo."""
+    if memo is not None and id(key) in memo:
+        return memo[id(key)][1]
+    if key[0] == 'val':
+        return set()
+    if key[0] == 'var' and not any(index for name, index in key[1]):
+        return {key[1][0][0]}
+    return collect_vars(key, memo)
+
+
+def collect_vars(key, memo):
+    """Generator for the variable names of a key with parts (see
+    vars_part)."""
+    names = set()
+    if key[0] == 'var':
+        names.add(key[1][0][0])
+        parts = [index for name, index in key[1] if index]
+    elif key[0] == 'op':
+        parts = [key[1], key[3]]
+    else:
+        parts = [key[1]]
+    for part in parts:
+        part_names = vars_part(part, memo)
+        if type(part_names) is GeneratorType:
+            part_names = yield part_names
+        names |= part_names
+    if memo is not None:
+        memo[id(key)] = (key, names)
+    return names
+
+
+def key_reads_heap(key):
+    """True if computing the key's value reads a struct, array, or dict."""
+    stack = [key]
+    while stack:
+        key = stack.pop()
+        if key[0] == 'var':
+            if len(key[1]) > 1 or any(index for name, index in key[1]):
+                return True
+        elif key[0] == 'op':
+            stack += [key[1], key[3]]
+        elif key[0] == 'not':
+            stack.append(key[1])
+    return False
+
+
+def cse_candidate(node, key_memo=None, vars_memo=None):
+    """Returns the key of a node worth computing once, or None. Only nodes
+    that emit work of their own (an operator or a heap read) qualify;
+    plain variables and literals are already a single instruction.
+
+    Args:
+        node -- An AST node.
+        key_memo -- Optional memo dictionary for expr_key.
+        vars_memo -- Optional memo dictionary for key_vars.
+
+    """
+    if isinstance(node, Expr):
+        if not node.op and not node.not_op:
+            return None
+    elif isinstance(node, VarRValue):
+        if len(node.path) == 1 and not node.path[0].array_expr:
+            return None
+    else:
+        return None
+    key = expr_key(node, key_memo)
+    # constant expressions are folded instead
+    if key is None or not key_vars(key, vars_memo):
+        return None
+    return key
+
+
+def has_user_call(node):
+    """True if evaluating the node may call a user-defined or native
+    function (the only ways a statement's evaluation can write to the
+    heap).
+
+    """
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, CallExpr):
+            built_in = BUILT_INS.get(node.fun_name.lexeme)
+            if built_in is None or built_in.native is not None:
+                return True
+            stack.extend(node.args)
+        elif isinstance(node, Expr):
+            stack.append(node.first)
+            if node.op is not None:
+                stack.append(node.rest)
+        elif isinstance(node, SimpleTerm):
+            stack.append(node.rvalue)
+        elif isinstance(node, ComplexTerm):
+            stack.append(node.expr)
+        elif isinstance(node, NewRValue):
+            stack.extend(node.struct_params)
+        elif isinstance(node, VarRValue):
+            stack.extend(v.array_expr for v in node.path if v.array_expr)
+    return False
+
+
+def stmt_exprs(stmt):
+    """Returns the expressions a simple statement (or a lone expression)
+    evaluates, in evaluation order.
+
+    """
+    if isinstance(stmt, VarDecl):
+        return [stmt.expr] if stmt.expr else []
+    elif isinstance(stmt, AssignStmt):
+        indexes = [v.array_expr for v in stmt.lvalue if v.array_expr]
+        return indexes + [stmt.expr]
+    elif isinstance(stmt, CallExpr):
+        return list(stmt.args)
+    elif isinstance(stmt, ReturnStmt):
+        return [stmt.expr]
+    return [stmt]
+
+
+def stmt_effects(stmt):
+    """Returns the (killed variable names, writes heap, calls user function)
+    effects of a simple statement or expression.
+
+    """
+    if isinstance(stmt, CallExpr):
+        calls = has_user_call(stmt)
+    else:
+        calls = any(has_user_call(e) for e in stmt_exprs(stmt))
+    killed = set()
+    writes_heap = calls
+    if isinstance(stmt, VarDecl):
+        killed.add(stmt.var_def.var_name.lexeme)
+    elif isinstance(stmt, AssignStmt):
+        if len(stmt.lvalue) == 1 and not stmt.lvalue[0].array_expr:
+            killed.add(stmt.lvalue[0].var_name.lexeme)
+        else:
+            writes_heap = True
+    return killed, writes_heap, calls
+
+
+def killed_keys(keys, names, heap, vars_memo=None):
+    """Returns the keys invalidated by writes to the given variable names
+    and, if heap is True, by a write to any heap object.
+
+    """
+    return [k for k in keys if (heap and key_reads_heap(k)) or key_vars(k, vars_memo) & names]
+
+
+def plan_cse(units, effects=None):
+    """Finds the common subexpressions of a basic block.
+
+    Walks the block in evaluation order tracking which keys are still
+    valid (not killed by an assignment, declaration, heap write, or call).
+    A key occurring more than once within one valid range is shared.
+
+    Args:
+        units -- A list of simple statements or expressions forming
+                 (part of) a basic block.
+        effects -- Optional dictionary to add id(unit) -> stmt_effects(unit)
+                   to for each unit (so they needn't be found again).
+
+    Returns: A dictionary from id(node) to key for every node whose value
+    should be computed once and then reused.
+
+    """
+    shared = {}
+    live = {}
+    # analyses of the nodes and keys seen so far
+    key_memo = {}
+    vars_memo = {}
+
+    def flush(keys):
+        for k in keys:
+            nodes = live.pop(k)
+            if len(nodes) > 1:
+                for node in nodes:
+                    shared[id(node)] = k
+
+    def walk(node, allow_heap):
+        # children are pushed in reverse so they're walked in order
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            key = cse_candidate(node, key_memo, vars_memo)
+            if key is not None and (allow_heap or not key_reads_heap(key)):
+                if key in live:
+                    # a later occurrence is a load, so its parts aren't evaluated
+                    live[key].append(node)
+                    continue
+                live[key] = [node]
+            if isinstance(node, Expr):
+                stack += [node.rest, node.first]
+            elif isinstance(node, SimpleTerm):
+                stack.append(node.rvalue)
+            elif isinstance(node, ComplexTerm):
+                stack.append(node.expr)
+            elif isinstance(node, CallExpr):
+                stack.extend(reversed(node.args))
+            elif isinstance(node, NewRValue):
+                stack.extend(reversed(node.struct_params))
+            elif isinstance(node, VarRValue):
+                stack.extend(var_ref.array_expr for var_ref in reversed(node.path))
+
+    for unit in units:
+        names, heap, calls = stmt_effects(unit)
+        if effects is not None:
+            effects[id(unit)] = (names, heap, calls)
+        if calls:
+            flush(killed_keys(list(live), set(), True, vars_memo))
+        for expr in stmt_exprs(unit):
+            walk(expr, not calls)
+        flush(killed_keys(list(live), names, heap, vars_memo))
+    flush(list(live))
+    return shared
+
+
+#----------------------------------------------------------------------
+# Escape analysis
+#----------------------------------------------------------------------
+
+def new_struct_expr(expr, struct_defs):
+    """Returns the NewRValue if the expression is just a struct allocation
+    that sets every field, otherwise None.
+
+    """
+    if not isinstance(expr, Expr) or expr.op or expr.not_op:
+        return None
+    if not isinstance(expr.first, SimpleTerm):
+        return None
+    new_rvalue = expr.first.rvalue
+    if not isinstance(new_rvalue, NewRValue) or new_rvalue.array_expr:
+        return None
+    struct_def = struct_defs.get(new_rvalue.type_name.lexeme)
+    if not struct_def or len(new_rvalue.struct_params) != len(struct_def.fields):
+        return None
+    return new_rvalue
+
+
+def non_escaping_structs(fun_def, struct_defs):
+    """Finds the struct variables of a function whose objects never escape.
+
+    A variable qualifies if it is declared once (and isn't a parameter),
+    initialized with a new struct, never reassigned, and only ever used
+    to read or write one of its fields. The object can then never be
+    stored in another object, returned, passed to a call, or compared, so
+    its fields can live in local variables instead of the struct heap.
+
+    Args:
+        fun_def -- The function definition to analyze.
+        struct_defs -- Dictionary from struct name to StructDef.
+
+    Returns: A dictionary from variable name to the StructDef of the
+    object it holds.
+
+    """
+    decls = {}
+    for param in fun_def.params:
+        decls.setdefault(param.var_name.lexeme, []).append(None)
+    for node in walk_nodes(fun_def):
+        if isinstance(node, VarDecl):
+            decls.setdefault(node.var_def.var_name.lexeme, []).append(node)
+    candidates = {}
+    for name, nodes in decls.items():
+        if len(nodes) == 1 and nodes[0] is not None:
+            new_rvalue = new_struct_expr(nodes[0].expr, struct_defs)
+            if new_rvalue:
+                candidates[name] = struct_defs[new_rvalue.type_name.lexeme]
+
+    def field_use(path):
+        struct_def = candidates[path[0].var_name.lexeme]
+        if len(path) < 2 or path[0].array_expr:
+            return False
+        return any(f.var_name.lexeme == path[1].var_name.lexeme for f in struct_def.fields)
+
+    for node in walk_nodes(fun_def):
+        path = None
+        if isinstance(node, VarRValue):
+            path = node.path
+        elif isinstance(node, AssignStmt):
+            path = node.lvalue
+        if path and path[0].var_name.lexeme in candidates and not field_use(path):
+            del candidates[path[0].var_name.lexeme]
+    return candidates
+
+
+#----------------------------------------------------------------------
+# Profile-guided optimization
+#----------------------------------------------------------------------
+
+def source_pos(node):
+    """Returns the 'line:column' of the first token of an AST node, used
+    to match profile data to the code it was recorded for.
+
+    """
+    for curr in walk_nodes(node):
+        token = None
+        if isinstance(curr, SimpleRValue):
+            token = curr.value
+        elif isinstance(curr, VarRef):
+            token = curr.var_name
+        elif isinstance(curr, CallExpr):
+            token = curr.fun_name
+        elif isinstance(curr, NewRValue):
+            token = curr.type_name
+        if token:
+            return f'{token.line}:{token.column}'
+    return None
+
+
+def hot_call_sites(profile):
+    """Returns the positions of the hot call sites of a profile."""
+    sites = profile.get('call_sites', {})
+    if not sites:
+        return set()
+    limit = max(HOT_CALL_MIN, HOT_CALL_FRACTION * max(sites.values()))
+    return {pos for pos, count in sites.items() if count >= limit}
+
+
+def pushes_nothing(call_expr):
+    """True if a call is to a built-in function that returns nothing
+    (such as print), so it leaves nothing on the operand stack."""
+    built_in = BUILT_INS.get(call_expr.fun_name.lexeme)
+    return built_in is not None and built_in.return_type == 'void'
+
+
+def can_inline(fun_def):
+    """True if calls to the function can be replaced by its body.
+
+    Only small leaf functions (no calls to user-defined functions, so
+    never recursive) qualify. Call statements other than calls to void
+    built-ins (like print) would leave their unused value on the
+    caller's operand stack, so functions with them don't qualify either.
+
+    """
+    if fun_def.fun_name.lexeme == 'main':
+        return False
+    if node_count(fun_def.stmts) > INLINE_BUDGET:
+        return False
+    for node in walk_nodes(fun_def):
+        if isinstance(node, CallExpr) and node.fun_name.lexeme not in BUILT_INS:
+            return False
+        for stmt in getattr(node, 'stmts', []) + getattr(node, 'else_stmts', []):
+            if isinstance(stmt, CallExpr) and not pushes_nothing(stmt):
+                return False
+    return True
+
+
+def is_cold(counts):
+    """True if a branch whose test was (true, false) the given number of
+    times should be kept off the fall-through path.
+
+    """
+    true_count, false_count = counts
+    return true_count <= (true_count + false_count) * COLD_BRANCH_RATIO
+
+
+def equality_test(cond):
+    """Returns (variable name, value) for a test of the form 'var == value'
+    (or 'value == var') with a literal value, otherwise None.
+
+    """
+    if not isinstance(cond, Expr) or cond.not_op or not cond.op:
+        return None
+    if cond.op.token_type != TokenType.EQUAL or cond.rest.op or cond.rest.not_op:
+        return None
+    name = simple_var_name(cond.first)
+    val = const_value(cond.rest)
+    if name is None:
+        name = simple_var_name(cond.rest)
+        val = const_value(cond.first)
+    if name is None or val is NOT_CONSTANT:
+        return None
+    return name, val
+
+
+def exclusive_tests(conds):
+    """True if at most one of the conditions can be true at a time and
+    none of them has side effects (so they can be tested in any order).
+
+    """
+    tests = [equality_test(cond) for cond in conds]
+    if None in tests or len({name for name, _ in tests}) != 1:
+        return False
+    vals = [val for _, val in tests]
+    return all(vals[i] != vals[j] for i in range(len(vals)) for j in range(i))
+
+
+#----------------------------------------------------------------------
+# Partial evaluation
+#----------------------------------------------------------------------
+
+def pure_functions(fun_defs):
+    """Returns the names of the functions that can be evaluated at compile
+    time: those that only call pure built-in functions (so never read
+    input or print, directly or through the functions they call) and
+    that return a primitive value (not a heap object reference).
+
+    Args:
+        fun_defs -- The program's function definitions.
+
+    """
+    calls = {}
+    pure = set()
+    for fun_def in fun_defs:
+        name = fun_def.fun_name.lexeme
+        ret = fun_def.return_type
+        if name == 'main' or ret.is_array or ret.is_dict:
+            continue
+        if ret.type_name.lexeme not in ('int', 'double', 'bool', 'string', 'void'):
+            continue
+        called = {n.fun_name.lexeme for n in walk_nodes(fun_def) if isinstance(n, CallExpr)}
+        if any(not BUILT_INS[n].pure for n in called if n in BUILT_INS):
+            continue
+        calls[name] = called - set(BUILT_INS)
+        pure.add(name)
+    # drop functions that call impure (or undefined) functions
+    changed = True
+    while changed:
+        changed = False
+        for name in list(pure):
+            if not calls[name] <= pure:
+                pure.discard(name)
+                changed = True
+    return pure
+
+
+def value_text(val):
+    """Returns a value written the way it would be in MyPL source."""
+    if val is None:
+        return 'null'
+    elif type(val) == bool:
+        return 'true' if val else 'false'
+    elif type(val) == str:
+        return '"' + val.replace('\n', '\\n').replace('\t', '\\t') + '"'
+    return str(val)
+
@@ -0,0 +1,96 @@
+"""Semantic checking and code generation of MyPL functions across a pool
+of worker processes.
+
+NAME: George Calvert
+DATE: Spring 2024
+CLASS: CPSC 326
+
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from mypl_error import *
+from mypl_semantic_checker import SemanticChecker
+from mypl_code_gen import CodeGenerator
+from mypl_vm import VM
+
+
+# each worker's copy of the program and its checker and code generator
+worker = {}
+
+
+def start_worker(program, opt_level, profile):
+    """Sets up a worker process for a program."""
+    worker['program'] = program
+    worker['checker'] = new_checker(program)
+    worker['vm'] = VM()
+    worker['codegen'] = CodeGenerator(worker['vm'], opt_level, profile)
+    worker['codegen'].begin_program(program)
+
+
+def new_checker(program):
+    """Returns a semantic checker that has recorded the program's
+    definitions (which are known to be valid)."""
+    checker = SemanticChecker()
+    checker.declare_program(program)
+    return checker
+
+
+def compile_function(index):
+    """Checks and generates code for one of the worker's functions.
+
+    Returns: A (check error, codegen error, template) tuple, where the
+    errors are None or the MyPLError raised.
+
+    """
+    fun_def = worker['program'].fun_defs[index]
+    codegen = worker['codegen']
+    try:
+        fun_def.accept(worker['checker'])
+    except MyPLError as ex:
+        worker['checker'] = new_checker(worker['program'])
+        return (ex, None, None)
+    try:
+        fun_def.accept(codegen)
+    except MyPLError as ex:
+        start_worker(worker['program'], codegen.opt_level, codegen.profile)
+        return (None, ex, None)
+    template = worker['vm'].frame_templates[fun_def.fun_name.lexeme]
+    return (None, None, template)
+
+
+def compile_parallel(program, vm, opt_level=0, profile=None, jobs=None):
+    """Checks and generates code for a program, with the functions split
+    across a pool of processes. The generated code (and any error
+    reported) is the same as checking and then generating the program in
+    one process.
+
+    Each function is generated on its own (its dictionary variables are
+    local to it), so the workers' templates are used as they are.
+
+    Args:
+        program -- The Program AST node.
+        vm -- The VM to add the frame templates to.
+        opt_level -- The code generator optimization level.
+        profile -- Profile data to guide code generation (optional).
+        jobs -- The number of worker processes (default: one per CPU).
+
+    """
+    checker = new_checker(program)
+    for struct in checker.structs.values():
+        struct.accept(checker)
+    count = len(program.fun_defs)
+    jobs = jobs or os.cpu_count() or 1
+    with ProcessPoolExecutor(jobs, initializer=start_worker,
+                             initargs=(program, opt_level, profile)) as pool:
+        chunk_size = max(1, count // (4 * jobs))
+        results = list(pool.map(compile_function, range(count), chunksize=chunk_size))
+    # report the error the serial path would: every function is checked
+    # before any code is generated
+    for kind in range(2):
+        for result in results:
+            if result[kind] is not None:
+                raise result[kind]
+    for result in results:
+        vm.add_frame_template(result[2])
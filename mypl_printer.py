@@ -9,6 +9,7 @@ CLASS: CPSC 326
 from dataclasses import dataclass
 from mypl_token import Token, TokenType
 from mypl_ast import *
+from mypl_ast_parser import BINARY_PRECEDENCE, NOT_PRECEDENCE
 
 
 class PrintVisitor(Visitor):
@@ -16,6 +17,8 @@ class PrintVisitor(Visitor):
 
     def __init__(self):
         self.indent = 0
+        # the operator printed just before the next expression visited
+        self.right_of = None
 
     # Helper Functions
         
@@ -34,6 +37,62 @@ class PrintVisitor(Visitor):
         self.output('  ' * self.indent)
 
 
+    def ends_with_not(self, expr):
+        """True if the printed expression could end with a not expression
+        (which would take in an operator printed after it)."""
+        while True:
+            if expr.not_op:
+                return True
+            if expr.op:
+                expr = expr.rest
+            elif type(expr.first) == ComplexTerm:
+                expr = expr.first.expr
+            else:
+                return False
+
+
+    def needs_parens(self, inner, expr, right_of):
+        """True if the expression of a complex term must be printed in
+        parentheses to parse back to the same tree.
+
+        Args:
+            inner -- The complex term's expression.
+            expr -- The Expr whose first term is the complex term.
+            right_of -- The operator printed just before expr (if any).
+
+        """
+        # look through parentheses that are printed only if needed
+        while not inner.op and not inner.not_op and type(inner.first) == ComplexTerm:
+            inner = inner.first.expr
+        if expr.op:
+            # the left operand of expr's operator
+            precedence = BINARY_PRECEDENCE[expr.op.token_type]
+            if inner.not_op:
+                return precedence > NOT_PRECEDENCE
+            if inner.op:
+                inner_precedence = BINARY_PRECEDENCE[inner.op.token_type]
+                if inner_precedence < precedence:
+                    return True
+                if precedence > NOT_PRECEDENCE and self.ends_with_not(inner):
+                    return True
+                # after an operator of the same precedence, only the same
+                # operator continues its chain
+                return (right_of is not None and not expr.not_op and
+                        inner_precedence == BINARY_PRECEDENCE[right_of.token_type] and
+                        inner.op.token_type != right_of.token_type)
+            return False
+        if expr.not_op:
+            # not prints its operand in parentheses if it has an operator
+            return inner.op is not None and not inner.not_op
+        if right_of:
+            if inner.not_op:
+                return True
+            if inner.op:
+                return (BINARY_PRECEDENCE[inner.op.token_type] <= BINARY_PRECEDENCE[right_of.token_type] or
+                        self.ends_with_not(inner))
+        return False
+
+
     def output_semicolon(self, stmt):
         """Prints a semicolon if the type of statment should end in a
         semicolon.
@@ -49,10 +108,10 @@ class PrintVisitor(Visitor):
     
     def visit_program(self, program):
         for struct in program.struct_defs:
-            struct.accept(self)
+            yield struct
             self.output('\n')
         for fun in program.fun_defs:
-            fun.accept(self)
+            yield fun
             self.output('\n')            
 
             
@@ -61,24 +120,24 @@ class PrintVisitor(Visitor):
         self.indent += 1
         for var_def in struct_def.fields:
             self.output_indent()
-            var_def.accept(self)
+            yield var_def
             self.output(';\n')
         self.indent -= 1
         self.output('}\n')
 
 
     def visit_fun_def(self, fun_def):
-        fun_def.return_type.accept(self)
+        yield fun_def.return_type
         self.output(fun_def.fun_name.lexeme + '(')
         for i in range(len(fun_def.params)):
-            fun_def.params[i].accept(self)
+            yield fun_def.params[i]
             if i < len(fun_def.params) - 1:
                 self.output(', ')
         self.output(') {\n')
         self.indent += 1
         for stmt in fun_def.stmts:
             self.output_indent()
-            self.visit_stmt_def(stmt)
+            yield from self.visit_stmt_def(stmt)
             self.output_semicolon(stmt)
             self.output('\n')
         self.indent -= 1
@@ -87,15 +146,15 @@ class PrintVisitor(Visitor):
 
     # TODO: Finish the rest of the visitor functions below
     def visit_stmt_def(self, stmt):
-        stmt.accept(self)
+        yield stmt
         
     def visit_var_decl(self, var_decl):
-        var_decl.var_def.accept(self)
+        yield var_decl.var_def
         self.output(" = ")
-        var_decl.expr.accept(self)
+        yield var_decl.expr
     
     def visit_var_def(self, var_def):
-        var_def.data_type.accept(self)
+        yield var_def.data_type
         self.output(var_def.var_name.lexeme)
     
     def visit_data_type(self, data_type):
@@ -104,27 +163,29 @@ class PrintVisitor(Visitor):
         self.output(data_type.type_name.lexeme + ' ')
     
     def visit_expr(self, expr):
-        # not op check
-        flag = False
+        right_of, self.right_of = self.right_of, None
+        # not op check (applies to the whole expression)
         if expr.not_op:
-            self.output('not (')
-            falg = True
+            self.output('not (' if expr.op else 'not ')
+
+        # first expression (the left operand), in parentheses only if
+        # precedence requires them
+        first = expr.first
+        if type(first) == ComplexTerm and not self.needs_parens(first.expr, expr, right_of):
+            # the term is printed just after the same operator
+            self.right_of = None if expr.not_op else right_of
+            yield first.expr
+        else:
+            yield first
 
-        # first expression
-        f = expr.first
-    
-        f.accept(self)
-   
-        # operator
+        # operator and rest (the right operand)
         if type(expr.op) == Token:
             self.output(' ' + expr.op.lexeme + ' ')
-            
+            self.right_of = expr.op
+            yield expr.rest
 
-        # rest
-        if type(expr.rest) == Expr:
-            expr.rest.accept(self)
-            if flag:
-                self.output(')')
+        if expr.not_op and expr.op:
+            self.output(')')
 
     def visit_simple_rvalue(self, simple_rvalue):
         if simple_rvalue.value.token_type == TokenType.STRING_VAL:
@@ -133,25 +194,25 @@ class PrintVisitor(Visitor):
             self.output(simple_rvalue.value.lexeme)
 
     def visit_simple_term(self, simple_term):
-        simple_term.rvalue.accept(self)
+        yield simple_term.rvalue
     
     def visit_complex_term(self, complex_term):
         self.output('(')
-        complex_term.expr.accept(self)
+        yield complex_term.expr
         self.output(')')
 
     def visit_call_expr(self, call_expr):
         self.output(call_expr.fun_name.lexeme + '(')
         
         for i in range(len(call_expr.args)):
-            call_expr.args[i].accept(self)
+            yield call_expr.args[i]
             if i < len(call_expr.args) - 1:
                 self.output(', ')
         self.output(')')
 
     def visit_return_stmt(self, return_stmt):
         self.output('return ')
-        return_stmt.expr.accept(self)
+        yield return_stmt.expr
     
     def visit_var_rvalue(self, var_rvalue):
         p = var_rvalue.path
@@ -159,7 +220,7 @@ class PrintVisitor(Visitor):
             self.output(p[var].var_name.lexeme)
             if type(p[var].array_expr) == Expr:
                 self.output('[')
-                p[var].array_expr.accept(self)
+                yield p[var].array_expr
                 self.output(']')
             if var < len(p) - 1:
                 self.output('.')
@@ -167,12 +228,12 @@ class PrintVisitor(Visitor):
     def visit_if_stmt(self, if_stmt):
         # basic if
         self.output("if (")
-        if_stmt.if_part.condition.accept(self)
+        yield if_stmt.if_part.condition
         self.output(") {\n")
         self.indent += 1
         for stmt in if_stmt.if_part.stmts:
             self.output_indent()
-            stmt.accept(self)
+            yield stmt
             self.output_semicolon(stmt)
             self.output('\n')
         self.indent -= 1
@@ -186,12 +247,12 @@ class PrintVisitor(Visitor):
                 self.output('\n')
                 self.output_indent()
                 self.output("elseif (")
-                e.condition.accept(self)
+                yield e.condition
                 self.output(") {\n")
                 self.indent += 1
                 for stmt in e.stmts:
                     self.output_indent()
-                    stmt.accept(self)
+                    yield stmt
                     self.output_semicolon(stmt)
                     self.output('\n')
                 self.indent -= 1
@@ -206,7 +267,7 @@ class PrintVisitor(Visitor):
             self.indent += 1
             for stmt in el:
                 self.output_indent()
-                stmt.accept(self)
+                yield stmt
                 self.output_semicolon(stmt)
                 self.output('\n')
             self.indent -= 1
@@ -220,7 +281,7 @@ class PrintVisitor(Visitor):
             self.output(lvals[ref].var_name.lexeme)
             if type(lvals[ref].array_expr) == Expr:
                 self.output("[")
-                lvals[ref].array_expr.accept(self)
+                yield lvals[ref].array_expr
                 self.output("]")
             if ref < len(lvals) - 1:
                 self.output('.')
@@ -228,26 +289,26 @@ class PrintVisitor(Visitor):
         self.output(' = ')
 
         # expression
-        assign_stmt.expr.accept(self)
+        yield assign_stmt.expr
     
     def visit_for_stmt(self, for_stmt):
         self.output("for (")
         # declaration
-        for_stmt.var_decl.accept(self)
+        yield for_stmt.var_decl
         self.output_semicolon(for_stmt.var_decl)
         self.output(" ")
         # condition
-        for_stmt.condition.accept(self)
+        yield for_stmt.condition
         self.output("; ")
         # assign
-        for_stmt.assign_stmt.accept(self)
+        yield for_stmt.assign_stmt
         self.output(') {\n')
 
         self.indent += 1
         for_stmts = for_stmt.stmts
         for stmt in range(len(for_stmts)):
             self.output_indent()  
-            for_stmts[stmt].accept(self)    
+            yield for_stmts[stmt]    
             self.output_semicolon(for_stmts[stmt])
             self.output('\n')
         self.indent -= 1
@@ -256,13 +317,13 @@ class PrintVisitor(Visitor):
     
     def visit_while_stmt(self, while_stmt):
         self.output('while (')
-        while_stmt.condition.accept(self)
+        yield while_stmt.condition
         self.output(') {\n')
         self.indent += 1
         # stmts
         for i in range(len(while_stmt.stmts)):
             self.output_indent()
-            while_stmt.stmts[i].accept(self)
+            yield while_stmt.stmts[i]
             self.output_semicolon(while_stmt.stmts[i])
             self.output('\n')
         self.indent -= 1
@@ -273,12 +334,12 @@ class PrintVisitor(Visitor):
         self.output(new_rvalue.type_name.lexeme)
         if type(new_rvalue.array_expr) == Expr:
             self.output('[')
-            new_rvalue.array_expr.accept(self)
+            yield new_rvalue.array_expr
             self.output(']')
         self.output("(")
         if len(new_rvalue.struct_params) > 0:
             for i in range(len(new_rvalue.struct_params)):
-                new_rvalue.struct_params[i].accept(self)
+                yield new_rvalue.struct_params[i]
                 if i < len(new_rvalue.struct_params) - 1:
                     self.output(', ')
         self.output(')')
@@ -11,11 +11,31 @@ from mypl_error import *
 from mypl_token import Token, TokenType
 from mypl_ast import *
 from mypl_symbol_table import SymbolTable
+from mypl_builtins import BUILT_INS
 
 
 BASE_TYPES = ['int', 'double', 'bool', 'string', 'dict']
-BUILT_INS = ['print', 'input', 'itos', 'itod', 'dtos', 'dtoi', 'stoi', 'stod',
-             'length', 'get', 'keys', 'in']
+# type names used in built-in function signatures -> token types
+TYPE_TOKENS = {'int': TokenType.INT_TYPE, 'double': TokenType.DOUBLE_TYPE,
+               'bool': TokenType.BOOL_TYPE, 'string': TokenType.STRING_TYPE,
+               'void': TokenType.VOID_TYPE}
+TYPE_NAMES = {token_type: name for name, token_type in TYPE_TOKENS.items()}
+
+
+def type_text(data_type):
+    """Returns a data type written the way built-in function signatures
+    write it (e.g., 'int', 'array string', or 'dict')."""
+    if data_type.is_dict:
+        return 'dict'
+    type_name = data_type.type_name
+    name = TYPE_NAMES.get(type_name.token_type, type_name.lexeme)
+    return 'array ' + name if data_type.is_array else name
+
+
+def type_matches(accepted, data_type):
+    """True if a data type is the type accepted by a built-in function."""
+    return accepted == 'any' or accepted == type_text(data_type)
+
 
 class SemanticChecker(Visitor):
     """Visitor implementation to semantically check MyPL programs."""
@@ -23,6 +43,8 @@ class SemanticChecker(Visitor):
     def __init__(self):
         self.structs = {}
         self.functions = {}
+        # variable name -> VarDef of its declaration (and 'return' -> the
+        # function's return type)
         self.symbol_table = SymbolTable()
         self.curr_type = None
 
@@ -55,10 +77,63 @@ class SemanticChecker(Visitor):
                 return var_def.data_type
         return None
 
+
+    def group_from_left(self, expr):
+        """Regroups a chain of one operator (which the parser builds as a
+        balanced tree) from the left, in place.
+
+        Args:
+            expr: The Expr at the top of the chain.
+
+        """
+        op_type = expr.op.token_type
+        operands = []
+        ops = []
+        stack = [expr]
+        while stack:
+            curr = stack.pop()
+            if isinstance(curr, Token):
+                ops.append(curr)
+            elif curr.op and curr.op.token_type == op_type and not curr.not_op:
+                stack.append(curr.rest)
+                stack.append(curr.op)
+                # a left operand with the same operator is part of the chain
+                first = curr.first
+                if isinstance(first, ComplexTerm) and first.expr.op and \
+                   first.expr.op.token_type == op_type and not first.expr.not_op:
+                    stack.append(first.expr)
+                else:
+                    stack.append(Expr(False, first, None, None))
+            else:
+                operands.append(curr)
+        left = operands[0]
+        for op, right in zip(ops, operands[1:]):
+            term = ComplexTerm(left) if left.op or left.not_op else left.first
+            left = Expr(False, term, op, right)
+        expr.first, expr.op, expr.rest = left.first, left.op, left.rest
+
         
     # Visitor Functions
     
     def visit_program(self, program):
+        self.declare_program(program)
+        # check each struct
+        for struct in self.structs.values():
+            yield struct
+        # check each function
+        for fun in self.functions.values():
+            yield fun
+
+
+    def declare_program(self, program):
+        """Records the program's struct and function definitions, checking
+        for duplicate definitions and for a valid main function (but not
+        checking the definitions themselves).
+
+        Args:
+            program -- The Program AST node.
+
+        """
         # check and record struct defs
         for struct in program.struct_defs:
             struct_name = struct.struct_name.lexeme
@@ -80,19 +155,13 @@ class SemanticChecker(Visitor):
         # check main function
         if 'main' not in self.functions:
             self.error('missing main function', None)
-        # check each struct
-        for struct in self.structs.values():
-            struct.accept(self)
-        # check each function
-        for fun in self.functions.values():
-            fun.accept(self)
         
         
     def visit_struct_def(self, struct_def):
         self.symbol_table.push_environment()
         # go through statements
         for stmt in struct_def.fields:
-            stmt.accept(self)
+            yield stmt
         self.symbol_table.pop_environment()
 
 
@@ -113,11 +182,11 @@ class SemanticChecker(Visitor):
             if self.symbol_table.exists_in_curr_env(name):
                 self.error(f'duplicate param name used in {fun_def.fun_name.lexeme}', param.var_name)
             else:
-                self.symbol_table.add(name, param.data_type)
+                self.symbol_table.add(name, param)
 
         # check statements
         for stmt in fun_def.stmts:
-            stmt.accept(self)
+            yield stmt
 
         # done with environment
         self.symbol_table.pop_environment()
@@ -128,7 +197,7 @@ class SemanticChecker(Visitor):
     def visit_return_stmt(self, return_stmt):
         # accept expr and check what type it is to return type in cur env
         return_type = self.symbol_table.get('return')
-        return_stmt.expr.accept(self)
+        yield return_stmt.expr
         expr_type = self.curr_type
         # check types
         if return_type.token_type != expr_type.type_name.token_type:
@@ -144,24 +213,25 @@ class SemanticChecker(Visitor):
         is_dict = var_decl.var_def.data_type.is_dict
         # expression is present
         if var_decl.expr:
-            var_decl.expr.accept(self)
+            yield var_decl.expr
             rhs_type = self.curr_type
             if lhs_type.type_name.token_type == rhs_type.type_name.token_type or rhs_type.type_name.lexeme == 'void':
                 # check if already in environment
                 if self.symbol_table.exists_in_curr_env(name):
-                    type_name = self.symbol_table.get(name)
+                    prev_def = self.symbol_table.get(name)
                     # check shadowing redeclaration
-                    if type_name.type_name.token_type != lhs_type.type_name.token_type:
+                    if prev_def.data_type.type_name.token_type != lhs_type.type_name.token_type:
                         self.error(f'Duplicate variable declarations for {lhs_type.type_name.lexeme} {name}', var_decl.var_def.data_type.type_name)
                     else:
-                        self.symbol_table.add(name, type_name)
+                        # still the same variable
+                        self.symbol_table.add(name, prev_def)
                 # add since not in env
                 else:
                     if not is_dict and array_bool != self.curr_type.is_array and rhs_type.type_name.lexeme != 'void':
                         self.error("Mismatch of array declaration", self.curr_type.type_name)
                     # elif is_dict != self.curr_type.is_dict and rhs_type.type_name.lexeme != 'void':
                     #     self.error("Mismatch of dict declaration", self.curr_type.type_name)
-                    self.symbol_table.add(name, lhs_type)
+                    self.symbol_table.add(name, var_decl.var_def)
             else:
                 self.error(f'Mismatch of types {lhs_type.type_name.lexeme} and {self.curr_type.type_name.lexeme}', var_decl.var_def.data_type.type_name)
         # no expression
@@ -171,7 +241,7 @@ class SemanticChecker(Visitor):
                 self.error(f'Duplicate variable declarations for {lhs_type} {name}', var_decl.var_def.var_name)
             # add since not in env
             else:
-                self.symbol_table.add(name, lhs_type)          
+                self.symbol_table.add(name, var_decl.var_def)
         
     def visit_assign_stmt(self, assign_stmt):
         # lvalue
@@ -179,24 +249,29 @@ class SemanticChecker(Visitor):
         first = assign_stmt.lvalue[0]
         if not self.symbol_table.exists(first.var_name.lexeme):
             self.error(f'Use before def {first.var_name.lexeme}', first.var_name)
-        first_type = self.symbol_table.get(assign_stmt.lvalue[0].var_name.lexeme)
+        first.var_def = self.symbol_table.get(first.var_name.lexeme)
+        first_type = first.var_def.data_type
 
         # change first type to element type to check
         if first_type.is_dict:
             # check indexing
             temp_type = DataType(False, False, None, None, first_type.key_type_name)
             if assign_stmt.lvalue[0].array_expr:
-                assign_stmt.lvalue[0].array_expr.accept(self)
+                yield assign_stmt.lvalue[0].array_expr
                 if temp_type.type_name.token_type != self.curr_type.type_name.token_type:
                     self.error("Invalid type for indexing dictionary", self.curr_type.type_name)
                 first_type = DataType(False, False, None, None, first_type.element_type_name)
+        elif first.array_expr:
+            yield first.array_expr
+            if self.curr_type.type_name.token_type != TokenType.INT_TYPE:
+                self.error('Invalid type for indexing array', self.curr_type.type_name)
         lvals_list = assign_stmt.lvalue
         for lval in range(1, len(lvals_list)):
             array_flag = False
             # array_expr
             if lvals_list[lval].array_expr:
                 array_flag = True
-                lvals_list[lval].array_expr.accept(self)
+                yield lvals_list[lval].array_expr
                 if self.curr_type.type_name.token_type != TokenType.INT_TYPE:
                     self.error('Invalid type for indexing array', self.curr_type.type_name)
                 # check dict type
@@ -205,53 +280,54 @@ class SemanticChecker(Visitor):
                 struct = self.structs[first_type.type_name.lexeme]
                 # check var is a field
                 # get type of field
-                try:
-                    first_type = self.get_field_type(struct, lvals_list[lval].var_name.lexeme)
-                except:
+                first_type = self.get_field_type(struct, lvals_list[lval].var_name.lexeme)
+                if first_type is None:
                     self.error(f'field {lvals_list[lval].var_name.lexeme} not in struct type {struct.struct_name.lexeme}', lvals_list[lval].var_name)
                 # array declaration
                 if first_type.is_array and not lvals_list[lval].array_expr and type(assign_stmt.expr.first.rvalue) != NewRValue:
                     self.error(f'No array expression given for array type {lvals_list[lval].var_name.lexeme}', lvals_list[lval].var_name)
         lhs_type = first_type
         # expr
-        assign_stmt.expr.accept(self)
+        yield assign_stmt.expr
         if lhs_type.type_name.token_type != self.curr_type.type_name.token_type and self.curr_type.type_name.token_type != TokenType.VOID_TYPE:
             self.error(f'Mismatch of types {lhs_type.type_name.lexeme} and {self.curr_type.type_name.lexeme}', self.curr_type.type_name)
         
             
     def visit_while_stmt(self, while_stmt):
         self.symbol_table.push_environment()
-        while_stmt.condition.accept(self)
+        yield while_stmt.condition
         if self.curr_type.type_name.token_type != TokenType.BOOL_TYPE or self.curr_type.is_array:
             self.error("Non boolean expression in condition of While Statement", self.curr_type.type_name)
         for stmt in while_stmt.stmts:
-            stmt.accept(self)
+            yield stmt
         self.symbol_table.pop_environment()
 
     def visit_for_stmt(self, for_stmt):
         self.symbol_table.push_environment()
         # var_decl
-        for_stmt.var_decl.accept(self)
+        yield for_stmt.var_decl
         # condition
-        for_stmt.condition.accept(self)
+        yield for_stmt.condition
         if self.curr_type.type_name.token_type != TokenType.BOOL_TYPE or self.curr_type.is_array:
             self.error('Bad Boolean expression in for loop', self.curr_type.type_name)
+        # update (which can't see the body's variables)
+        yield for_stmt.assign_stmt
 
         # stmts
         for stmt in for_stmt.stmts:
-            stmt.accept(self)
+            yield stmt
         self.symbol_table.pop_environment()
 
     def visit_if_stmt(self, if_stmt):
         self.symbol_table.push_environment()
         # basic ifs
         # condition
-        if_stmt.if_part.condition.accept(self)
+        yield if_stmt.if_part.condition
         if self.curr_type.type_name.token_type != TokenType.BOOL_TYPE or self.curr_type.is_array:
             self.error("Non boolean expression in condition of If Statement", self.curr_type.type_name)
         # statements
         for stmt in if_stmt.if_part.stmts:
-            stmt.accept(self)
+            yield stmt
         self.symbol_table.pop_environment()
 
         # else ifs
@@ -260,163 +336,50 @@ class SemanticChecker(Visitor):
                 self.symbol_table.push_environment()
                 # basic ifs
                 # condition
-                else_ifs.condition.accept(self)
+                yield else_ifs.condition
                 if self.curr_type.type_name.token_type != TokenType.BOOL_TYPE or self.curr_type.is_array:
                     self.error("Non boolean expression in condition of if Statement", self.curr_type.type_name)
                 # statements
                 for stmt in else_ifs.stmts:
-                    stmt.accept(self)
+                    yield stmt
                 self.symbol_table.pop_environment()
         # else
         if if_stmt.else_stmts:
             self.symbol_table.push_environment()
             for stmt in if_stmt.else_stmts:
-                stmt.accept(self)
+                yield stmt
             self.symbol_table.pop_environment()
         
         
     def visit_call_expr(self, call_expr):
         # check function exists
-        fun_list = list(self.functions.keys())
-        if call_expr.fun_name.lexeme not in fun_list and call_expr.fun_name.lexeme not in BUILT_INS:
-            self.error(f'Undeclared Function {call_expr.fun_name.lexeme}', call_expr.fun_name)
         func_name = call_expr.fun_name.lexeme
+        if func_name not in self.functions and func_name not in BUILT_INS:
+            self.error(f'Undeclared Function {func_name}', call_expr.fun_name)
         line = call_expr.fun_name.line
         column = call_expr.fun_name.column
-        type_token = None
-        is_array = False
         # check for built in functions
-        if call_expr.fun_name.lexeme in BUILT_INS:
-            # print
-            if func_name == 'print':
-                # set cur to void since print returns a void 
-                # one argument but can be no arguments
-                if len(call_expr.args) > 1:
-                    self.error('Too many arguments for built in function, print', call_expr.fun_name)
-                call_expr.args[0].accept(self)
-                arg_type = self.curr_type
-                accepted_tokens = [TokenType.STRING_TYPE, TokenType.BOOL_TYPE, TokenType.DOUBLE_TYPE, TokenType.INT_TYPE, TokenType.VOID_TYPE]
-                if arg_type.type_name.token_type not in accepted_tokens or arg_type.is_array == True:
-                    self.error(f'Arguments of type {arg_type.type_name.lexeme} not allowed for function, print', arg_type.type_name)
-                type_token = Token(TokenType.VOID_TYPE, 'void', line, column)
-            # input
-            elif func_name == 'input':
-                # check if params is not zero
-                if len(call_expr.args) != 0:
-                    self.error(f'Too many arguments for bult in function, input', call_expr.fun_name)
-                type_token = Token(TokenType.STRING_TYPE, 'string', line, column)
-            # itos
-            elif func_name == 'itos':
-                if len(call_expr.args) != 1:
-                    self.error('Too many arguments for built in function, itos', call_expr.fun_name)
-                call_expr.args[0].accept(self)
-                arg_type = self.curr_type
-                if arg_type.type_name.token_type != TokenType.INT_TYPE:
-                    self.error(f'Expecting type int, received type {arg_type.type_name.lexeme}', call_expr.fun_name)
-                type_token = Token(TokenType.STRING_TYPE, 'string', line, column)
-            # dtos
-            elif func_name == 'dtos':
-                if len(call_expr.args) != 1:
-                    self.error('Too many arguments for built in function, dtos', call_expr.fun_name)
-                call_expr.args[0].accept(self)
-                arg_type = self.curr_type
-                if arg_type.type_name.token_type != TokenType.DOUBLE_TYPE:
-                    self.error(f'Expecting type double, received type {arg_type.type_name.lexeme}', call_expr.fun_name)
-                type_token = Token(TokenType.STRING_TYPE, 'string', line, column)
-            # stoi
-            elif func_name == 'stoi':
-                if len(call_expr.args) != 1:
-                    self.error('Too many arguments for built in function, stoi', call_expr.fun_name)
-                call_expr.args[0].accept(self)
+        if func_name in BUILT_INS:
+            built_in = BUILT_INS[func_name]
+            if len(call_expr.args) != len(built_in.params):
+                self.error(f'Wrong number of arguments for built in function, {func_name}', call_expr.fun_name)
+            arg_types = []
+            for arg, accepted in zip(call_expr.args, built_in.params):
+                yield arg
                 arg_type = self.curr_type
-                if arg_type.type_name.token_type != TokenType.STRING_TYPE:
-                    self.error(f'Expecting type string, received type {arg_type.type_name.lexeme}', call_expr.fun_name)
-                type_token = Token(TokenType.INT_TYPE, 'int', line, column)
-            # dtoi
-            elif func_name == 'dtoi':
-                if len(call_expr.args) != 1:
-                    self.error('Too many arguments for built in function, dtoi', call_expr.fun_name)
-                call_expr.args[0].accept(self)
-                arg_type = self.curr_type
-                if arg_type.type_name.token_type != TokenType.DOUBLE_TYPE:
-                    self.error(f'Expecting type double, received type {arg_type.type_name.lexeme}', call_expr.fun_name)
-                type_token = Token(TokenType.INT_TYPE, 'int', line, column)
-            # stod
-            elif func_name == 'stod':
-                if len(call_expr.args) != 1:
-                    self.error('Too many arguments for built in function, stod', call_expr.fun_name)
-                call_expr.args[0].accept(self)
-                arg_type = self.curr_type
-                if arg_type.type_name.token_type != TokenType.STRING_TYPE:
-                    self.error(f'Expecting type string, received type {arg_type.type_name.lexeme}', call_expr.fun_name)
-                type_token = Token(TokenType.DOUBLE_TYPE, 'double', line, column)
-            # itod
-            elif func_name == 'itod':
-                if len(call_expr.args) != 1:
-                    self.error('Too many arguments for built in function, itod', call_expr.fun_name)
-                call_expr.args[0].accept(self)
-                arg_type = self.curr_type
-                if arg_type.type_name.token_type != TokenType.INT_TYPE:
-                    self.error(f'Expecting type itod, received type {arg_type.type_name.lexeme}', call_expr.fun_name)
-                type_token = Token(TokenType.DOUBLE_TYPE, 'double', line, column)
-            # length
-            elif func_name == 'length':
-                if len(call_expr.args) != 1:
-                    self.error('Too many arguments for built in function, length', call_expr.fun_name)
-                call_expr.args[0].accept(self)
-                arg_type = self.curr_type
-                accepted_tokens = [TokenType.STRING_TYPE, TokenType.BOOL_TYPE, TokenType.DOUBLE_TYPE, TokenType.INT_TYPE]
-                if arg_type.type_name.token_type == TokenType.BOOL_TYPE or arg_type.type_name.token_type == TokenType.INT_TYPE or arg_type.type_name.token_type == TokenType.DOUBLE_TYPE:
-                    # check if it is an array
-                    if not arg_type.is_array:
-                        self.error(f'Cannot find length for type {arg_type.type_name.lexeme}', arg_type.type_name)
-                if arg_type.type_name.token_type not in accepted_tokens:
-                    self.error(f'Cannot find length for type {arg_type.type_name.lexeme}', arg_type.type_name)
-                type_token = Token(TokenType.INT_TYPE, 'int', line, column)
-            # get
-            elif func_name == 'get':
-                if len(call_expr.args) != 2:
-                    self.error('Too many arguments for built in function, get', call_expr.fun_name)
-                # first_arg
-                call_expr.args[0].accept(self)
-                first_arg = self.curr_type
-                # second_arg
-                call_expr.args[1].accept(self)
-                second_arg = self.curr_type
-
-                if first_arg.type_name.token_type != TokenType.INT_TYPE:
-                    self.error(f'Expecting type int for first argument, received {first_arg.type_name.token_type} for function, get', call_expr.fun_name)
-                if second_arg.type_name.token_type != TokenType.STRING_TYPE:
-                    self.error(f'Expecting type string for second argument, received {second_arg.type_name.token_type} for function, get', call_expr.fun_name)
-                # check array
-                elif second_arg.is_array:
-                    self.error(f'Expecting type string for second argument, received arrayfor function, get', call_expr.fun_name)
-                type_token = Token(TokenType.STRING_TYPE, 'string', line, column)
-            # keys
-            elif func_name == 'keys':
-                if len(call_expr.args) != 1:
-                    self.error('Too many arguments for built in function, get', call_expr.fun_name)
-                call_expr.args[0].accept(self)
-                arg_type = self.curr_type
-                # check dict type 
-                if not arg_type.is_dict:
-                    self.error(f'Expecting type dict for in argument for keys, received {arg_type.type_name.lexeme}', call_expr.fun_name)
-                is_array = True
-                type_token = Token(arg_type.key_type_name.token_type, arg_type.key_type_name.lexeme, line, column)
-            # in
-            elif func_name == 'in':
-                if len(call_expr.args) != 2:
-                    self.error('Too many arguments for built in function, get', call_expr.fun_name)
-                call_expr.args[0].accept(self)
-                arg_type = self.curr_type
-                # check dict type 
-                if not arg_type.is_dict:
-                    self.error(f'Expecting type dict for in argument for keys, received {arg_type.type_name.lexeme}', call_expr.fun_name)
-                call_expr.args[1].accept(self)
-                arg_type = self.curr_type
-
-                type_token = Token(TokenType.BOOL_TYPE, 'bool', line, column)            
-            self.curr_type = DataType(is_array, False, None, None, type_token)
+                if not any(type_matches(t, arg_type) for t in accepted):
+                    expected = ' or '.join(accepted)
+                    self.error(f'Expecting type {expected} for argument {len(arg_types) + 1} of function, {func_name}, received {type_text(arg_type)}', call_expr.fun_name)
+                arg_types.append(arg_type)
+            if built_in.return_type == 'array key':
+                key_type = arg_types[0].key_type_name
+                type_token = Token(key_type.token_type, key_type.lexeme, line, column)
+                self.curr_type = DataType(True, False, None, None, type_token)
+            else:
+                is_array = built_in.return_type.startswith('array ')
+                type_name = built_in.return_type.split()[-1]
+                type_token = Token(TYPE_TOKENS[type_name], type_name, line, column)
+                self.curr_type = DataType(is_array, False, None, None, type_token)
         else:
             # check params
             func = self.functions[call_expr.fun_name.lexeme]
@@ -424,7 +387,7 @@ class SemanticChecker(Visitor):
                 self.error(f"Arguments do not match function definition of {func.fun_name.lexeme}", call_expr.fun_name)
             # check type matching of arguments passed
             for param in range(len(func.params)):
-                call_expr.args[param].accept(self)
+                yield call_expr.args[param]
                 arg_type = self.curr_type
                 if (func.params[param].data_type.type_name.token_type != arg_type.type_name.token_type):
                     if (arg_type.type_name.token_type != TokenType.VOID_TYPE):
@@ -439,7 +402,7 @@ class SemanticChecker(Visitor):
 
     def visit_expr(self, expr):
         # check lhs term
-        expr.first.accept(self)
+        yield expr.first
         # store inferred type
         lhs_type = self.curr_type
         type_token = None
@@ -449,7 +412,7 @@ class SemanticChecker(Visitor):
             column = lhs_type.type_name.column 
             op = expr.op
             # check rest of expr
-            expr.rest.accept(self)
+            yield expr.rest
             # save rhs type
             rhs_type = self.curr_type
             math_ops = [TokenType.PLUS, TokenType.MINUS, TokenType.TIMES, TokenType.DIVIDE]
@@ -511,6 +474,12 @@ class SemanticChecker(Visitor):
             else:
                 self.error(f'Mismatch of types {lhs_type.type_name.lexeme} and {rhs_type.type_name.lexeme}', op)
             self.curr_type = DataType(False, False, None, None, type_token)
+            # double results depend on the grouping, so a balanced chain
+            # is regrouped from the left
+            rest = expr.rest
+            if type_token.token_type == TokenType.DOUBLE_TYPE and rest.op and \
+               rest.op.token_type == op.token_type and not rest.not_op:
+                self.group_from_left(expr)
         #if there is a not operator
         if expr.not_op:
             if self.curr_type.type_name.token_type != TokenType.BOOL_TYPE:
@@ -539,14 +508,14 @@ class SemanticChecker(Visitor):
         if self.symbol_table.exists_in_curr_env(name):
             self.error(f'Duplicate name {name}', var_def.var_name)
 
-        self.symbol_table.add(name, var_def.data_type)
+        self.symbol_table.add(name, var_def)
         
     def visit_simple_term(self, simple_term):
-        simple_term.rvalue.accept(self)
+        yield simple_term.rvalue
         
     
     def visit_complex_term(self, complex_term):
-        complex_term.expr.accept(self)
+        yield complex_term.expr
 
     def visit_simple_rvalue(self, simple_rvalue):
         value = simple_rvalue.value
@@ -576,15 +545,14 @@ class SemanticChecker(Visitor):
                 is_dict = True 
             else:
                 is_array = True
-            new_rvalue.array_expr.accept(self)
+            yield new_rvalue.array_expr
             arr = self.curr_type
             if arr.type_name.token_type != TokenType.INT_TYPE:
                 self.error(f'Mismatch of new expression types {type_token.lexeme} and {arr.type_name.lexeme}', type_token)
         # struct params
         if new_rvalue.type_name.token_type == TokenType.ID:
             # check struct has been defined
-            struct_list = list(self.structs.keys())
-            if new_rvalue.type_name.lexeme not in struct_list:
+            if new_rvalue.type_name.lexeme not in self.structs:
                 self.error(f'Struct {new_rvalue.type_name.lexeme} not defined', new_rvalue.type_name)
             struct = self.structs[new_rvalue.type_name.lexeme]
             # check params
@@ -592,7 +560,7 @@ class SemanticChecker(Visitor):
                 self.error(f'Mismatch of fields given for struct {struct.struct_name.lexeme}', struct.struct_name)
             param_list = new_rvalue.struct_params
             for param in range(len(param_list)):
-                param_list[param].accept(self)
+                yield param_list[param]
                 temp_type = self.curr_type
                 if temp_type.type_name.token_type != struct.fields[param].data_type.type_name.token_type and temp_type.type_name.token_type != TokenType.VOID_TYPE:
                     self.error(f'Mismatch of types for field {temp_type.type_name.lexeme} and {struct.fields[param].data_type.type_name.lexeme}', temp_type.type_name)
@@ -610,16 +578,17 @@ class SemanticChecker(Visitor):
         column = first.var_name.column
         if not self.symbol_table.exists(first.var_name.lexeme):
             self.error(f'Use before def error for {first.var_name.lexeme}', first.var_name)
-        first_type = self.symbol_table.get(first.var_name.lexeme)
-        token = self.symbol_table.get(first.var_name.lexeme).type_name.token_type
+        first.var_def = self.symbol_table.get(first.var_name.lexeme)
+        first_type = first.var_def.data_type
+        token = first_type.type_name.token_type
         key_type = first_type.key_type_name
         element_type = first_type.element_type_name
-        is_array = self.symbol_table.get(first.var_name.lexeme).is_array
-        is_dict = self.symbol_table.get(first.var_name.lexeme).is_dict
+        is_array = first_type.is_array
+        is_dict = first_type.is_dict
 
         # check for array expr on first
         if first.array_expr:
-            first.array_expr.accept(self)
+            yield first.array_expr
             if first_type.is_array:
                 is_array = False
                 # check that it is an integer
@@ -650,7 +619,7 @@ class SemanticChecker(Visitor):
                         self.error(f"field variable {var_rvalue.path[var].var_name.lexeme} doesnt exist for type {first_type.type_name.lexeme}", self.curr_type.type_name)
                 # check for array_expr
                 if var_rvalue.path[var].array_expr:
-                    var_rvalue.path[var].array_expr.accept(self)
+                    yield var_rvalue.path[var].array_expr
                     # array check
                     if first_type.is_array:
                         if self.curr_type.type_name.token_type != TokenType.INT_TYPE:
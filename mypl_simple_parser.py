@@ -19,6 +19,7 @@ class SimpleParser:
 
         """
         self.lexer = lexer
+        self.tokens = TokenStream(lexer.tokens())
         self.curr_token = None
 
         
@@ -54,11 +55,9 @@ class SimpleParser:
 
 
     def advance(self):
-        """Moves to the next token of the lexer."""
-        self.curr_token = self.lexer.next_token()
-        # skip comments
-        while self.match(TokenType.COMMENT):
-            self.curr_token = self.lexer.next_token()
+        """Moves to the next token of the lexer (comments are skipped by
+        the lexer)."""
+        self.curr_token = self.tokens.next()
 
             
     def match(self, token_type):
@@ -6,13 +6,21 @@ CLASS: CPSC 326
 
 """
 
+import sys
 
 
 class SymbolTable:
+    """Nested environments of names, kept as one dictionary from each name
+    to the stack of its bindings (innermost last) so lookups don't depend
+    on the nesting depth. Each environment records the names it added,
+    which are popped off their stacks when the environment is removed."""
 
     def __init__(self):
         """Create an empty symbol table."""
+        # name -> info for each environment, from outermost to innermost
         self.environments = []
+        # name -> stack of infos from the environments that have the name
+        self.bindings = {}
 
         
     def __len__(self):
@@ -35,7 +43,12 @@ class SymbolTable:
 
         """
         if self.environments:
-            self.environments.pop()
+            bindings = self.bindings
+            for name in self.environments.pop():
+                stack = bindings[name]
+                stack.pop()
+                if not stack:
+                    del bindings[name]
 
 
     def add(self, name, info):
@@ -46,7 +59,15 @@ class SymbolTable:
             info -- The info to associate to the name.
         """
         if self.environments:
-            self.environments[-1][name] = info
+            # interned (like the lexer's identifiers) so that lookups by
+            # a token's name match on identity
+            name = sys.intern(name)
+            env = self.environments[-1]
+            if name in env:
+                self.bindings[name][-1] = info
+            else:
+                self.bindings.setdefault(name, []).append(info)
+            env[name] = info
 
             
     def exists(self, name):
@@ -56,10 +77,7 @@ class SymbolTable:
             name: The name to search for.
 
         """
-        for i in range(1, len(self)+1): 
-            if name in self.environments[-i]:
-                return True
-        return False
+        return name in self.bindings
 
     
     def exists_in_curr_env(self, name):
@@ -81,10 +99,7 @@ class SymbolTable:
             name: The name whose info is to be returned.
 
         """
-        n = len(self)
-        for i in range(1, len(self)+1):
-            if name in self.environments[-i]:
-                return self.environments[-i][name]
-        return None
+        stack = self.bindings.get(name)
+        return stack[-1] if stack else None
 
     
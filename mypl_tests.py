@@ -1,5 +1,6 @@
 import pytest
 import io
+import sys
 
 from mypl_error import *  
 from mypl_iowrapper import *
@@ -8,11 +9,18 @@ from mypl_lexer import *
 from mypl_ast_parser import *
 from mypl_symbol_table import *
 from mypl_semantic_checker import *
+from mypl_printer import *
 from mypl_opcode import *
 from mypl_frame import *
 from mypl_vm import *
 from mypl_var_table import *
 from mypl_code_gen import *
+from mypl_builtins import *
+from mypl_cache import *
+from mypl_incremental import *
+from mypl_daemon import *
+from mypl_batch import *
+from mypl_parallel import *
 
 
 
@@ -2260,8 +2268,11 @@ def test_simple_not_bool_expr():
     p = ASTParser(Lexer(in_stream)).parse()
     assert len(p.fun_defs[0].stmts) == 1
     stmt = p.fun_defs[0].stmts[0]
-    assert stmt.expr.not_op == True
-    assert stmt.expr.first.rvalue.value.lexeme == 'true'
+    # not binds tighter than and
+    assert stmt.expr.not_op == False
+    assert stmt.expr.first.expr.not_op == True
+    assert stmt.expr.first.expr.first.rvalue.value.lexeme == 'true'
+    assert stmt.expr.first.expr.op == None
     assert stmt.expr.op.lexeme == 'and'
     assert stmt.expr.rest.not_op == False
     assert stmt.expr.rest.first.rvalue.value.lexeme == 'false'
@@ -2338,16 +2349,17 @@ def test_expr_with_two_ops():
     p = ASTParser(Lexer(in_stream)).parse()
     assert len(p.fun_defs[0].stmts) == 1
     stmt = p.fun_defs[0].stmts[0]
+    # left associative: (1 / 2) * 3
     assert stmt.expr.not_op == False
-    assert stmt.expr.first.rvalue.value.lexeme == '1'
-    assert stmt.expr.op.lexeme == '/'
+    assert stmt.expr.first.expr.first.rvalue.value.lexeme == '1'
+    assert stmt.expr.first.expr.op.lexeme == '/'
+    assert stmt.expr.first.expr.rest.first.rvalue.value.lexeme == '2'
+    assert stmt.expr.first.expr.rest.op == None
+    assert stmt.expr.op.lexeme == '*'
     assert stmt.expr.rest.not_op == False
-    assert stmt.expr.rest.first.rvalue.value.lexeme == '2'
-    assert stmt.expr.rest.op.lexeme == '*'
-    assert stmt.expr.rest.rest.not_op == False
-    assert stmt.expr.rest.rest.first.rvalue.value.lexeme == '3'
-    assert stmt.expr.rest.rest.op == None
-    assert stmt.expr.rest.rest.rest == None    
+    assert stmt.expr.rest.first.rvalue.value.lexeme == '3'
+    assert stmt.expr.rest.op == None
+    assert stmt.expr.rest.rest == None    
 
 def test_empty_call_expr():
     in_stream = FileWrapper(io.StringIO(
@@ -2640,13 +2652,15 @@ def test_expression():
     assert len(p.fun_defs[0].stmts) == 2
     stmt = p.fun_defs[0].stmts[0]
     assert stmt.lvalue[0].var_name.lexeme == 'name'
-    assert stmt.expr.first.expr.first.rvalue.value.lexeme == '4'
-    assert stmt.expr.first.expr.op.lexeme == '+'
-    assert stmt.expr.first.expr.rest.first.rvalue.value.lexeme == '2'
-    assert stmt.expr.op.lexeme == '/'
-    assert stmt.expr.rest.first.rvalue.value.lexeme == '3'
-    assert stmt.expr.rest.op.lexeme == '+'
-    assert stmt.expr.rest.rest.first.rvalue.value.lexeme == '12'
+    # ((4 + 2) / 3) + 12
+    div = stmt.expr.first.expr
+    assert div.first.expr.first.rvalue.value.lexeme == '4'
+    assert div.first.expr.op.lexeme == '+'
+    assert div.first.expr.rest.first.rvalue.value.lexeme == '2'
+    assert div.op.lexeme == '/'
+    assert div.rest.first.rvalue.value.lexeme == '3'
+    assert stmt.expr.op.lexeme == '+'
+    assert stmt.expr.rest.first.rvalue.value.lexeme == '12'
 
 def test_call_expr_and_expr():
     in_stream = FileWrapper(io.StringIO(
@@ -2659,16 +2673,18 @@ def test_call_expr_and_expr():
     assert len(p.fun_defs[0].stmts) == 2
     stmt = p.fun_defs[0].stmts[0]
     assert stmt.lvalue[0].var_name.lexeme == 'name'
-    assert stmt.expr.first.expr.first.rvalue.value.lexeme == '4'
-    assert stmt.expr.first.expr.op.lexeme == '+'
-    assert stmt.expr.first.expr.rest.first.rvalue.value.lexeme == '2'
-    assert stmt.expr.op.lexeme == '/'
-    assert stmt.expr.rest.first.rvalue.value.lexeme == '3'
-    assert stmt.expr.rest.op.lexeme == '+'
-    assert stmt.expr.rest.rest.first.rvalue.fun_name.lexeme == 'func'
-    assert len(stmt.expr.rest.rest.first.rvalue.args) == 2
-    assert stmt.expr.rest.rest.first.rvalue.args[0].first.rvalue.path[0].var_name.lexeme == 'arr'
-    assert stmt.expr.rest.rest.first.rvalue.args[1].first.rvalue.value.lexeme == '2'
+    # ((4 + 2) / 3) + func(arr[1], 2)
+    div = stmt.expr.first.expr
+    assert div.first.expr.first.rvalue.value.lexeme == '4'
+    assert div.first.expr.op.lexeme == '+'
+    assert div.first.expr.rest.first.rvalue.value.lexeme == '2'
+    assert div.op.lexeme == '/'
+    assert div.rest.first.rvalue.value.lexeme == '3'
+    assert stmt.expr.op.lexeme == '+'
+    assert stmt.expr.rest.first.rvalue.fun_name.lexeme == 'func'
+    assert len(stmt.expr.rest.first.rvalue.args) == 2
+    assert stmt.expr.rest.first.rvalue.args[0].first.rvalue.path[0].var_name.lexeme == 'arr'
+    assert stmt.expr.rest.first.rvalue.args[1].first.rvalue.value.lexeme == '2'
 
 def test_trace_expr():
     in_stream = FileWrapper(io.StringIO(
@@ -2847,6 +2863,23 @@ def test_multiple_environments():
     assert table.exists('y') and table.get('y') == 'double'
     table.pop_environment()
 
+def test_shadowing_undone_on_pop():
+    table = SymbolTable()
+    table.push_environment()
+    table.add('x', 'int')
+    table.add('x', 'double')
+    for i in range(1000):
+        table.push_environment()
+        table.add('x', i)
+        table.add(f'y{i}', i)
+    assert table.get('x') == 999 and table.get('y0') == 0
+    for i in range(1000):
+        table.pop_environment()
+    assert table.get('x') == 'double' and not table.exists('y0')
+    table.pop_environment()
+    assert not table.exists('x') and table.get('x') is None
+    assert table.bindings == {}
+
     
 # # #----------------------------------------------------------------------
 # # # BASIC FUNCTION DEFINITIONS
@@ -5343,6 +5376,34 @@ def test_jump_false_no_jump(capsys):
     captured = capsys.readouterr()
     assert captured.out == 'bluegreen'
 
+def test_jump_true_forward(capsys):
+    main = VMFrameTemplate('main', 0)
+    main.instructions.append(PUSH(True))
+    main.instructions.append(JMPT(4))
+    main.instructions.append(PUSH('blue'))
+    main.instructions.append(WRITE())
+    main.instructions.append(PUSH('green'))
+    main.instructions.append(WRITE())
+    vm = VM()
+    vm.add_frame_template(main)
+    vm.run()
+    captured = capsys.readouterr()
+    assert captured.out == 'green'
+
+def test_jump_true_no_jump(capsys):
+    main = VMFrameTemplate('main', 0)
+    main.instructions.append(PUSH(False))
+    main.instructions.append(JMPT(4))
+    main.instructions.append(PUSH('blue'))
+    main.instructions.append(WRITE())
+    main.instructions.append(PUSH('green'))
+    main.instructions.append(WRITE())
+    vm = VM()
+    vm.add_frame_template(main)
+    vm.run()
+    captured = capsys.readouterr()
+    assert captured.out == 'bluegreen'
+
 def test_jump_backwards(capsys):
     main = VMFrameTemplate('main', 0)
     main.instructions.append(PUSH(0))       # 0
@@ -6246,6 +6307,98 @@ def test_var_table_multiple_environments():
     assert table.get('z') == None
     assert table.get('u') == None
 
+def test_var_table_redeclared_and_shadowed_names():
+    table = VarTable()
+    table.push_environment()
+    table.add('x')
+    table.add('x')
+    assert table.get('x') == 0 and table.total_vars == 2
+    table.push_environment()
+    table.add('x')
+    table.add('x')
+    assert table.get('x') == 2
+    table.pop_environment()
+    assert table.get('x') == 0
+    table.pop_environment()
+    assert table.get('x') == None and table.slots == {}
+
+def test_checker_resolves_var_slots(capsys):
+    program = (
+        'void main() { \n'
+        '  int x = 1; int y = 2; \n'
+        '  for (int i = 0; i < 2; i = i + 1) { int x = i * 10; y = y + x; } \n'
+        '  if (y > 0) { int z = y; x = x + z; } \n'
+        '  while (x < 100) { int w = x; x = w * 2; } \n'
+        '  print(x); print(" "); print(y); \n'
+        '} \n'
+    )
+    ast = ASTParser(Lexer(FileWrapper(io.StringIO(program)))).parse()
+    ast.accept(SemanticChecker())
+    refs = [ref for stmt in ast.fun_defs[0].stmts for ref in walk_nodes(stmt) if isinstance(ref, VarRef)]
+    assert all(ref.var_def is not None for ref in refs if ref.var_name.lexeme in ('y', 'w'))
+    vm = VM()
+    ast.accept(CodeGenerator(vm))
+    assert str(vm) == str(build(program))
+    vm.run()
+    assert capsys.readouterr().out == '104 12'
+
+def test_checker_resolves_array_index_and_for_update():
+    program = (
+        'void main() { \n'
+        '  array int xs = new int[2]; int k = 0; \n'
+        '  for (int i = 0; i < 2; i = i + 1) { xs[k] = i; } \n'
+        '} \n'
+    )
+    ast = ASTParser(Lexer(FileWrapper(io.StringIO(program)))).parse()
+    ast.accept(SemanticChecker())
+    for_stmt = ast.fun_defs[0].stmts[2]
+    assert for_stmt.assign_stmt.expr.first.rvalue.path[0].var_def is for_stmt.var_decl.var_def
+    assert for_stmt.stmts[0].lvalue[0].array_expr.first.rvalue.path[0].var_def is ast.fun_defs[0].stmts[1].var_def
+    for bad in ['xs["a"] = 1;', 'for (int i = 0; i < 2; i = "a") {}',
+                'for (int i = 0; i < 2; i = j) { int j = 1; }']:
+        in_stream = FileWrapper(io.StringIO(f'void main() {{ array int xs = new int[2]; {bad} }}'))
+        with pytest.raises(MyPLError) as e:
+            ASTParser(Lexer(in_stream)).parse().accept(SemanticChecker())
+        assert str(e.value).startswith('Static Error:')
+
+class SlotCheckingGenerator(CodeGenerator):
+    # checks each declaration's index against the innermost variable
+    # with the reference's name
+    def var_index(self, var_ref):
+        name = var_ref.var_name.lexeme
+        slot = self.slots.get((id(var_ref.var_def), name))
+        assert slot is not None and slot[0] is var_ref.var_def
+        assert slot[1] == self.var_table.get(name)
+        self.resolved += 1
+        return super().var_index(var_ref)
+
+def test_var_slots_match_var_table_when_optimized(capsys):
+    program = (
+        'struct P { int x; int y; } \n'
+        'int add(int a, int b) { int s = a + b; if (s < 0) { return 0; } return s; } \n'
+        'void main() { \n'
+        '  int t = 0; int t = 5; \n'
+        '  P p = new P(1, 2); \n'
+        '  array int xs = new int[4]; \n'
+        '  for (int i = 0; i < 4; i = i + 1) { int v = i * t; xs[i] = v + v; t = add(t, p.x); } \n'
+        '  for (int j = 0; j < 2; j = j + 1) { int t = xs[j]; print(t); print(" "); } \n'
+        '  p.y = xs[3] * 2 + xs[3] * 2; \n'
+        '  print(t); print(" "); print(p.y); \n'
+        '} \n'
+    )
+    expected = '0 2 4 72'
+    profile = profile_run(program, capsys)
+    for opt_level, prof in [(0, None), (1, None), (2, None), (0, profile), (2, profile)]:
+        ast = ASTParser(Lexer(FileWrapper(io.StringIO(program)))).parse()
+        ast.accept(SemanticChecker())
+        vm = VM()
+        codegen = SlotCheckingGenerator(vm, opt_level, prof)
+        codegen.resolved = 0
+        ast.accept(codegen)
+        assert codegen.resolved > 0
+        vm.run()
+        assert capsys.readouterr().out == expected
+
     
 # # # #----------------------------------------------------------------------
 # # # # SIMPLE GETTING STARTED TESTS
@@ -7574,3 +7727,1501 @@ def test_not_in_dict(capsys):
     assert captured.out == 'false'
 
 
+#########################
+#   Optimization tests  #
+#########################
+
+# helper function to build an optimized vm from the program string
+def build_opt(program, opt_level=1, profile=None):
+    vm = VM()
+    cg = CodeGenerator(vm, opt_level, profile)
+    ASTParser(Lexer(FileWrapper(io.StringIO(program)))).parse().accept(cg)
+    return vm
+
+# helper function to count the opcodes of a function in a vm
+def count_ops(vm, fun_name, opcode):
+    instrs = vm.frame_templates[fun_name].instructions
+    return len([i for i in instrs if i.opcode == opcode])
+
+#----------------------------------------------------------------------
+# Common subexpression elimination
+#----------------------------------------------------------------------
+
+def test_cse_repeated_array_read(capsys):
+    program = (
+        'void main() { \n'
+        '  array int xs = new int[3]; \n'
+        '  xs[0] = 2; xs[1] = 0; xs[2] = 2; \n'
+        '  dict(int, int) counts = new dict(); \n'
+        '  counts[2] = 0; counts[0] = 0; \n'
+        '  for (int i = 0; i < 3; i = i + 1) { \n'
+        '    counts[xs[i]] = counts[xs[i]] + 1; \n'
+        '  } \n'
+        '  print(counts[2]); print(counts[0]); \n'
+        '} \n'
+    )
+    unopt = count_ops(build_opt(program, 0), 'main', OpCode.GETI)
+    vm = build_opt(program)
+    vm.run()
+    captured = capsys.readouterr()
+    assert captured.out == '21'
+    assert count_ops(vm, 'main', OpCode.GETI) == unopt - 1
+
+def test_cse_across_statements(capsys):
+    program = (
+        'void main() { \n'
+        '  int x = 3; \n'
+        '  int y = 4; \n'
+        '  int a = (x * y) + 1; \n'
+        '  int b = (x * y) + 2; \n'
+        '  print(a); print(" "); print(b); \n'
+        '} \n'
+    )
+    vm = build_opt(program)
+    vm.run()
+    captured = capsys.readouterr()
+    assert captured.out == '13 14'
+    assert count_ops(vm, 'main', OpCode.MUL) == 1
+
+def test_cse_killed_by_variable_assign(capsys):
+    program = (
+        'void main() { \n'
+        '  int x = 3; \n'
+        '  int a = (x * x) + 1; \n'
+        '  x = 4; \n'
+        '  int b = (x * x) + 1; \n'
+        '  print(a); print(" "); print(b); \n'
+        '} \n'
+    )
+    vm = build_opt(program)
+    vm.run()
+    captured = capsys.readouterr()
+    assert captured.out == '10 17'
+    assert count_ops(vm, 'main', OpCode.MUL) == 2
+
+def test_cse_killed_by_heap_write(capsys):
+    program = (
+        'struct T {int v;} \n'
+        'void main() { \n'
+        '  T t = new T(1); \n'
+        '  array int xs = new int[2]; \n'
+        '  xs[0] = 5; \n'
+        '  int a = t.v + xs[0]; \n'
+        '  xs[0] = 7; \n'
+        '  t.v = 2; \n'
+        '  int b = t.v + xs[0]; \n'
+        '  print(a); print(" "); print(b); \n'
+        '} \n'
+    )
+    build_opt(program).run()
+    captured = capsys.readouterr()
+    assert captured.out == '6 9'
+
+def test_cse_killed_by_user_call(capsys):
+    program = (
+        'void set(array int xs) { xs[0] = 9; } \n'
+        'void main() { \n'
+        '  array int xs = new int[1]; \n'
+        '  xs[0] = 1; \n'
+        '  int a = xs[0] + 1; \n'
+        '  set(xs); \n'
+        '  int b = xs[0] + 1; \n'
+        '  print(a); print(" "); print(b); \n'
+        '} \n'
+    )
+    build_opt(program).run()
+    captured = capsys.readouterr()
+    assert captured.out == '2 10'
+
+def test_cse_in_condition_and_nested_blocks(capsys):
+    program = (
+        'void main() { \n'
+        '  array int xs = new int[4]; \n'
+        '  for (int i = 0; i < 4; i = i + 1) { xs[i] = i * i; } \n'
+        '  int j = 0; \n'
+        '  while ((xs[j] + xs[j]) < 8) { \n'
+        '    if (xs[j] == 1) { int k = xs[j] + xs[j]; print(k); } \n'
+        '    else { print(xs[j]); } \n'
+        '    j = j + 1; \n'
+        '  } \n'
+        '  print(j); \n'
+        '} \n'
+    )
+    build_opt(program).run()
+    captured = capsys.readouterr()
+    assert captured.out == '022'
+
+def test_cse_plan_records_statement_effects():
+    program = 'void main() { int a = 1; a = a + 2; f(a); xs[0] = a; }'
+    stmts = ASTParser(Lexer(FileWrapper(io.StringIO(program)))).parse().fun_defs[0].stmts
+    effects = {}
+    plan_cse(stmts, effects)
+    assert [effects[id(stmt)] for stmt in stmts] == [stmt_effects(stmt) for stmt in stmts]
+    assert effects[id(stmts[2])] == (set(), True, True)
+    assert effects[id(stmts[3])] == (set(), True, False)
+
+#----------------------------------------------------------------------
+# Constant folding and loop unrolling
+#----------------------------------------------------------------------
+
+def test_constant_folding(capsys):
+    program = (
+        'void main() { \n'
+        '  print(2 * (3 + 4)); \n'
+        '  print(not (1 < 2)); \n'
+        '  print("a" + "b"); \n'
+        '} \n'
+    )
+    vm = build_opt(program)
+    vm.run()
+    captured = capsys.readouterr()
+    assert captured.out == '14falseab'
+    assert count_ops(vm, 'main', OpCode.MUL) == 0
+    assert count_ops(vm, 'main', OpCode.CMPLT) == 0
+
+def test_constant_folding_keeps_runtime_errors():
+    program = (
+        'void main() { \n'
+        '  int x = 1 / 0; \n'
+        '} \n'
+    )
+    with pytest.raises(MyPLError) as e:
+        build_opt(program).run()
+    assert str(e.value).startswith('VM Error:')
+
+def test_unroll_constant_loop(capsys):
+    program = (
+        'void main() { \n'
+        '  array int xs = new int[5]; \n'
+        '  for (int i = 0; i < 5; i = i + 1) { \n'
+        '    xs[i] = i * 2; \n'
+        '  } \n'
+        '  for (int i = 4; i >= 0; i = i - 1) { \n'
+        '    print(xs[i]); \n'
+        '  } \n'
+        '} \n'
+    )
+    vm = build_opt(program, 2)
+    vm.run()
+    captured = capsys.readouterr()
+    assert captured.out == '86420'
+    assert count_ops(vm, 'main', OpCode.JMPT) == 0
+    assert count_ops(vm, 'main', OpCode.MUL) == 0
+
+def test_unroll_not_at_level_one():
+    program = (
+        'void main() { \n'
+        '  for (int i = 0; i < 3; i = i + 1) { print(i); } \n'
+        '} \n'
+    )
+    vm = build_opt(program, 1)
+    assert count_ops(vm, 'main', OpCode.JMPT) == 1
+
+def test_unroll_respects_budget(capsys):
+    program = (
+        'void main() { \n'
+        '  int sum = 0; \n'
+        '  for (int i = 0; i < 100; i = i + 1) { sum = sum + i; } \n'
+        '  for (int j = 0; j < 10; j = j + 1) { sum = sum + j; } \n'
+        '  print(sum); \n'
+        '} \n'
+    )
+    vm = VM()
+    cg = CodeGenerator(vm, 2)
+    cg.unroll_budget = 20
+    ASTParser(Lexer(FileWrapper(io.StringIO(program)))).parse().accept(cg)
+    vm.run()
+    captured = capsys.readouterr()
+    assert captured.out == '4995'
+    # too many trips for the first loop and too large for the second
+    assert count_ops(vm, 'main', OpCode.JMPT) == 2
+
+def test_unroll_skips_modified_induction_var(capsys):
+    program = (
+        'void main() { \n'
+        '  for (int i = 0; i < 6; i = i + 1) { \n'
+        '    print(i); \n'
+        '    i = i + 1; \n'
+        '  } \n'
+        '} \n'
+    )
+    vm = build_opt(program, 2)
+    vm.run()
+    captured = capsys.readouterr()
+    assert captured.out == '024'
+    assert count_ops(vm, 'main', OpCode.JMPT) == 1
+
+#----------------------------------------------------------------------
+# Escape analysis and scalar replacement
+#----------------------------------------------------------------------
+
+def test_scalar_replaced_struct(capsys):
+    program = (
+        'struct Point {int x; int y;} \n'
+        'int dist(int x1, int y1, int x2, int y2) { \n'
+        '  Point d = new Point(x2 - x1, y2 - y1); \n'
+        '  if (d.x < 0) { d.x = 0 - d.x; } \n'
+        '  if (d.y < 0) { d.y = 0 - d.y; } \n'
+        '  return d.x + d.y; \n'
+        '} \n'
+        'void main() { \n'
+        '  print(dist(1, 5, 4, 1)); \n'
+        '} \n'
+    )
+    vm = build_opt(program, 2)
+    vm.run()
+    captured = capsys.readouterr()
+    assert captured.out == '7'
+    assert count_ops(vm, 'dist', OpCode.ALLOCS) == 0
+    assert count_ops(vm, 'dist', OpCode.GETF) == 0
+    assert count_ops(vm, 'dist', OpCode.SETF) == 0
+
+def test_scalar_replaced_struct_with_array_field(capsys):
+    program = (
+        'struct Buf {array int data; int n;} \n'
+        'void main() { \n'
+        '  for (int k = 0; k < 3; k = k + 1) { \n'
+        '    Buf b = new Buf(new int[2], k); \n'
+        '    b.data[0] = b.n; \n'
+        '    b.data[1] = b.data[0] + 1; \n'
+        '    print(b.data[1]); \n'
+        '  } \n'
+        '} \n'
+    )
+    vm = build_opt(program, 2)
+    vm.run()
+    captured = capsys.readouterr()
+    assert captured.out == '123'
+    assert count_ops(vm, 'main', OpCode.ALLOCS) == 0
+
+def test_escaping_structs_stay_on_heap(capsys):
+    program = (
+        'struct P {int v;} \n'
+        'struct Box {P p;} \n'
+        'P make(int v) { P p = new P(v); return p; } \n'
+        'void show(P p) { print(p.v); } \n'
+        'void main() { \n'
+        '  P a = new P(1); \n'
+        '  show(a); \n'
+        '  P b = new P(2); \n'
+        '  Box box = new Box(b); \n'
+        '  print(box.p.v); \n'
+        '  P m = make(3); \n'
+        '  print(m.v); \n'
+        '  P c = new P(4); \n'
+        '  c = new P(5); \n'
+        '  print(c.v); \n'
+        '} \n'
+    )
+    vm = build_opt(program, 2)
+    vm.run()
+    captured = capsys.readouterr()
+    assert captured.out == '1235'
+    assert count_ops(vm, 'make', OpCode.ALLOCS) == 1
+    # a, b, and c escape or are reassigned; box only has field reads
+    assert count_ops(vm, 'main', OpCode.ALLOCS) == 4
+
+def test_struct_path_from_dict_element(capsys):
+    program = (
+        'struct P {int v;} \n'
+        'void main() { \n'
+        '  dict(string, P) d = new dict(); \n'
+        '  d["a"] = new P(3); \n'
+        '  d["a"].v = 4; \n'
+        '  print(d["a"].v); \n'
+        '} \n'
+    )
+    build(program).run()
+    captured = capsys.readouterr()
+    assert captured.out == '4'
+
+#----------------------------------------------------------------------
+# Loop rotation
+#----------------------------------------------------------------------
+
+def test_rotated_loops(capsys):
+    program = (
+        'void main() { \n'
+        '  int i = 0; \n'
+        '  while (i < 3) { \n'
+        '    for (int j = 0; j < i; j = j + 1) { print(j); } \n'
+        '    print(";"); \n'
+        '    i = i + 1; \n'
+        '  } \n'
+        '} \n'
+    )
+    vm = build_opt(program)
+    vm.run()
+    captured = capsys.readouterr()
+    assert captured.out == ';0;01;'
+    assert count_ops(vm, 'main', OpCode.JMP) == 0
+    assert count_ops(vm, 'main', OpCode.JMPT) == 2
+
+def test_rotated_loops_zero_iterations(capsys):
+    program = (
+        'void main() { \n'
+        '  while (false) { print("no"); } \n'
+        '  for (int i = 5; i < 3; i = i + 1) { print("no"); } \n'
+        '  print("done"); \n'
+        '} \n'
+    )
+    build_opt(program).run()
+    captured = capsys.readouterr()
+    assert captured.out == 'done'
+
+#----------------------------------------------------------------------
+# Profile-guided optimization
+#----------------------------------------------------------------------
+
+# helper function to profile a program (discarding its output)
+def profile_run(program, capsys):
+    vm = build_opt(program, 0)
+    vm.run(profile=True)
+    capsys.readouterr()
+    return vm.profile()
+
+def test_profile_counts(capsys):
+    program = (
+        'int f(int x) { return x + 1; } \n'
+        'void main() { \n'
+        '  int i = 0; \n'
+        '  while (i < 3) { \n'
+        '    if (i == 1) { print(f(i)); } \n'
+        '    i = i + 1; \n'
+        '  } \n'
+        '} \n'
+    )
+    profile = profile_run(program, capsys)
+    assert profile['functions']['main']['calls'] == 1
+    assert profile['functions']['f']['calls'] == 1
+    assert profile['branches'] == {'5:9': {'true': 1, 'false': 2}}
+    assert profile['call_sites'] == {'5:25': 1}
+    counts = profile['functions']['f']['instructions']
+    assert counts == [1] * len(counts)
+
+def test_profile_inlines_hot_calls(capsys):
+    program = (
+        'int add(int x, int y) { \n'
+        '  if (x < 0) { return 0; } \n'
+        '  return x + y; \n'
+        '} \n'
+        'void main() { \n'
+        '  int t = 0; \n'
+        '  for (int i = 0; i < 10; i = i + 1) { t = t + add(i, 2); } \n'
+        '  print(add(0 - 1, 1)); print(" "); print(t); \n'
+        '} \n'
+    )
+    profile = profile_run(program, capsys)
+    vm = build_opt(program, 0, profile)
+    vm.run()
+    captured = capsys.readouterr()
+    assert captured.out == '0 65'
+    # only the call in the loop is hot
+    assert count_ops(vm, 'main', OpCode.CALL) == 1
+
+def test_profile_does_not_inline_recursive_calls(capsys):
+    program = (
+        'int fac(int n) { \n'
+        '  if (n <= 1) { return 1; } \n'
+        '  return n * fac(n - 1); \n'
+        '} \n'
+        'void main() { for (int i = 0; i < 5; i = i + 1) { print(fac(i)); } } \n'
+    )
+    profile = profile_run(program, capsys)
+    vm = build_opt(program, 0, profile)
+    vm.run()
+    captured = capsys.readouterr()
+    assert captured.out == '112624'
+    assert count_ops(vm, 'main', OpCode.CALL) == 1
+
+def test_profile_loop_counts(capsys):
+    program = (
+        'void main() { \n'
+        '  for (int i = 0; i < 3; i = i + 1) { \n'
+        '    int j = 0; \n'
+        '    while (j < i) { j = j + 1; } \n'
+        '  } \n'
+        '} \n'
+    )
+    # the same counts with the test at the top or rotated to the bottom
+    for opt_level in range(2):
+        vm = build_opt(program, opt_level)
+        vm.run(profile=True)
+        profile = vm.profile()
+        assert profile['loops'] == {'2:19': {'true': 3, 'false': 1},
+                                    '4:12': {'true': 3, 'false': 3}}
+        assert profile['branches'] == {}
+
+def test_profile_moves_cold_branches(capsys):
+    program = (
+        'void main() { \n'
+        '  for (int i = 0; i < 20; i = i + 1) { \n'
+        '    if (i == 13) { print("*"); } \n'
+        '    else { print("."); if (i > 18) { print("!"); } } \n'
+        '  } \n'
+        '} \n'
+    )
+    profile = profile_run(program, capsys)
+    vm = build_opt(program, 0, profile)
+    vm.run()
+    captured = capsys.readouterr()
+    assert captured.out == '.' * 13 + '*' + '.' * 6 + '!'
+    # the rarely printed strings are moved after the return
+    instrs = vm.frame_templates['main'].instructions
+    ret = [i.opcode for i in instrs].index(OpCode.RET)
+    assert [i.operand for i in instrs[ret:] if i.opcode == OpCode.PUSH] == ['*', '!']
+
+def test_profile_reorders_exclusive_tests(capsys):
+    program = (
+        'void main() { \n'
+        '  for (int i = 0; i < 10; i = i + 1) { \n'
+        '    int k = 0; \n'
+        '    if (i > 3) { k = 2; } elseif (i > 1) { k = 1; } \n'
+        '    if (k == 0) { print("a"); } \n'
+        '    elseif (k == 1) { print("b"); } \n'
+        '    elseif (k == 2) { print("c"); } \n'
+        '  } \n'
+        '} \n'
+    )
+    profile = profile_run(program, capsys)
+    vm = build_opt(program, 0, profile)
+    vm.run()
+    captured = capsys.readouterr()
+    assert captured.out == 'aabbcccccc'
+    # k == 2 is tested first, but the overlapping i tests keep their order
+    pushes = [i.operand for i in vm.frame_templates['main'].instructions if i.opcode == OpCode.PUSH]
+    assert pushes[pushes.index(3):][:2] == [3, 2]
+    assert pushes.index(2, pushes.index(1)) < pushes.index(0, pushes.index(1))
+
+def test_profile_without_data_keeps_layout(capsys):
+    program = (
+        'void main() { \n'
+        '  if (true) { print("x"); } else { print("y"); } \n'
+        '} \n'
+    )
+    vm = build_opt(program, 0, {'branches': {}, 'call_sites': {}})
+    assert vm.frame_templates == build(program).frame_templates
+
+#----------------------------------------------------------------------
+# Partial evaluation
+#----------------------------------------------------------------------
+
+def test_vm_run_returns_main_value():
+    main = VMFrameTemplate('main', 0)
+    main.instructions.append(PUSH(42))
+    main.instructions.append(RET())
+    vm = VM()
+    vm.add_frame_template(main)
+    assert vm.run() == 42
+
+def test_vm_instruction_budget():
+    main = VMFrameTemplate('main', 0)
+    main.instructions.append(JMP(0))
+    vm = VM()
+    vm.add_frame_template(main)
+    vm.max_steps = 100
+    with pytest.raises(MyPLError) as e:
+        vm.run()
+    assert str(e.value).startswith('VM Error: instruction budget exceeded')
+
+def test_partial_eval_pure_calls(capsys):
+    program = (
+        'int sum_to(int n) { \n'
+        '  int s = 0; \n'
+        '  for (int i = 1; i <= n; i = i + 1) { s = s + i; } \n'
+        '  return s; \n'
+        '} \n'
+        'string twice(string s) { return s + s; } \n'
+        'void main() { \n'
+        '  print(sum_to(100)); print(twice("ab")); print(sum_to(sum_to(3))); \n'
+        '} \n'
+    )
+    vm = build_opt(program, 2)
+    assert count_ops(vm, 'main', OpCode.CALL) == 0
+    comments = [i.comment for i in vm.frame_templates['main'].instructions if i.comment]
+    assert comments == ['folded sum_to(100)', 'folded twice("ab")', 'folded sum_to(sum_to(3))']
+    vm.run()
+    captured = capsys.readouterr()
+    assert captured.out == '5050abab21'
+
+def test_partial_eval_skips_impure_calls(capsys):
+    program = (
+        'int noisy(int x) { print("hi"); return x; } \n'
+        'int calls_noisy(int x) { return noisy(x) + 1; } \n'
+        'int nums(int x) { array int xs = new int[2]; xs[0] = x; return length(xs) + xs[0]; } \n'
+        'void main() { print(calls_noisy(1)); print(nums(3)); } \n'
+    )
+    vm = build_opt(program, 2)
+    assert count_ops(vm, 'main', OpCode.CALL) == 1
+    vm.run()
+    captured = capsys.readouterr()
+    assert captured.out == 'hi25'
+
+def test_partial_eval_leaves_errors_for_run_time():
+    program = (
+        'int f(int x) { return x / 0; } \n'
+        'int g(int x) { while (true) { x = x + 1; } return x; } \n'
+        'void main() { int z = f(1); int y = g(1); } \n'
+    )
+    vm = build_opt(program, 2)
+    assert count_ops(vm, 'main', OpCode.CALL) == 2
+    with pytest.raises(MyPLError):
+        vm.run()
+
+def test_partial_eval_reports_compiler_bugs(monkeypatch):
+    program = (
+        'int f(int x) { return x * 2; } \n'
+        'void main() { print(f(4)); } \n'
+    )
+    def broken_run(self, debug=False, profile=False):
+        raise TypeError('broken')
+    monkeypatch.setattr(VM, 'run', broken_run)
+    with pytest.raises(TypeError):
+        build_opt(program, 2)
+
+def test_partial_eval_not_at_level_one(capsys):
+    program = (
+        'int f(int x) { return x * 2; } \n'
+        'void main() { print(f(4)); } \n'
+    )
+    vm = build_opt(program, 1)
+    assert count_ops(vm, 'main', OpCode.CALL) == 1
+    vm.run()
+    captured = capsys.readouterr()
+    assert captured.out == '8'
+
+#----------------------------------------------------------------------
+# Bounds check elimination
+#----------------------------------------------------------------------
+
+def test_unchecked_array_ops(capsys):
+    main = VMFrameTemplate('main', 0)
+    main.instructions.append(PUSH(2))
+    main.instructions.append(ALLOCA())
+    main.instructions.append(DUP())
+    main.instructions.append(PUSH(1))
+    main.instructions.append(PUSH('x'))
+    main.instructions.append(SETIU())
+    main.instructions.append(PUSH(1))
+    main.instructions.append(GETIU())
+    main.instructions.append(WRITE())
+    vm = VM()
+    vm.add_frame_template(main)
+    vm.run()
+    captured = capsys.readouterr()
+    assert captured.out == 'x'
+
+def test_length_bounded_loop_skips_checks(capsys):
+    program = (
+        'void main() { \n'
+        '  array int xs = new int[4]; \n'
+        '  for (int i = 0; i < length(xs); i = i + 1) { xs[i] = i * 2; } \n'
+        '  for (int i = 1; i < length(xs); i = i + 2) { print(xs[i]); } \n'
+        '} \n'
+    )
+    vm = build_opt(program)
+    assert count_ops(vm, 'main', OpCode.SETI) == 0
+    assert count_ops(vm, 'main', OpCode.GETI) == 0
+    assert count_ops(vm, 'main', OpCode.SETIU) == 1
+    assert count_ops(vm, 'main', OpCode.GETIU) == 1
+    vm.run()
+    captured = capsys.readouterr()
+    assert captured.out == '26'
+
+def test_unbounded_loops_keep_checks():
+    program = (
+        'void main() { \n'
+        '  array int xs = new int[4]; \n'
+        '  array int ys = new int[2]; \n'
+        '  for (int i = 0; i <= length(xs); i = i + 1) { xs[i] = 0; } \n'
+        '  for (int i = 0; i < length(xs); i = i + 1) { ys[i] = 0; } \n'
+        '  for (int i = 0; i < length(xs); i = i + 1) { xs[i + 1] = 0; } \n'
+        '  for (int i = 0; i < length(xs); i = i + 1) { xs = ys; xs[i] = 0; } \n'
+        '  for (int i = 0; i < length(xs); i = i + 1) { i = i - 1; xs[i] = 0; } \n'
+        '} \n'
+    )
+    vm = build_opt(program)
+    assert count_ops(vm, 'main', OpCode.SETIU) == 0
+    assert count_ops(vm, 'main', OpCode.SETI) == 5
+
+def test_length_bounded_loop_over_empty_array(capsys):
+    program = (
+        'void main() { \n'
+        '  array int xs = new int[0]; \n'
+        '  for (int i = 0; i < length(xs); i = i + 1) { print(xs[i]); } \n'
+        '  print("done"); \n'
+        '} \n'
+    )
+    build_opt(program).run()
+    captured = capsys.readouterr()
+    assert captured.out == 'done'
+
+#----------------------------------------------------------------------
+# Compiled program cache
+#----------------------------------------------------------------------
+
+def test_cache_round_trip(capsys):
+    program = (
+        'struct P { int x; string s; } \n'
+        'double f(double d, bool b) { if (b) { return d * 2.5; } return d; } \n'
+        'void main() { \n'
+        '  P p = new P(123456789012345678901234567890, "caf\u00e9\\n"); \n'
+        '  print(p.x); print(p.s); print(f(2.0, true)); print(null); \n'
+        '} \n'
+    )
+    vm = build(program)
+    data = encode_templates(vm.frame_templates)
+    templates = decode_templates(data)
+    assert list(templates) == list(vm.frame_templates)
+    for name, template in vm.frame_templates.items():
+        assert templates[name].arg_count == template.arg_count
+        assert templates[name].instructions == template.instructions
+    vm = VM()
+    vm.frame_templates = templates
+    vm.run()
+    captured = capsys.readouterr()
+    assert captured.out == '123456789012345678901234567890caf\u00e9\n5.0null'
+
+def test_cached_templates_decode_on_demand():
+    vm = build('int f() { return 1; } int g() { return 2; } void main() { } \n')
+    templates = CachedTemplates(encode_templates(vm.frame_templates))
+    assert 'g' in templates and len(templates) == 3
+    assert dict.__len__(templates) == 0
+    assert templates['g'].instructions == vm.frame_templates['g'].instructions
+    assert dict.__len__(templates) == 1
+    with pytest.raises(KeyError):
+        templates['h']
+
+def test_cache_files(tmp_path):
+    vm = build('void main() { print("hi"); } \n')
+    key = cache_key('void main() { print("hi"); } \n')
+    assert key != cache_key('void main() { print("hi"); } \n', 1)
+    assert load_templates(tmp_path, key) is None
+    save_templates(tmp_path, key, vm.frame_templates)
+    templates = load_templates(tmp_path, key)
+    assert templates['main'].instructions == vm.frame_templates['main'].instructions
+    # bad entries are ignored
+    with open(cache_path(tmp_path, key), 'wb') as f:
+        f.write(encode_templates(vm.frame_templates)[:-3])
+    assert load_templates(tmp_path, key) is None
+    with open(cache_path(tmp_path, key), 'wb') as f:
+        f.write(b'')
+    assert load_templates(tmp_path, key) is None
+
+def test_cache_dir_not_used_with_lazy_or_jobs(tmp_path, monkeypatch, capsys):
+    import mypl
+    prog = tmp_path / 'prog.mypl'
+    prog.write_text('void main() { print("hi"); } \n')
+    cache_dir = tmp_path / 'cache'
+    cache_dir.mkdir()
+    for flags in (['--lazy'], ['-j', '2']):
+        with pytest.raises(SystemExit):
+            mypl.main(['--cache-dir', str(cache_dir)] + flags + [str(prog)])
+        assert '--cache-dir cannot be used with --lazy or -j' in capsys.readouterr().err
+    # a cache directory from the environment is skipped instead
+    monkeypatch.setenv('MYPL_CACHE_DIR', str(cache_dir))
+    mypl.main(['--lazy', str(prog)])
+    assert capsys.readouterr().out == 'hi'
+    assert list(cache_dir.iterdir()) == []
+    mypl.main([str(prog)])
+    assert capsys.readouterr().out == 'hi'
+    assert len(list(cache_dir.iterdir())) == 1
+
+#----------------------------------------------------------------------
+# Lazy code generation
+#----------------------------------------------------------------------
+
+def build_lazy(program):
+    vm = VM()
+    cg = CodeGenerator(vm, 0, lazy=True)
+    ASTParser(Lexer(FileWrapper(io.StringIO(program)))).parse().accept(cg)
+    return vm
+
+def test_lazy_codegen_only_called_functions(capsys):
+    program = (
+        'int f(int x) { return x + 1; } \n'
+        'int g(int x) { return x + 2; } \n'
+        'void h() { print(g(1)); } \n'
+        'void main() { print(f(1)); if (false) { h(); } } \n'
+    )
+    vm = build_lazy(program)
+    assert 'g' in vm.frame_templates and len(vm.frame_templates) == 4
+    assert dict.__len__(vm.frame_templates) == 0
+    vm.run()
+    captured = capsys.readouterr()
+    assert captured.out == '2'
+    assert sorted(dict.keys(vm.frame_templates)) == ['f', 'main']
+
+def test_lazy_codegen_matches_eager():
+    program = (
+        'struct S { dict(string, int) d; } \n'
+        'int f(S s) { dict(string, int) d = s.d; return d["a"]; } \n'
+        'void main() { S s = new S(new dict()); s.d["a"] = 3; print(f(s)); } \n'
+    )
+    lazy = build_lazy(program).frame_templates
+    eager = build(program).frame_templates
+    assert list(lazy.items()) == list(eager.items())
+
+def test_lazy_codegen_call_order(capsys):
+    # f is generated after main with --lazy, before it otherwise
+    program = (
+        'void f() { array int m = new int[2]; m[0] = 5; print(itos(m[0])); } \n'
+        'void main() { \n'
+        '  dict(string, int) m = new dict(); m["a"] = 1; \n'
+        '  f(); print(itos(m["a"])); \n'
+        '} \n'
+    )
+    lazy = build_lazy(program)
+    lazy.run()
+    assert capsys.readouterr().out == '51'
+    eager = build(program)
+    eager.run()
+    assert capsys.readouterr().out == '51'
+    assert sorted(dict.items(lazy.frame_templates)) == sorted(eager.frame_templates.items())
+
+#----------------------------------------------------------------------
+# Incremental compilation
+#----------------------------------------------------------------------
+
+INCREMENTAL_PROGRAM = (
+    'struct P { int x; int y; } \n'
+    'int f(int x) { return x + 1; } \n'
+    '// braces in comments } and strings are skipped \n'
+    'string g() { return "}{"; } \n'
+    'void main() { \n'
+    '  P p = new P(1, 2); \n'
+    '  if (f(p.x) > 1) { print(g()); } \n'
+    '} \n'
+)
+
+def same_templates(vm1, vm2):
+    templates1 = {n: (t.instructions, t.sites) for n, t in vm1.frame_templates.items()}
+    templates2 = {n: (t.instructions, t.sites) for n, t in vm2.frame_templates.items()}
+    return templates1 == templates2
+
+def test_split_definitions():
+    pieces = split_definitions(INCREMENTAL_PROGRAM)
+    assert [text.split('{')[0].split('\n')[-1] for text, _, _ in pieces[:4]] == \
+        ['struct P ', 'int f(int x) ', 'string g() ', 'void main() ']
+    assert [(line, column) for _, line, column in pieces] == [(1, 0), (1, 26), (2, 30), (4, 27), (8, 1)]
+    assert ''.join(text for text, _, _ in pieces) == INCREMENTAL_PROGRAM
+
+def test_incremental_matches_full_compile(capsys):
+    compiler = IncrementalCompiler()
+    vm = compiler.compile(INCREMENTAL_PROGRAM)
+    assert same_templates(vm, build_opt(INCREMENTAL_PROGRAM, 0))
+    assert compiler.generated == ['f', 'g', 'main']
+    vm.run()
+    assert capsys.readouterr().out == '}{'
+    # adding lines moves the later definitions down
+    program = INCREMENTAL_PROGRAM.replace('x + 1;', 'x \n + \n 1;')
+    vm = compiler.compile(program)
+    assert same_templates(vm, build_opt(program, 0))
+    assert vm.frame_templates['main'].sites == build_opt(program, 0).frame_templates['main'].sites
+    assert compiler.parsed == ['f']
+    assert compiler.checked == ['f']
+    assert compiler.generated == ['f']
+
+def test_incremental_unchanged_program():
+    compiler = IncrementalCompiler(2)
+    compiler.compile(INCREMENTAL_PROGRAM)
+    vm = compiler.compile(INCREMENTAL_PROGRAM)
+    assert compiler.parsed == compiler.checked == compiler.generated == []
+    assert same_templates(vm, build_opt(INCREMENTAL_PROGRAM, 2))
+
+def test_incremental_signature_change_rechecks_callers():
+    compiler = IncrementalCompiler()
+    compiler.compile(INCREMENTAL_PROGRAM)
+    program = INCREMENTAL_PROGRAM.replace('int f(int x) { return x + 1; }',
+                                          'int f(int x, int y) { return x + y; }')
+    with pytest.raises(MyPLError) as e:
+        compiler.compile(program)
+    assert compiler.checked == ['f', 'main']
+    with pytest.raises(MyPLError) as expected:
+        ASTParser(Lexer(FileWrapper(io.StringIO(program)))).parse().accept(SemanticChecker())
+    assert str(e.value) == str(expected.value)
+
+def test_incremental_struct_change_regenerates_users():
+    compiler = IncrementalCompiler()
+    compiler.compile(INCREMENTAL_PROGRAM)
+    program = INCREMENTAL_PROGRAM.replace('int x; int y;', 'int y; int x;')
+    vm = compiler.compile(program)
+    assert compiler.checked == ['P', 'main']
+    assert compiler.generated == ['main']
+    assert same_templates(vm, build_opt(program, 0))
+
+def test_incremental_struct_dict_field_regenerates_functions(capsys):
+    program = 'void main() { array int m = new int[1]; m[0] = 5; print(itos(m[0])); } \n'
+    compiler = IncrementalCompiler()
+    compiler.compile(program).run()
+    assert capsys.readouterr().out == '5'
+    # an unrelated struct's dictionary field changes how main uses m
+    program += 'struct B { dict(string, int) m; } \n'
+    with pytest.raises(MyPLError) as e:
+        compiler.compile(program).run()
+    assert compiler.generated == ['main']
+    with pytest.raises(MyPLError) as expected:
+        build_opt(program, 0).run()
+    assert str(e.value) == str(expected.value)
+
+def test_incremental_parse_error_matches_full_parse():
+    compiler = IncrementalCompiler()
+    compiler.compile(INCREMENTAL_PROGRAM)
+    program = INCREMENTAL_PROGRAM.replace('return x + 1;', 'return x +;')
+    with pytest.raises(MyPLError) as e:
+        compiler.compile(program)
+    with pytest.raises(MyPLError) as expected:
+        ASTParser(Lexer(FileWrapper(io.StringIO(program)))).parse()
+    assert str(e.value) == str(expected.value)
+
+#----------------------------------------------------------------------
+# Warm server
+#----------------------------------------------------------------------
+
+def test_run_remote_without_server(tmp_path):
+    assert run_remote(['prog.mypl'], str(tmp_path / 'none.sock')) is None
+
+def test_run_remote(tmp_path):
+    import os, signal, subprocess, sys, time
+    path = str(tmp_path / 'mypl.sock')
+    mypl = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mypl.py')
+    server = subprocess.Popen([sys.executable, mypl, '--serve', '--socket', path],
+                              stderr=subprocess.DEVNULL)
+    try:
+        while not os.path.exists(path):
+            time.sleep(0.05)
+        socket_mode = os.stat(path).st_mode & 0o777
+        (tmp_path / 'prog.mypl').write_text('void main() { print(input() + "!"); } \n')
+        (tmp_path / 'bad.mypl').write_text('void main() { print(x); } \n')
+        (tmp_path / 'in.txt').write_text('hi\n')
+        with open(tmp_path / 'in.txt') as stdin, open(tmp_path / 'out.txt', 'w') as stdout:
+            fds = (stdin.fileno(), stdout.fileno(), stdout.fileno())
+            assert run_remote([str(tmp_path / 'prog.mypl')], path, fds) == 0
+            assert run_remote([str(tmp_path / 'bad.mypl')], path, fds) == 1
+        assert (tmp_path / 'out.txt').read_text().startswith('hi!Static Error:')
+    finally:
+        server.send_signal(signal.SIGINT)
+        server.wait()
+    assert not os.path.exists(path)
+    assert socket_mode == 0o600
+
+def test_default_socket(monkeypatch):
+    import os, tempfile
+    monkeypatch.delenv('MYPL_SOCKET', raising=False)
+    monkeypatch.setenv('XDG_RUNTIME_DIR', '/run/user/1000')
+    assert default_socket() == '/run/user/1000/mypl.sock'
+    monkeypatch.delenv('XDG_RUNTIME_DIR')
+    assert default_socket() == os.path.join(tempfile.gettempdir(), f'mypl-{os.getuid()}', 'mypl.sock')
+    monkeypatch.setenv('MYPL_SOCKET', '/x/y.sock')
+    assert default_socket() == '/x/y.sock'
+
+def test_make_private_dir(tmp_path):
+    import os, stat
+    path = str(tmp_path / 'private')
+    make_private_dir(path)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o700
+    os.chmod(path, 0o755)
+    with pytest.raises(OSError):
+        make_private_dir(path)
+
+def test_send_request_forwards_only_mypl_env(monkeypatch):
+    import json, os, socket, struct
+    monkeypatch.setenv('MYPL_CACHE_DIR', '/cache')
+    monkeypatch.setenv('SECRET_TOKEN', 'hunter2')
+    client, server = socket.socketpair()
+    with client, server:
+        send_request(client, ['prog.mypl'], [0, 1, 2])
+        size_data, fds, _, _ = socket.recv_fds(server, 4, 3)
+        for fd in fds:
+            os.close(fd)
+        request = json.loads(recv_exactly(server, struct.unpack('<I', size_data)[0]))
+    assert request['env'] == {'MYPL_CACHE_DIR': '/cache'}
+
+def test_run_remote_refuses_other_users_socket(tmp_path, monkeypatch, capsys):
+    import os, socket
+    path = str(tmp_path / 'mypl.sock')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as listener:
+        listener.bind(path)
+        listener.listen()
+        uid = os.getuid()
+        monkeypatch.setattr(os, 'getuid', lambda: uid + 1)
+        assert run_remote(['prog.mypl'], path) is None
+        assert 'not a socket owned by this user' in capsys.readouterr().err
+        # nothing was sent
+        listener.settimeout(0.1)
+        with pytest.raises(socket.timeout):
+            listener.accept()
+
+def test_trusted_peer(monkeypatch):
+    import os, socket
+    client, server = socket.socketpair()
+    with client, server:
+        assert trusted_peer(server)
+        if hasattr(socket, 'SO_PEERCRED'):
+            uid = os.getuid()
+            monkeypatch.setattr(os, 'getuid', lambda: uid + 1)
+            assert not trusted_peer(server)
+
+#----------------------------------------------------------------------
+# Batch runner
+#----------------------------------------------------------------------
+
+def test_run_program(tmp_path):
+    (tmp_path / 'p.mypl').write_text('void main() { print(input() + "!"); } \n')
+    (tmp_path / 'p.input').write_text('hi\n')
+    (tmp_path / 'p.expected').write_text('hi!')
+    result = run_program(str(tmp_path / 'p.mypl'))
+    assert (result.name, result.stdout, result.status) == ('p.mypl', 'hi!', 0)
+    assert result.passed()
+    (tmp_path / 'q.mypl').write_text('void main() { print(x); } \n')
+    result = run_program(str(tmp_path / 'q.mypl'))
+    assert result.status == 1 and result.stdout.startswith('Static Error:')
+    assert result.expected is None and not result.passed()
+
+def test_run_batch(tmp_path, capsys):
+    (tmp_path / 'a.mypl').write_text('void main() { print("a"); } \n')
+    (tmp_path / 'a.expected').write_text('a')
+    (tmp_path / 'b.mypl').write_text('void main() { print("b"); } \n')
+    (tmp_path / 'b.expected').write_text('c')
+    (tmp_path / 'c.mypl').write_text('void main() { } \n')
+    (tmp_path / 'notes.txt').write_text('not a program')
+    assert run_batch(str(tmp_path), 1, 2) == 1
+    lines = capsys.readouterr().out.splitlines()
+    assert [line.split()[0] for line in lines[:4]] == ['PASS', 'FAIL', '---', '+++']
+    assert lines[0].endswith(' a.mypl') and lines[1].endswith(' b.mypl')
+    assert '    -c' in lines and '    +b' in lines
+    assert lines[-2].split()[0] == 'OK' and lines[-2].endswith(' c.mypl')
+    assert lines[-1].startswith('3 programs, 2 passed, 1 failed')
+
+def test_run_batch_stops_programs_that_time_out(tmp_path, capsys):
+    (tmp_path / 'a.mypl').write_text('void main() { while (true) { int x = 1; } } \n')
+    (tmp_path / 'b.mypl').write_text('void main() { print("b"); } \n')
+    result = run_program(str(tmp_path / 'a.mypl'), 0, 0.2)
+    assert result.timed_out and result.status == 1 and not result.passed()
+    assert result.stderr == 'timed out after 0.2s\n'
+    assert run_batch(str(tmp_path), 0, 1, 0.2) == 1
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].split()[0] == 'TIMEOUT' and lines[0].endswith(' a.mypl')
+    assert lines[1] == '    timed out after 0.2s'
+    assert lines[2].split()[0] == 'OK'
+    assert lines[-1].startswith('2 programs, 1 passed, 1 failed')
+
+def test_jobs_and_timeout_must_be_positive(capsys):
+    import mypl
+    for flags in (['-j', '0'], ['-j', '-2'], ['--timeout', '0']):
+        with pytest.raises(SystemExit):
+            mypl.main(['--batch', '.'] + flags)
+        assert 'must be greater than 0' in capsys.readouterr().err
+
+#----------------------------------------------------------------------
+# Parallel checking and code generation
+#----------------------------------------------------------------------
+
+PARALLEL_PROGRAM = (
+    'struct S { int v; dict(string, int) m; } \n'
+    'int a() { dict(string, int) d = new dict(); d["x"] = 1; return d["x"]; } \n'
+    'int b() { array int d = new int[3]; d[0] = 4; return d[0]; } \n'
+    'int c(int n) { int t = 0; for (int i = 0; i < n; i = i + 1) { t = t + i; } return t; } \n'
+    'void main() { S s = new S(1, new dict()); print(a() + c(4) + s.v); } \n'
+)
+
+def test_parallel_matches_serial():
+    for opt_level in range(3):
+        program = ASTParser(Lexer(FileWrapper(io.StringIO(PARALLEL_PROGRAM)))).parse()
+        vm = VM()
+        compile_parallel(program, vm, opt_level, jobs=2)
+        serial = build_opt(PARALLEL_PROGRAM, opt_level)
+        assert list(vm.frame_templates.items()) == list(serial.frame_templates.items())
+
+def test_parallel_reports_serial_error():
+    program = PARALLEL_PROGRAM.replace('return t;', 'return x;').replace('print(a()', 'print(z()')
+    with pytest.raises(MyPLError) as e:
+        compile_parallel(ASTParser(Lexer(FileWrapper(io.StringIO(program)))).parse(), VM(), jobs=2)
+    assert 'Use before def error for x' in str(e.value)
+
+#----------------------------------------------------------------------
+# Buffered input
+#----------------------------------------------------------------------
+
+def test_buffered_wrapper_read_and_peek():
+    in_stream = BufferedWrapper(io.StringIO('ab'))
+    assert in_stream.peek_char() == 'a'
+    assert in_stream.read_char() == 'a'
+    assert in_stream.peek_char() == 'b'
+    assert in_stream.read_char() == 'b'
+    assert in_stream.peek_char() == ''
+    assert in_stream.read_char() == ''
+    assert in_stream.read_char() == ''
+
+def test_buffered_wrapper_same_tokens():
+    program = (
+        'struct S { int x; } // comment \n'
+        'void main() { \n'
+        '  string s = "a b"; double d = 3.25; \n'
+        '  if (s != null and not false) { print(s); } \n'
+        '} \n'
+    )
+    file_lexer = Lexer(FileWrapper(io.StringIO(program)))
+    buffered_lexer = Lexer(BufferedWrapper(io.StringIO(program)))
+    while True:
+        t = file_lexer.next_token()
+        assert buffered_lexer.next_token() == t
+        if t.token_type == TokenType.EOS:
+            break
+
+#----------------------------------------------------------------------
+# Table-driven lexer
+#----------------------------------------------------------------------
+
+def lex_all(program):
+    """Returns (type, lexeme, line, column) for each token of a program,
+    with ('error', message, line, column) for each lexer error."""
+    lexer = Lexer(FileWrapper(io.StringIO(program)))
+    result = []
+    while not result or result[-1][0] != TokenType.EOS:
+        try:
+            t = lexer.next_token()
+            result.append((t.token_type, t.lexeme, t.line, t.column))
+        except MyPLError as e:
+            result.append(('error', str(e), lexer.line, lexer.column))
+    return result
+
+def test_table_lexer_keywords_and_ids():
+    assert lex_all('while x; \n return;elseif(trueish') == [
+        (TokenType.WHILE, 'while', 1, 1), (TokenType.ID, 'x', 1, 7),
+        (TokenType.SEMICOLON, ';', 1, 8), (TokenType.ID, 'return', 2, 2),
+        (TokenType.SEMICOLON, ';', 2, 8), (TokenType.ELSEIF, 'elseif', 2, 9),
+        (TokenType.LPAREN, '(', 2, 15), (TokenType.BOOL_VAL, 'true', 2, 16),
+        (TokenType.ID, 'ish', 2, 20), (TokenType.EOS, '', 2, 23)]
+
+def test_table_lexer_comment_and_string_positions():
+    assert lex_all('//ab\n  "x y" <= 2.5') == [
+        (TokenType.COMMENT, ' b', 1, 1), (TokenType.STRING_VAL, 'x y', 2, 3),
+        (TokenType.LESS_EQ, '<=', 2, 9), (TokenType.DOUBLE_VAL, '2.5', 2, 12),
+        (TokenType.EOS, '', 2, 15)]
+
+def test_table_lexer_errors_consume_bad_characters():
+    tokens = lex_all('! 05 3x #')
+    assert [t[0] for t in tokens] == ['error', 'error', TokenType.INT_VAL, 'error',
+                                      TokenType.ID, 'error', TokenType.EOS]
+    assert tokens[0][1].endswith('Invalid Use of ! at line 1, column 1')
+    assert tokens[1][1].endswith('Leading Zero at line 1, column 3')
+    assert tokens[3][1].endswith('Invalid Number at line 1, column 6')
+    assert tokens[5][1].endswith('Invalid Symbol at line 1, column 9')
+
+def test_table_lexer_unterminated_string():
+    tokens = lex_all('"ab\nc" "open')
+    assert tokens[0][1].endswith('No Endquotes at line 1, column 1')
+    assert tokens[1][1].endswith('No Endquotes at line 1, column 8')
+    assert tokens[2] == (TokenType.EOS, '', 1, 13)
+
+#----------------------------------------------------------------------
+# Token streams
+#----------------------------------------------------------------------
+
+def test_lexer_tokens_skip_comments():
+    program = 'int x // a comment \n = 1; // another'
+    lexer = Lexer(FileWrapper(io.StringIO(program)))
+    types = [t.token_type for t in lexer.tokens()]
+    assert types == [TokenType.INT_TYPE, TokenType.ID, TokenType.ASSIGN, TokenType.INT_VAL,
+                     TokenType.SEMICOLON, TokenType.EOS]
+    lexer = Lexer(FileWrapper(io.StringIO(program)))
+    assert [t.token_type for t in lexer.tokens(comments=True)].count(TokenType.COMMENT) == 2
+
+def test_lexer_tokens_long_whitespace():
+    program = 'x' + ' \n' * 100000 + 'y'
+    tokens = list(Lexer(FileWrapper(io.StringIO(program))).tokens())
+    assert [(t.lexeme, t.line, t.column) for t in tokens] == [
+        ('x', 1, 1), ('y', 100001, 1), ('', 100001, 2)]
+
+def test_token_stream_lookahead():
+    program = 'a b c d'
+    stream = TokenStream(Lexer(FileWrapper(io.StringIO(program))).tokens(), 2)
+    assert stream.peek().lexeme == 'a' and stream.peek(1).lexeme == 'b'
+    with pytest.raises(IndexError):
+        stream.peek(2)
+    assert stream.next().lexeme == 'a'
+    assert stream.peek(1).lexeme == 'c'
+    assert [stream.next().lexeme for _ in range(3)] == ['b', 'c', 'd']
+    # the end-of-stream token repeats
+    assert stream.next().token_type == TokenType.EOS
+    assert stream.peek(1).token_type == TokenType.EOS
+    assert stream.next().token_type == TokenType.EOS
+
+#----------------------------------------------------------------------
+# Memory-mapped input
+#----------------------------------------------------------------------
+
+def test_mapped_wrapper_read_and_peek(tmp_path):
+    path = tmp_path / 'prog.mypl'
+    path.write_bytes('aé'.encode('utf-8'))
+    in_stream = MappedWrapper(open(path, 'rb'))
+    assert in_stream.peek_char() == 'a'
+    assert in_stream.read_char() == 'a'
+    assert in_stream.read_char() == 'é'
+    assert in_stream.peek_char() == '' and in_stream.read_char() == ''
+    in_stream.close()
+    path.write_bytes(b'')
+    in_stream = MappedWrapper(open(path, 'rb'))
+    assert Lexer(in_stream).next_token().token_type == TokenType.EOS
+    in_stream.close()
+
+def test_mapped_wrapper_same_tokens(tmp_path):
+    program = (
+        'struct S { int x; } // comment é \r\n'
+        'void main() {\r\n'
+        '  string s = "naïve"; double d = 3.25;//\r\n'
+        '  naïve = d; \r\n'
+        '  if (s != null and not false) { print(s); }\u00a0²x \n'
+        '}'
+    )
+    path = tmp_path / 'prog.mypl'
+    path.write_bytes(program.encode('utf-8'))
+    tokens = []
+    for in_stream in [BufferedWrapper(open(path, 'r', encoding='utf-8')), MappedWrapper(open(path, 'rb'))]:
+        lexer = Lexer(in_stream)
+        tokens.append([])
+        while True:
+            try:
+                t = lexer.next_token()
+            except MyPLError as e:
+                tokens[-1].append(str(e))
+                continue
+            tokens[-1].append(t)
+            if t.token_type == TokenType.EOS:
+                break
+        in_stream.close()
+    assert tokens[0] == tokens[1]
+    comments = [t.lexeme for t in tokens[0] if type(t) == Token and t.token_type == TokenType.COMMENT]
+    assert comments == [' comment é ', '   naïve = d; ']
+    errors = [t for t in tokens[0] if isinstance(t, str)]
+    assert len(errors) == 1 and errors[0].endswith('Invalid Symbol at line 4, column 46')
+
+def test_mapped_wrapper_lone_carriage_returns(tmp_path):
+    # a lone \r ends a line, as when the file is read in text mode
+    program = 'void main() {\r  // c\r  print("a");\r\n  int x = 1; }\r'
+    path = tmp_path / 'prog.mypl'
+    path.write_bytes(program.encode('utf-8'))
+    tokens = []
+    for in_stream in [BufferedWrapper(open(path, 'r', encoding='utf-8')), MappedWrapper(open(path, 'rb'))]:
+        tokens.append([(t.token_type, t.lexeme, t.line, t.column) for t in Lexer(in_stream).tokens(comments=True)])
+        assert in_stream.text == 'void main() {\n  // c\n  print("a");\n  int x = 1; }\n'
+        in_stream.close()
+    assert tokens[0] == tokens[1]
+    assert tokens[0][5] == (TokenType.COMMENT, ' c', 2, 3)
+    assert tokens[0][-1] == (TokenType.EOS, '', 5, 1)
+
+#----------------------------------------------------------------------
+# Compact tokens
+#----------------------------------------------------------------------
+
+def test_tokens_have_slots():
+    t = Token(TokenType.ID, 'x', 1, 2)
+    assert not hasattr(t, '__dict__')
+    t.line += 1
+    assert t == Token(TokenType.ID, 'x', 2, 2)
+
+def test_lexer_interns_names():
+    program = 'int total = total1; total = total; while while'
+    names = {}
+    for t in Lexer(FileWrapper(io.StringIO(program))).tokens():
+        if t.token_type in (TokenType.ID, TokenType.WHILE):
+            assert names.setdefault(t.lexeme, t.lexeme) is t.lexeme
+    assert sorted(names) == ['total', 'total1', 'while']
+
+def test_tables_intern_names():
+    name = ''.join(['a', 'b'])
+    table = SymbolTable()
+    table.push_environment()
+    table.add(name, 1)
+    assert next(iter(table.environments[-1])) is sys.intern('ab')
+    var_table = VarTable()
+    var_table.push_environment()
+    var_table.add(name)
+    assert var_table.environments[-1][0] is sys.intern('ab')
+    assert var_table.get('ab') == 0
+
+def test_field_lookup_without_interned_names():
+    program = 'struct S { int ab; } void main() { S s = new S(1); s.ab = 2; } \n'
+    p = ASTParser(Lexer(FileWrapper(io.StringIO(program)))).parse()
+    # a field name that didn't come from the lexer
+    field = p.fun_defs[0].stmts[1].lvalue[1].var_name
+    field.lexeme = ''.join(['a', 'b'])
+    assert field.lexeme is not sys.intern('ab')
+    p.accept(SemanticChecker())
+    field.lexeme = 'abc'
+    with pytest.raises(MyPLError) as e:
+        p.accept(SemanticChecker())
+    assert 'field abc not in struct type S' in str(e.value)
+
+#----------------------------------------------------------------------
+# Slotted AST nodes
+#----------------------------------------------------------------------
+
+def test_ast_nodes_have_slots():
+    program = ASTParser(Lexer(FileWrapper(io.StringIO('void main() { int x = (1 + 2); }')))).parse()
+    for node in walk_nodes(program.fun_defs[0]):
+        assert not hasattr(node, '__dict__')
+    with pytest.raises(AttributeError):
+        program.fun_defs[0].extra = 1
+
+def test_dict_param_key_type(capsys):
+    program = (
+        'int f(dict(string, int) d) { return d["a"]; } \n'
+        'void main() { dict(string, int) m = new dict(); m["a"] = 3; print(f(m)); } \n'
+    )
+    p = ASTParser(Lexer(FileWrapper(io.StringIO(program)))).parse()
+    assert p.fun_defs[0].params[0].data_type.key_type_name.lexeme == 'string'
+    assert p.fun_defs[0].params[0].data_type.element_type_name.lexeme == 'int'
+    p.accept(SemanticChecker())
+    for opt_level in range(3):
+        build_opt(program, opt_level).run()
+        assert capsys.readouterr().out == '3'
+
+def test_dict_and_array_share_name_across_functions(capsys):
+    program = (
+        'int f(dict(string, int) m) { return 0; } \n'
+        'void g() { dict(string, int) a = new dict(); a["k"] = 1; } \n'
+        'void main() { \n'
+        '  array int m = new int[2]; m[0] = 7; \n'
+        '  array int a = new int[1]; a[0] = 8; \n'
+        '  print(m[0]); print(a[0]); \n'
+        '} \n'
+    )
+    for opt_level in range(3):
+        build_opt(program, opt_level).run()
+        assert capsys.readouterr().out == '78'
+
+def test_inlined_body_has_own_dict_names(capsys):
+    program = (
+        'int f(int i) { array int m = new int[1]; m[0] = i; return m[0]; } \n'
+        'void main() { \n'
+        '  dict(string, int) m = new dict(); m["a"] = 0; \n'
+        '  for (int i = 0; i < 5; i = i + 1) { m["a"] = m["a"] + f(i); } \n'
+        '  print(m["a"]); \n'
+        '} \n'
+    )
+    profile = profile_run(program, capsys)
+    vm = build_opt(program, 0, profile)
+    assert count_ops(vm, 'main', OpCode.CALL) == 0
+    vm.run()
+    assert capsys.readouterr().out == '10'
+
+#----------------------------------------------------------------------
+# Operator precedence
+#----------------------------------------------------------------------
+
+def test_precedence_and_associativity(capsys):
+    program = (
+        'void main() { \n'
+        '  print(1 + 2 * 3); print(" "); print(10 - 4 - 3); print(" "); \n'
+        '  print(16 / 4 / 2); print(" "); print(2 * (3 + 4) - 1); print(" "); \n'
+        '  print(1 + 2 < 4 and not 3 < 2); print(" "); print(false and true or true); \n'
+        '} \n'
+    )
+    ast = ASTParser(Lexer(FileWrapper(io.StringIO(program)))).parse()
+    ast.accept(SemanticChecker())
+    for opt_level in range(3):
+        build_opt(program, opt_level).run()
+        assert capsys.readouterr().out == '7 3 2 13 true true'
+
+def test_boolean_chains_are_balanced(capsys):
+    program = 'void main() { print(' + ' and '.join(['true'] * 1000) + '); }'
+    p = ASTParser(Lexer(FileWrapper(io.StringIO(program)))).parse()
+    depth, expr = 0, p.fun_defs[0].stmts[0].args[0]
+    while expr.op:
+        depth, expr = depth + 1, expr.rest
+    assert depth <= 10
+    build(program).run()
+    assert capsys.readouterr().out == 'true'
+
+def test_arithmetic_chains_are_balanced(capsys):
+    program = 'void main() { int x = 1; print(x' + ' + x * 2' * 1000 + '); }'
+    p = ASTParser(Lexer(FileWrapper(io.StringIO(program)))).parse()
+    depth, expr = 0, p.fun_defs[0].stmts[1].args[0]
+    while expr.op:
+        depth, expr = depth + 1, expr.rest
+    assert depth <= 11
+    p.accept(SemanticChecker())
+    for opt_level in range(3):
+        build_opt(program, opt_level).run()
+        assert capsys.readouterr().out == '2001'
+
+def test_double_chains_group_from_left(capsys):
+    program = (
+        'void main() { \n'
+        '  double x = 0.1; \n'
+        '  print(x + 0.2 + 0.3); print(" "); print((x + 0.2) + 0.3 + 1.0); print(" "); \n'
+        '  print(x + (0.2 + 0.3)); print(" "); print(x * 3.0 * 0.1 * 7.0); print(" "); \n'
+        '  print(x + 0.7 + 0.3 + (0.1 + 0.2) + 0.3 + 0.6); \n'
+        '} \n'
+    )
+    x = 0.1
+    expected = [x + 0.2 + 0.3, x + 0.2 + 0.3 + 1.0, x + (0.2 + 0.3), x * 3.0 * 0.1 * 7.0,
+                x + 0.7 + 0.3 + (0.1 + 0.2) + 0.3 + 0.6]
+    assert expected[0] != expected[2]
+    for opt_level in range(3):
+        p = ASTParser(Lexer(FileWrapper(io.StringIO(program)))).parse()
+        p.accept(SemanticChecker())
+        vm = VM()
+        p.accept(CodeGenerator(vm, opt_level))
+        vm.run()
+        assert capsys.readouterr().out == ' '.join(str(v) for v in expected)
+
+def test_printer_groups_by_precedence(capsys):
+    def printed(expr):
+        program = 'void main() { x = ' + expr + '; }'
+        ASTParser(Lexer(FileWrapper(io.StringIO(program)))).parse().accept(PrintVisitor())
+        return capsys.readouterr().out.split('x = ')[1].split(';')[0]
+    cases = {
+        '1 + 2 * 3 - 4': '1 + 2 * 3 - 4',
+        '1 + 2 * 3 + 4': '1 + 2 * 3 + 4',
+        'x - 1 - 2': 'x - 1 - 2',
+        '(x - 1) - 2': 'x - 1 - 2',
+        'x - (1 - 2)': 'x - (1 - 2)',
+        'x - (1 + 2)': 'x - (1 + 2)',
+        '(x + 1) * 2': '(x + 1) * 2',
+        'x * (y / 2)': 'x * (y / 2)',
+        '(x + 1) + 2': 'x + 1 + 2',
+        'a + b + c + (p + q) + x + y': 'a + b + c + (p + q) + x + y',
+        'a + (b - c + d) + e': 'a + (b - c + d) + e',
+        '(x)': 'x',
+        'not x < 2 and true': 'not (x < 2) and true',
+        'not (a and b)': 'not (a and b)',
+        '(not a) == b': '(not a) == b',
+        '(a == not b) == c': '(a == not b) == c',
+        'a or (b and c)': 'a or b and c',
+        '(a or b) and c': '(a or b) and c',
+    }
+    for expr, expected in cases.items():
+        assert printed(expr) == expected
+        # the output parses back to an expression that prints the same
+        assert printed(expected) == expected
+    assert printed(' + '.join(['x'] * 20000)).count('(') == 0
+
+#----------------------------------------------------------------------
+# Traversal engine
+#----------------------------------------------------------------------
+
+def test_long_expressions_past_recursion_limit(capsys):
+    terms = sys.getrecursionlimit() * 3
+    program = 'void main() { int x = 2; print(x' + ' + x - 1' * terms + '); }'
+    p = ASTParser(Lexer(FileWrapper(io.StringIO(program)))).parse()
+    p.accept(SemanticChecker())
+    p.accept(PrintVisitor())
+    assert capsys.readouterr().out.count('+ x') == terms
+    for opt_level in range(3):
+        build_opt(program, opt_level).run()
+        assert capsys.readouterr().out == str(2 + terms)
+
+def test_deep_nesting_and_errors_through_engine(capsys):
+    depth = 300
+    program = ('void main() { int x = 0; ' + 'if (x >= 0) { x = x + 1; ' * depth +
+               'print(x);' + ' }' * depth + ' }')
+    p = ASTParser(Lexer(FileWrapper(io.StringIO(program)))).parse()
+    p.accept(SemanticChecker())
+    for opt_level in range(3):
+        build_opt(program, opt_level).run()
+        assert capsys.readouterr().out == str(depth)
+    program = 'void main() { int x = 1' + ' + x' * 3000 + ' + "a"; }'
+    p = ASTParser(Lexer(FileWrapper(io.StringIO(program)))).parse()
+    with pytest.raises(MyPLError) as e:
+        p.accept(SemanticChecker())
+    assert str(e.value).startswith('Static Error:')
+
+def test_handler_table_dispatch(capsys):
+    class CountingPrinter(PrintVisitor):
+        def __init__(self):
+            super().__init__()
+            self.var_rvalues = 0
+        def visit_var_rvalue(self, var_rvalue):
+            self.var_rvalues += 1
+            yield from super().visit_var_rvalue(var_rvalue)
+    table = handler_table(CountingPrinter)
+    assert table[Expr] is PrintVisitor.visit_expr
+    assert table[VarRValue] is CountingPrinter.visit_var_rvalue
+    program = 'void main() { int x = 1; x = x + x * 2; }'
+    printer = CountingPrinter()
+    ASTParser(Lexer(FileWrapper(io.StringIO(program)))).parse().accept(printer)
+    assert printer.var_rvalues == 2
+    assert 'x = x + x * 2;' in capsys.readouterr().out
+
+
+#----------------------------------------------------------------------
+# Built-in function registry
+#----------------------------------------------------------------------
+
+def check_program(program):
+    p = ASTParser(Lexer(FileWrapper(io.StringIO(program)))).parse()
+    p.accept(SemanticChecker())
+
+def test_registry_describes_built_ins():
+    assert BUILT_INS['print'].opcode == OpCode.WRITE and not BUILT_INS['print'].pure
+    assert BUILT_INS['stoi'].opcode == OpCode.TOINT and BUILT_INS['stoi'].pure
+    assert all(b.native is None for b in BUILT_INS.values())
+    check_program('void main() { dict(int, string) d = new dict(); '
+                  'array int k = keys(d); print(length(k)); print(in(d, 3)); '
+                  'print(get(0, itos(length("ab")))); print(null); }')
+    for call in ['itos("a")', 'length(3)', 'keys(1)', 'get(1)', 'input(1)',
+                 'print(new int[2])', 'in(1, 2)', 'dtoi(null)']:
+        with pytest.raises(MyPLError) as e:
+            check_program('void main() { print(' + call + '); }')
+        assert str(e.value).startswith('Static Error:')
+
+def test_register_native(capsys):
+    register_native('hypot', ['double', 'double'], 'double',
+                    lambda x, y: (x * x + y * y) ** 0.5, pure=True)
+    register_native('total', ['array int'], 'int', sum)
+    register_native('squares', ['int'], 'array int', lambda n: [i * i for i in range(n)])
+    register_native('clear', ['array int'], 'void', lambda xs: xs.clear())
+    try:
+        program = ('void main() { array int xs = squares(4); print(total(xs)); '
+                   'print(" "); print(dtos(hypot(3.0, 4.0))); clear(xs); '
+                   'print(" "); print(length(xs)); }')
+        check_program(program)
+        for opt_level in range(3):
+            build_opt(program, opt_level).run()
+            assert capsys.readouterr().out == '14 5.0 0'
+        with pytest.raises(MyPLError) as e:
+            check_program('void main() { print(total(3)); }')
+        assert str(e.value).startswith('Static Error:')
+        with pytest.raises(MyPLError) as e:
+            check_program('int hypot(int x) { return x; } void main() { }')
+        assert str(e.value).startswith('Static Error:')
+    finally:
+        for name in ['hypot', 'total', 'squares', 'clear']:
+            unregister_native(name)
+    assert 'hypot' not in BUILT_INS
+
+def test_native_purity_decides_folding(capsys):
+    register_native('twice', ['int'], 'int', lambda x: 2 * x, pure=True)
+    register_native('ticks', [], 'int', lambda: 7)
+    try:
+        program = ('int f(int x) { return twice(x) + 1; } '
+                   'int g() { return ticks(); } '
+                   'void main() { print(f(20)); print(g()); }')
+        vm = build_opt(program, 2)
+        assert count_ops(vm, 'main', OpCode.CALL) == 1
+        assert count_ops(vm, 'g', OpCode.NATIVE) == 1
+        vm.run()
+        assert capsys.readouterr().out == '417'
+    finally:
+        unregister_native('twice')
+        unregister_native('ticks')
+
+def test_register_native_errors():
+    with pytest.raises(ValueError):
+        register_native('print', ['string'], 'void', print)
+    with pytest.raises(ValueError):
+        register_native('count', ['dict'], 'int', len)
+    with pytest.raises(ValueError):
+        register_native('nothing', ['void'], 'int', len)
+    with pytest.raises(ValueError):
+        unregister_native('length')
+    register_native('fails', ['int'], 'int', lambda x: 1 // x)
+    try:
+        with pytest.raises(MyPLError) as e:
+            build_opt('void main() { print(fails(0)); }', 0).run()
+        assert str(e.value).startswith('VM Error:')
+    finally:
+        unregister_native('fails')
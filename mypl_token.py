@@ -29,8 +29,10 @@ TokenType = Enum('TokenType', [
 ])
     
 
-@dataclass
+@dataclass(slots=True)
 class Token:
+    # identifier and reserved word lexemes from the lexer are interned,
+    # so tokens with the same name share one string
     token_type: TokenType
     lexeme: str
     line: int
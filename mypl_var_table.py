@@ -7,12 +7,23 @@ CLASS: CPSC 326
 
 """
 
+import sys
+
+
 class VarTable:
+    """Nested environments of variables, each variable numbered by its
+    position across the environments. The index of each visible name is
+    kept in one dictionary from the name to the stack of its indexes
+    (innermost last), so lookups don't depend on the number of variables
+    in scope."""
 
     def __init__(self):
         """Create an empty var table"""
+        # variable names of each environment, from outermost to innermost
         self.environments = []
         self.total_vars = 0
+        # name -> stack of indexes from the environments that have the name
+        self.slots = {}
         
         
     def __len__(self):
@@ -36,7 +47,14 @@ class VarTable:
         """
         if self.environments:
             self.total_vars -= len(self.environments[-1])
-            self.environments.pop()
+            slots = self.slots
+            for var_name in self.environments.pop():
+                stack = slots.get(var_name)
+                # a name added twice to the environment has one index
+                if stack and stack[-1] >= self.total_vars:
+                    stack.pop()
+                    if not stack:
+                        del slots[var_name]
 
             
     def add(self, var_name):
@@ -47,7 +65,15 @@ class VarTable:
 
         """
         if self.environments:
-            self.environments[-1].append(var_name)
+            # interned (like the lexer's identifiers) so that lookups by
+            # a token's name match on identity
+            var_name = sys.intern(var_name)
+            env = self.environments[-1]
+            stack = self.slots.setdefault(var_name, [])
+            # a name added twice to an environment keeps its first index
+            if not stack or stack[-1] < self.total_vars - len(env):
+                stack.append(self.total_vars)
+            env.append(var_name)
             self.total_vars += 1
             
             
@@ -59,11 +85,7 @@ class VarTable:
             var_name -- The variable to lookup in the table.
 
         """
-        num_remaining = self.total_vars
-        for i in range(1, len(self) + 1):
-            num_remaining -= len(self.environments[-i])
-            if var_name in self.environments[-i]:
-                return num_remaining + self.environments[-i].index(var_name)
-        return None
+        stack = self.slots.get(var_name)
+        return stack[-1] if stack else None
 
     
@@ -9,6 +9,7 @@ CLASS: CPSC 326
 from mypl_error import *
 from mypl_opcode import *
 from mypl_frame import *
+from mypl_builtins import BUILT_INS
 
 
 class VM:
@@ -21,6 +22,10 @@ class VM:
         self.next_obj_id = 2024      # next available object id (int)
         self.frame_templates = {}    # function name -> VMFrameTemplate
         self.call_stack = []         # function call stack
+        self.call_counts = {}        # function name -> times called
+        self.instr_counts = {}       # function name -> per instruction counts
+        self.branch_counts = {}      # (function name, pc) -> [false, true] counts
+        self.max_steps = None        # instruction budget (None for no limit)
 
     
     def __repr__(self):
@@ -28,8 +33,8 @@ class VM:
         s = ''
         for name, template in self.frame_templates.items():
             s += f'\nFrame {name}\n'
-            for instr in template.instructions:
-                s += f'  {id}: {instr}\n'
+            for i, instr in enumerate(template.instructions):
+                s += f'  {i}: {instr}\n'
         return s
 
     
@@ -53,19 +58,75 @@ class VM:
         msg += f' (in {name} at {pc}: {instr})'
         raise VMError(msg)
 
+
+    def record(self, frame, instr):
+        """Update the profile counts for an instruction about to run."""
+        name = frame.template.function_name
+        counts = self.instr_counts.get(name)
+        if counts is None:
+            counts = [0] * len(frame.template.instructions)
+            self.instr_counts[name] = counts
+        pc = frame.pc - 1
+        counts[pc] += 1
+        if instr.opcode == OpCode.CALL:
+            self.call_counts[instr.operand] = self.call_counts.get(instr.operand, 0) + 1
+        elif instr.opcode in (OpCode.JMPF, OpCode.JMPT) and frame.operand_stack:
+            outcomes = self.branch_counts.setdefault((name, pc), [0, 0])
+            outcomes[1 if frame.operand_stack[-1] else 0] += 1
+
+
+    def profile(self):
+        """Returns the counts recorded by a profiled run as a dictionary
+        (that can be saved as JSON). Branches, loops, and call sites are
+        given by their source position so the profile can be used to
+        generate differently laid out code for the same program. A loop's
+        'true' count is the number of iterations and its 'false' count the
+        number of times its condition ended it (in both loop layouts).
+
+        """
+        functions = {}
+        branches = {}
+        loops = {}
+        call_sites = {}
+        for name, template in self.frame_templates.items():
+            counts = self.instr_counts.get(name, [0] * len(template.instructions))
+            functions[name] = {'calls': self.call_counts.get(name, 0),
+                               'instructions': counts}
+            for pc, pos in template.sites.items():
+                if template.instructions[pc].opcode == OpCode.CALL:
+                    call_sites[pos] = call_sites.get(pos, 0) + counts[pc]
+                else:
+                    false_count, true_count = self.branch_counts.get((name, pc), [0, 0])
+                    outcomes = branches.setdefault(pos, {'true': 0, 'false': 0})
+                    outcomes['true'] += true_count
+                    outcomes['false'] += false_count
+            for pc, pos in template.loops.items():
+                false_count, true_count = self.branch_counts.get((name, pc), [0, 0])
+                outcomes = loops.setdefault(pos, {'true': 0, 'false': 0})
+                outcomes['true'] += true_count
+                outcomes['false'] += false_count
+        return {'functions': functions, 'branches': branches,
+                'loops': loops, 'call_sites': call_sites}
+
     
     #----------------------------------------------------------------------
     # RUN FUNCTION
     #----------------------------------------------------------------------
     
-    def run(self, debug=False):
-        """Run the virtual machine."""
+    def run(self, debug=False, profile=False):
+        """Run the virtual machine (counting calls, branch outcomes, and
+        executed instructions if profile is True). Returns the value
+        returned by main."""
         # grab the "main" function frame and instantiate it
         if not 'main' in self.frame_templates:
             self.error('No "main" functrion')
         frame = VMFrame(self.frame_templates['main'])
         frame.variables = []
         self.call_stack.append(frame)
+        if profile:
+            self.call_counts['main'] = self.call_counts.get('main', 0) + 1
+        steps_left = self.max_steps
+        result = None
 
         # run loop (continue until run out of call frames or instructions)
         while self.call_stack and frame.pc < len(frame.template.instructions):
@@ -73,6 +134,12 @@ class VM:
             instr = frame.template.instructions[frame.pc]
             # increment the program count (pc)
             frame.pc += 1
+            if profile:
+                self.record(frame, instr)
+            if steps_left is not None:
+                steps_left -= 1
+                if steps_left < 0:
+                    self.error('instruction budget exceeded', frame)
             # for debugging:
             if debug:
                 print('\n')
@@ -216,6 +283,11 @@ class VM:
                 x = frame.operand_stack.pop()
                 if not x:
                     frame.pc = a
+            elif instr.opcode == OpCode.JMPT:
+                a = instr.operand
+                x = frame.operand_stack.pop()
+                if x:
+                    frame.pc = a
 
             
                     
@@ -231,6 +303,8 @@ class VM:
                 if len(self.call_stack) != 0:
                     frame = self.call_stack[-1]
                     frame.operand_stack.append(ret)
+                else:
+                    result = ret
 
 
             elif instr.opcode == OpCode.CALL:
@@ -258,6 +332,27 @@ class VM:
                 x = input()
                 frame.operand_stack.append(x)
 
+            elif instr.opcode == OpCode.NATIVE:
+                built_in = BUILT_INS[instr.operand]
+                args = []
+                for accepted in reversed(built_in.params):
+                    x = frame.operand_stack.pop()
+                    # arrays are passed as their lists
+                    if accepted[0].startswith('array ') and x is not None:
+                        x = self.array_heap[x]
+                    args.append(x)
+                args.reverse()
+                try:
+                    x = built_in.native(*args)
+                except Exception as ex:
+                    self.error(f'native function {instr.operand} failed: {ex}', frame)
+                if built_in.return_type.startswith('array ') and x is not None:
+                    self.array_heap[self.next_obj_id] = list(x)
+                    x = self.next_obj_id
+                    self.next_obj_id += 1
+                if built_in.return_type != 'void':
+                    frame.operand_stack.append(x)
+
             elif instr.opcode == OpCode.LEN:
                 x = frame.operand_stack.pop()
                 if type(x) == str:
@@ -378,17 +473,15 @@ class VM:
                 if y == None:
                     self.error("Invalid index for array")
                 
-                keys_list = list(self.array_heap.keys())
+                l = self.array_heap.get(oid)
         
-                if oid not in keys_list:
+                if l is None:
                     self.error("Object id doesnt exist for array")
                 
-                l = self.array_heap[oid]
-
                 if y >= len(l) or y < 0:
                     self.error("Invalid Index for array")
                 
-                self.array_heap[oid][y] = x
+                l[y] = x
 
             elif instr.opcode == OpCode.GETI:
                 x = frame.operand_stack.pop()
@@ -399,6 +492,16 @@ class VM:
                     frame.operand_stack.append(self.array_heap[y][x])
                 except:
                     self.error("index error in GETI", frame)
+
+            elif instr.opcode == OpCode.SETIU:
+                x = frame.operand_stack.pop()
+                y = frame.operand_stack.pop()
+                self.array_heap[frame.operand_stack.pop()][y] = x
+
+            elif instr.opcode == OpCode.GETIU:
+                x = frame.operand_stack.pop()
+                y = frame.operand_stack.pop()
+                frame.operand_stack.append(self.array_heap[y][x])
             # Dictionaries
             elif instr.opcode == OpCode.ALLOCD:
                 id = self.next_obj_id
@@ -430,12 +533,7 @@ class VM:
                 except:
                     self.error("dictionary object not declared", frame)
                 
-                keys = list(dictionary.keys())
-
-                if x in keys:
-                    frame.operand_stack.append(True)
-                else:
-                    frame.operand_stack.append(False)
+                frame.operand_stack.append(x in dictionary)
 
             elif instr.opcode == OpCode.GETD:
                 key = frame.operand_stack.pop()
@@ -472,3 +570,5 @@ class VM:
 
             else:
                 self.error(f'unsupported operation {instr}')
+
+        return result